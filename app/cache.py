@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import math
+import operator
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from .config import CACHE_MAX_ENTRIES, CACHE_TTL, CACHE_SIMILARITY_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+def normalizar_pregunta(pregunta):
+    """Normaliza una pregunta: minúsculas, sin acentos, sin puntuación y espacios colapsados"""
+    texto = unicodedata.normalize("NFKD", pregunta.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"[^\w\s]", " ", texto)
+    return " ".join(texto.split())
+
+def _normalizar_vector(vector):
+    norma = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norma for x in vector]
+
+
+class QuestionCache:
+    """
+    Caché de dos niveles pregunta -> SQL generado.
+
+    - Nivel exacto: pregunta normalizada + huella del esquema.
+    - Nivel semántico (opcional): similitud coseno entre embeddings por encima de un umbral.
+
+    Se guarda el SQL y no las filas, para que las respuestas cacheadas vean datos frescos.
+    Ambos niveles tienen expulsión LRU y TTL, y se vacían si cambia la huella del esquema.
+    Con `shared` (estado compartido entre workers) el nivel exacto se consulta también ahí
+    cuando falla el local.
+    """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, similarity_threshold=CACHE_SIMILARITY_THRESHOLD,
+                 shared=None):
+        self.shared = shared
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.fingerprint = None
+        self._exact = OrderedDict()     # pregunta normalizada -> (sql, expira)
+        self._semantic = OrderedDict()  # pregunta normalizada -> (vector, sql, expira)
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits_exact': 0,
+            'hits_semantic': 0,
+            'hits_shared': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0
+        }
+
+    def _check_fingerprint(self, fingerprint):
+        """Vacía la caché si la huella del esquema ha cambiado (debe llamarse con el lock tomado)"""
+        if fingerprint != self.fingerprint:
+            if self._exact or self._semantic:
+                self.stats['invalidations'] += 1
+                logger.info("Huella del esquema cambiada, invalidando caché de preguntas")
+            self._exact.clear()
+            self._semantic.clear()
+            self.fingerprint = fingerprint
+
+    def _get_fresh(self, store, key, now):
+        entry = store.get(key)
+        if entry is None:
+            return None
+        if entry[-1] < now:
+            del store[key]
+            return None
+        store.move_to_end(key)
+        return entry
+
+    def _put(self, store, key, entry):
+        store[key] = entry
+        store.move_to_end(key)
+        while len(store) > self.max_entries:
+            store.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _get_local(self, key, fingerprint):
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            entry = self._get_fresh(self._exact, key, time.monotonic())
+            if entry is not None:
+                self.stats['hits_exact'] += 1
+                return entry[0]
+        return None
+
+    def _from_shared(self, key, fingerprint, sql):
+        """Copia en el nivel local un acierto del estado compartido"""
+        if sql is None:
+            return None
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._put(self._exact, key, (sql, time.monotonic() + self.ttl))
+            self.stats['hits_shared'] += 1
+        return sql
+
+    def get(self, pregunta, fingerprint):
+        """Busca en el nivel exacto; devuelve el SQL o None (bloqueante si hay estado compartido)"""
+        key = normalizar_pregunta(pregunta)
+        sql = self._get_local(key, fingerprint)
+        if sql is not None or self.shared is None:
+            return sql
+        # Fuera del lock: la consulta al estado compartido hace E/S
+        return self._from_shared(key, fingerprint, self.shared.cache_get(key, fingerprint))
+
+    async def get_async(self, pregunta, fingerprint):
+        """Como get, pero la consulta al estado compartido se hace en el pool de hilos"""
+        key = normalizar_pregunta(pregunta)
+        sql = self._get_local(key, fingerprint)
+        if sql is not None or self.shared is None:
+            return sql
+        return self._from_shared(key, fingerprint, await asyncio.to_thread(self.shared.cache_get, key, fingerprint))
+
+    def get_similar(self, embedding, fingerprint):
+        """Busca en el nivel semántico la entrada más parecida por encima del umbral"""
+        vector = _normalizar_vector(embedding)
+        now = time.monotonic()
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            best_key, best_score = None, self.similarity_threshold
+            for key, (stored, sql, expires) in list(self._semantic.items()):
+                if expires < now:
+                    del self._semantic[key]
+                    continue
+                score = sum(map(operator.mul, vector, stored))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            self._semantic.move_to_end(best_key)
+            self.stats['hits_semantic'] += 1
+            return self._semantic[best_key][1]
+
+    def record_miss(self):
+        with self._lock:
+            self.stats['misses'] += 1
+
+    def _put_local(self, pregunta, fingerprint, sql, embedding):
+        key = normalizar_pregunta(pregunta)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._put(self._exact, key, (sql, expires))
+            if embedding is not None:
+                self._put(self._semantic, key, (_normalizar_vector(embedding), sql, expires))
+        return key
+
+    def put(self, pregunta, fingerprint, sql, embedding=None):
+        """Guarda el SQL generado para la pregunta (y su embedding); bloqueante si hay estado compartido"""
+        key = self._put_local(pregunta, fingerprint, sql, embedding)
+        if self.shared is not None:
+            self.shared.cache_put(key, fingerprint, sql, self.ttl)
+
+    async def put_async(self, pregunta, fingerprint, sql, embedding=None):
+        """Como put, pero la escritura en el estado compartido se hace en el pool de hilos"""
+        key = self._put_local(pregunta, fingerprint, sql, embedding)
+        if self.shared is not None:
+            await asyncio.to_thread(self.shared.cache_put, key, fingerprint, sql, self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._exact.clear()
+            self._semantic.clear()
+
+    def get_stats(self):
+        """Contadores de aciertos/fallos y tamaño actual de cada nivel"""
+        with self._lock:
+            hits = self.stats['hits_exact'] + self.stats['hits_semantic'] + self.stats['hits_shared']
+            lookups = hits + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'exact_entries': len(self._exact),
+                'semantic_entries': len(self._semantic)
+            }
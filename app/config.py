@@ -12,3 +12,115 @@ DB_NAME = os.getenv("DB_NAME")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 DB_URL = f"{DB_TYPE}+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Detección de cambios de esquema: "information_schema" (token estructural barato) o "checksum" (SHOW CREATE TABLE por tabla)
+SCHEMA_CHANGE_DETECTION = os.getenv("SCHEMA_CHANGE_DETECTION", "information_schema")
+# Cada cuántos segundos el refrescador recalcula el token de cambios
+SCHEMA_TOKEN_INTERVAL = int(os.getenv("SCHEMA_TOKEN_INTERVAL", "30"))
+# Refrescador adaptativo: intervalo mínimo tras un cambio, máximo con el esquema quieto, ventana en la
+# que se cuentan los cambios recientes y jitter (fracción) para que los workers no comprueben a la vez
+METADATA_REFRESH_MIN_INTERVAL = float(os.getenv("METADATA_REFRESH_MIN_INTERVAL", "5"))
+METADATA_REFRESH_MAX_INTERVAL = float(os.getenv("METADATA_REFRESH_MAX_INTERVAL", "300"))
+METADATA_REFRESH_WINDOW = float(os.getenv("METADATA_REFRESH_WINDOW", "3600"))
+METADATA_REFRESH_JITTER = float(os.getenv("METADATA_REFRESH_JITTER", "0.1"))
+
+# Hilos dedicados a ejecutar SQL fuera del event loop
+SQL_EXECUTOR_WORKERS = int(os.getenv("SQL_EXECUTOR_WORKERS", "8"))
+
+# Introspección de metadatos: hilos para muestras y si se piden conteos exactos (COUNT(*))
+METADATA_WORKERS = int(os.getenv("METADATA_WORKERS", "4"))
+METADATA_EXACT_COUNTS = os.getenv("METADATA_EXACT_COUNTS", "false").lower() == "true"
+# Tablas cuyo detalle (muestras, valores, conteo) se mantiene en memoria; se carga al usarlas en un prompt
+METADATA_DETAILS_MAX_TABLES = int(os.getenv("METADATA_DETAILS_MAX_TABLES", "64"))
+
+# Caché pregunta -> SQL (exacta y, opcionalmente, por similitud de embeddings)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+CACHE_SEMANTIC_ENABLED = os.getenv("CACHE_SEMANTIC_ENABLED", "false").lower() == "true"
+CACHE_SIMILARITY_THRESHOLD = float(os.getenv("CACHE_SIMILARITY_THRESHOLD", "0.95"))
+CACHE_EMBEDDING_MODEL = os.getenv("CACHE_EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Caché de resultados de SQL de solo lectura, invalidada por tabla
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Resultados más grandes que esto (serializados) no se guardan
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESULT_CACHE_MAX_ENTRY_BYTES", str(4 * 1024 * 1024)))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "300"))
+# Cómo se detecta que una tabla cambió: "update_time" (information_schema), "checksum" (CHECKSUM TABLE) o "none"
+RESULT_CACHE_VALIDATION = os.getenv("RESULT_CACHE_VALIDATION", "update_time")
+# Segundos durante los que se reutiliza la versión leída de una tabla
+RESULT_CACHE_VERSION_TTL = float(os.getenv("RESULT_CACHE_VERSION_TTL", "1"))
+
+# Plantillas de SQL aprendidas: preguntas que solo cambian un literal se responden sin llamar al modelo
+TEMPLATES_ENABLED = os.getenv("TEMPLATES_ENABLED", "true").lower() == "true"
+TEMPLATE_MAX_ENTRIES = int(os.getenv("TEMPLATE_MAX_ENTRIES", "1000"))
+TEMPLATE_TTL = int(os.getenv("TEMPLATE_TTL", "86400"))
+# Valores distintos con los que el modelo debe haber generado el mismo SQL antes de usar la plantilla
+TEMPLATE_MIN_SUPPORT = int(os.getenv("TEMPLATE_MIN_SUPPORT", "2"))
+
+# Poda del esquema en el prompt: número de tablas más relevantes (0 desactiva la poda)
+SCHEMA_TOP_K = int(os.getenv("SCHEMA_TOP_K", "8"))
+# Modelo local opcional (sentence-transformers) para complementar el índice léxico
+SCHEMA_EMBEDDING_MODEL = os.getenv("SCHEMA_EMBEDDING_MODEL", "")
+
+# Filas por bloque al transmitir resultados en NDJSON
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "1000"))
+
+# Correcciones que se piden al modelo cuando su SQL no pasa la validación local contra los metadatos (0 desactiva)
+SQL_REPAIR_ATTEMPTS = int(os.getenv("SQL_REPAIR_ATTEMPTS", "2"))
+
+# Gobernador de consultas: tope de filas, tamaño de página, tiempo máximo y presupuesto de filas del EXPLAIN
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "10000"))
+SQL_PAGE_SIZE = int(os.getenv("SQL_PAGE_SIZE", "500"))
+SQL_TIMEOUT_MS = int(os.getenv("SQL_TIMEOUT_MS", "30000"))
+SQL_MAX_EXPLAIN_ROWS = int(os.getenv("SQL_MAX_EXPLAIN_ROWS", "10000000"))
+
+# Pool de conexiones para las consultas de usuario
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Con pre-ping cada checkout hace un ida y vuelta; sin él, pool_recycle (< wait_timeout de MySQL) evita conexiones caducadas
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() == "true"
+# Pool pequeño y separado para la introspección de metadatos
+DB_METADATA_POOL_SIZE = int(os.getenv("DB_METADATA_POOL_SIZE", "4"))
+DB_METADATA_MAX_OVERFLOW = int(os.getenv("DB_METADATA_MAX_OVERFLOW", "0"))
+# Reintentos de conexión al arrancar (espera exponencial a partir de DB_CONNECT_BACKOFF segundos)
+DB_CONNECT_RETRIES = int(os.getenv("DB_CONNECT_RETRIES", "5"))
+DB_CONNECT_BACKOFF = float(os.getenv("DB_CONNECT_BACKOFF", "1.0"))
+
+# Log de acceso estructurado: fichero, fracción de peticiones con payload completo y tamaño máximo guardado
+ACCESS_LOG_PATH = os.getenv("ACCESS_LOG_PATH", "logs/access.log")
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "0.01"))
+ACCESS_LOG_MAX_PAYLOAD = int(os.getenv("ACCESS_LOG_MAX_PAYLOAD", "4096"))
+
+# Snapshot del esquema en disco (SQLite) para arrancar sin esperar a la introspección; vacío lo desactiva
+SCHEMA_SNAPSHOT_PATH = os.getenv("SCHEMA_SNAPSHOT_PATH", "data/schema_snapshot.db")
+
+# Estado compartido entre workers: vacío usa el SQLite del snapshot; redis://... usa Redis (paquete opcional)
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "")
+# Duración de la lease del refrescador elegido; los demás workers solo leen el snapshot compartido
+SHARED_LEASE_TTL = int(os.getenv("SHARED_LEASE_TTL", "60"))
+
+# Lotes de preguntas (/preguntar-lote): tamaño máximo, llamadas al modelo simultáneas y por minuto (0 = sin límite)
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "100"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_RATE_LIMIT_RPM = int(os.getenv("BATCH_RATE_LIMIT_RPM", "0"))
+
+# Pasarela al modelo: plazo por llamada y total, reintentos con espera exponencial (con jitter) y concurrencia
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "45"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF = float(os.getenv("LLM_BACKOFF", "0.5"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Límites de peticiones y tokens por minuto (0 = sin límite)
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+# Circuito: fallos seguidos que lo abren y segundos que permanece abierto
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))
+LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30"))
+# Enrutado: modelo rápido por defecto y modelo fuerte (vacío = siempre el rápido) para prompts grandes o preguntas complejas
+LLM_MODEL_FAST = os.getenv("LLM_MODEL_FAST", "gpt-3.5-turbo")
+LLM_MODEL_STRONG = os.getenv("LLM_MODEL_STRONG", "")
+LLM_ROUTING_MAX_TOKENS = int(os.getenv("LLM_ROUTING_MAX_TOKENS", "3000"))
+LLM_ROUTING_COMPLEXITY = int(os.getenv("LLM_ROUTING_COMPLEXITY", "2"))
@@ -1,12 +1,88 @@
 from sqlalchemy import create_engine, text
-from .config import DB_URL, DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from .config import (
+    DB_URL, DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+    DB_CONNECT_RETRIES, DB_CONNECT_BACKOFF
+)
 import mysql.connector
 from mysql.connector import Error
+import asyncio
+import random
+import threading
 import time
 import logging
 
 logger = logging.getLogger(__name__)
 
+class PoolMetrics:
+    """Espera en el checkout y saturación de un pool de conexiones"""
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.pool = None
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def registrar(self, espera, timeout=False):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += espera
+            self.max_wait = max(self.max_wait, espera)
+            if timeout:
+                self.timeouts += 1
+
+    def snapshot(self):
+        pool = self.pool
+        capacidad = pool.size() + max(pool._max_overflow, 0) if pool is not None else 0
+        en_uso = pool.checkedout() if pool is not None else 0
+        with self._lock:
+            return {
+                'pool': self.nombre,
+                'size': pool.size() if pool is not None else 0,
+                'checked_out': en_uso,
+                'overflow': max(pool.overflow(), 0) if pool is not None else 0,
+                'saturation': en_uso / capacidad if capacidad else 0.0,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'avg_wait': self.total_wait / self.checkouts if self.checkouts else 0.0,
+                'max_wait': self.max_wait
+            }
+
+# Métricas de todos los pools creados, por nombre
+pool_metrics = {}
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool que mide cuánto se espera para obtener una conexión"""
+    metricas = None
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            conexion = super()._do_get()
+        except PoolTimeoutError:
+            if self.metricas is not None:
+                self.metricas.registrar(time.perf_counter() - inicio, timeout=True)
+            raise
+        if self.metricas is not None:
+            self.metricas.registrar(time.perf_counter() - inicio)
+        return conexion
+
+    def recreate(self):
+        nuevo = super().recreate()
+        nuevo.metricas = self.metricas
+        if self.metricas is not None:
+            self.metricas.pool = nuevo
+        return nuevo
+
+
+def obtener_metricas_pool():
+    return [metricas.snapshot() for metricas in pool_metrics.values()]
+
 def lanzar_mysqlconnector():
     try:
         connection = mysql.connector.connect(
@@ -25,13 +101,44 @@ def lanzar_mysqlconnector():
             connection.close()
             logger.info("Conexión mysql.connector cerrada.")
 
-def intentar_sqlalchemy():
+def crear_engine(nombre="consultas", pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                 pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING):
+    """Crea un engine con el pool configurado y registra sus métricas"""
+    engine = create_engine(
+        DB_URL,
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping
+    )
+    metricas = pool_metrics.setdefault(nombre, PoolMetrics(nombre))
+    metricas.pool = engine.pool
+    engine.pool.metricas = metricas
+    return engine
+
+def intentar_sqlalchemy(nombre="consultas", **pool_kwargs):
     try:
-        engine = create_engine(DB_URL, pool_pre_ping=True)
+        engine = crear_engine(nombre, **pool_kwargs)
         with engine.connect() as conn:
             conn.execute(text("SELECT 1"))
-        logger.info("Conexión SQLAlchemy exitosa.")
+        logger.info(f"Conexión SQLAlchemy exitosa ({nombre}).")
         return engine
     except Exception as e:
         logger.error(f"Error en SQLAlchemy: {e}")
         return None
+
+async def conectar_con_reintentos(nombre="consultas", intentos=DB_CONNECT_RETRIES, backoff=DB_CONNECT_BACKOFF,
+                                  **pool_kwargs):
+    """Intenta conectar con espera exponencial (con jitter) sin bloquear el event loop"""
+    for intento in range(intentos):
+        engine = await asyncio.to_thread(intentar_sqlalchemy, nombre, **pool_kwargs)
+        if engine:
+            return engine
+        if intento == 0:
+            await asyncio.to_thread(lanzar_mysqlconnector)
+        espera = backoff * 2 ** intento * random.uniform(0.5, 1.5)
+        logger.warning(f"Reintentando conexión ({nombre}) en {espera:.1f}s ({intento + 1}/{intentos})")
+        await asyncio.sleep(espera)
+    raise RuntimeError(f"No se pudo conectar a la base de datos tras {intentos} intentos")
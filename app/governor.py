@@ -0,0 +1,151 @@
+import base64
+import json
+import logging
+from collections import namedtuple
+from contextlib import contextmanager
+import sqlglot
+from sqlglot import exp
+from sqlalchemy import text
+from .config import SQL_MAX_ROWS, SQL_PAGE_SIZE, SQL_TIMEOUT_MS, SQL_MAX_EXPLAIN_ROWS
+
+logger = logging.getLogger(__name__)
+
+# sql_original: la sentencia tal cual; sql: la que se ejecuta (con LIMIT/OFFSET y hint);
+# limite: filas de esta página; tope: filas máximas en total para la consulta
+Pagina = namedtuple("Pagina", ["sql_original", "sql", "offset", "limite", "tope"])
+
+
+class ConsultaRechazada(Exception):
+    """La consulta no supera las comprobaciones del gobernador"""
+
+
+def _entero(nodo):
+    """Valor entero de un LIMIT/OFFSET literal, o None si no lo es"""
+    if nodo is None:
+        return None
+    valor = nodo.args.get("expression") or nodo.this if isinstance(nodo, (exp.Limit, exp.Offset)) else nodo
+    if isinstance(valor, exp.Literal) and valor.is_int:
+        return int(valor.this)
+    return None
+
+def codificar_token(sql, offset):
+    """Token opaco para pedir la siguiente página de una consulta"""
+    datos = json.dumps({"sql": sql, "offset": offset}).encode("utf-8")
+    return base64.urlsafe_b64encode(datos).decode("ascii")
+
+def decodificar_token(token):
+    datos = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    return datos["sql"], int(datos["offset"])
+
+
+class QueryGovernor:
+    """
+    Envuelve la ejecución del SQL generado:
+
+    - inyecta o recorta el LIMIT (nunca más de max_rows filas en total) y pagina por OFFSET,
+    - aplica el hint MAX_EXECUTION_TIME y el tiempo máximo de la sesión en MySQL,
+    - rechaza planes cuyo EXPLAIN estime más filas de las permitidas.
+    """
+    def __init__(self, max_rows=SQL_MAX_ROWS, page_size=SQL_PAGE_SIZE, timeout_ms=SQL_TIMEOUT_MS,
+                 max_explain_rows=SQL_MAX_EXPLAIN_ROWS):
+        self.max_rows = max_rows
+        self.page_size = page_size
+        self.timeout_ms = timeout_ms
+        self.max_explain_rows = max_explain_rows
+
+    def preparar(self, sql, offset=0):
+        """Devuelve la Pagina a ejecutar para la sentencia y el desplazamiento dados"""
+        try:
+            sentencias = sqlglot.parse(sql, read="mysql")
+        except sqlglot.errors.ParseError as e:
+            # Sin árbol no se puede reescribir: el tope se aplica al leer las filas
+            logger.warning(f"No se pudo analizar el SQL para limitarlo: {e}")
+            return Pagina(sql, sql, 0, self.max_rows, self.max_rows)
+
+        sentencias = [s for s in sentencias if s is not None]
+        if len(sentencias) != 1:
+            raise ConsultaRechazada("Solo se permite una sentencia SQL por consulta.")
+        arbol = sentencias[0]
+        if not isinstance(arbol, exp.Query):
+            # SHOW, DESCRIBE...: no se reescriben ni se paginan
+            return Pagina(sql, sql, 0, self.max_rows, self.max_rows)
+
+        limite_original = _entero(arbol.args.get("limit"))
+        offset_original = _entero(arbol.args.get("offset")) or 0
+        tope = min(limite_original, self.max_rows) if limite_original is not None else self.max_rows
+        limite = max(0, min(self.page_size, tope - offset))
+
+        # Se pide una fila de más para saber si hay página siguiente
+        arbol = arbol.copy().limit(limite + 1).offset(offset_original + offset)
+        return Pagina(sql, self._con_hint(arbol.sql(dialect="mysql")), offset, limite, tope)
+
+    def preparar_stream(self, sql):
+        """
+        (SQL a ejecutar, tope de filas) para transmitir el resultado entero con un cursor:
+        sin paginar, pero con el LIMIT recortado a max_rows y el hint de tiempo máximo.
+        """
+        try:
+            sentencias = [s for s in sqlglot.parse(sql, read="mysql") if s is not None]
+        except sqlglot.errors.ParseError as e:
+            logger.warning(f"No se pudo analizar el SQL para limitarlo: {e}")
+            return sql, self.max_rows
+        if len(sentencias) != 1:
+            raise ConsultaRechazada("Solo se permite una sentencia SQL por consulta.")
+        arbol = sentencias[0]
+        if not isinstance(arbol, exp.Query):
+            return sql, self.max_rows
+
+        limite_original = _entero(arbol.args.get("limit"))
+        tope = min(limite_original, self.max_rows) if limite_original is not None else self.max_rows
+        return self._con_hint(arbol.copy().limit(tope).sql(dialect="mysql")), tope
+
+    def _con_hint(self, sql):
+        # El hint solo vale en el SELECT de primer nivel; en el resto basta el límite de la sesión
+        if self.timeout_ms and sql.startswith("SELECT "):
+            return f"SELECT /*+ MAX_EXECUTION_TIME({self.timeout_ms}) */ " + sql[len("SELECT "):]
+        return sql
+
+    def comprobar_plan(self, conn, sql):
+        """Rechaza la consulta si el EXPLAIN estima más filas que el presupuesto"""
+        if conn.dialect.name != "mysql" or not self.max_explain_rows:
+            return
+        if not sql.strip().upper().startswith(("SELECT", "WITH")):
+            return
+        try:
+            plan = conn.execute(text(f"EXPLAIN {sql}")).mappings().fetchall()
+        except Exception as e:
+            logger.warning(f"No se pudo obtener el plan de la consulta: {e}")
+            return
+
+        # Filas estimadas: producto de las filas de cada tabla del mismo SELECT (bucles anidados)
+        por_select = {}
+        for fila in plan:
+            filas = (fila.get("rows") or 1) * (fila.get("filtered") or 100) / 100
+            por_select[fila.get("id")] = por_select.get(fila.get("id"), 1) * max(filas, 1)
+        estimacion = sum(por_select.values())
+        if estimacion > self.max_explain_rows:
+            raise ConsultaRechazada(
+                f"La consulta examinaría ~{int(estimacion)} filas (máximo {self.max_explain_rows})."
+            )
+
+    @contextmanager
+    def tiempo_limite(self, conn):
+        """Aplica max_execution_time a la sesión durante la consulta (solo MySQL)"""
+        if conn.dialect.name != "mysql" or not self.timeout_ms:
+            yield
+            return
+        conn.execute(text("SET SESSION max_execution_time = :ms"), {"ms": self.timeout_ms})
+        try:
+            yield
+        finally:
+            conn.execute(text("SET SESSION max_execution_time = DEFAULT"))
+
+    def leer_pagina(self, resultado, pagina):
+        """Lee como mucho una página y devuelve (filas, token de la siguiente o None)"""
+        filas = resultado.fetchmany(pagina.limite + 1)
+        if len(filas) <= pagina.limite:
+            return filas, None
+        siguiente = pagina.offset + pagina.limite
+        if siguiente >= pagina.tope:
+            return filas[:pagina.limite], None
+        return filas[:pagina.limite], codificar_token(pagina.sql_original, siguiente)
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Cubo de fichas asíncrono: se reponen `rate` fichas por segundo hasta `capacity`"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._ultima = time.monotonic()
+
+    def _reponer(self):
+        ahora = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (ahora - self._ultima) * self.rate)
+        self._ultima = ahora
+
+    async def adquirir(self, n=1):
+        """Espera hasta que haya `n` fichas y las consume (n mayor que la capacidad espera a llenar el cubo)"""
+        n = min(n, self.capacity)
+        while True:
+            self._reponer()
+            if self.tokens >= n:
+                self.tokens -= n
+                return
+            await asyncio.sleep((n - self.tokens) / self.rate)
+
+
+class Limitador:
+    """
+    Limita una operación asíncrona a `max_concurrencia` ejecuciones simultáneas y, si
+    se indica, a `por_minuto` inicios por minuto. Se usa como `async with limitador:`.
+    """
+    def __init__(self, max_concurrencia, por_minuto=0):
+        self.max_concurrencia = max_concurrencia
+        self._semaforo = asyncio.Semaphore(max_concurrencia)
+        # Se permite una ráfaga inicial de tantas llamadas como la concurrencia máxima
+        self._cubo = TokenBucket(por_minuto / 60, max(1, max_concurrencia)) if por_minuto else None
+        self.en_curso = 0
+        self.esperando = 0
+
+    async def __aenter__(self):
+        self.esperando += 1
+        try:
+            await self._semaforo.acquire()
+            try:
+                if self._cubo is not None:
+                    await self._cubo.adquirir()
+            except BaseException:
+                self._semaforo.release()
+                raise
+        finally:
+            self.esperando -= 1
+        self.en_curso += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self.en_curso -= 1
+        self._semaforo.release()
+
+    def get_stats(self):
+        return {'max_concurrencia': self.max_concurrencia, 'en_curso': self.en_curso, 'esperando': self.esperando}
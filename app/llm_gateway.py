@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from contextlib import aclosing
+import openai
+from .limiter import Limitador, TokenBucket
+from .schema_retrieval import contar_tokens
+from .telemetry import LLM_REQUESTS, LLM_RETRIES
+from .config import (
+    LLM_TIMEOUT, LLM_DEADLINE, LLM_MAX_RETRIES, LLM_BACKOFF, LLM_MAX_CONCURRENCY, LLM_RPM, LLM_TPM,
+    LLM_CIRCUIT_FAILURES, LLM_CIRCUIT_COOLDOWN, LLM_MODEL_FAST, LLM_MODEL_STRONG,
+    LLM_ROUTING_MAX_TOKENS, LLM_ROUTING_COMPLEXITY
+)
+
+logger = logging.getLogger(__name__)
+
+# Errores transitorios: se reintentan y cuentan para el circuito (un 400 o un 401 no)
+ERRORES_REINTENTABLES = (
+    openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError,
+    asyncio.TimeoutError
+)
+
+# Tokens que se reservan para la respuesta al estimar el consumo de una llamada
+TOKENS_RESPUESTA = 256
+
+# Construcciones que suelen requerir agregaciones, subconsultas o ventanas
+_PATRONES_COMPLEJOS = re.compile(
+    r"\b(por cada|promedio|media|compar\w*|versus|vs|ranking|top \d+|percentil\w*|acumulad\w*|tendencia|"
+    r"mes a mes|año a año|crecimiento|porcentaje|proporci[oó]n|ratio|agrupad\w*|que no|nunca|al menos|"
+    r"más de|menos de|entre|respecto)\b",
+    re.IGNORECASE
+)
+
+
+class LLMNoDisponible(Exception):
+    """El modelo no ha respondido: circuito abierto, plazo agotado o reintentos agotados"""
+
+
+def complejidad(pregunta):
+    """Puntuación heurística de lo compleja que es una pregunta (construcciones distintas + longitud)"""
+    construcciones = {m.lower() for m in _PATRONES_COMPLEJOS.findall(pregunta)}
+    return len(construcciones) + (len(pregunta.split()) > 30)
+
+
+class CircuitBreaker:
+    """
+    Tras `umbral` fallos seguidos deja de llamar al modelo durante `enfriamiento`
+    segundos; después deja pasar una única llamada de prueba y se cierra si tiene éxito.
+    """
+    def __init__(self, umbral=LLM_CIRCUIT_FAILURES, enfriamiento=LLM_CIRCUIT_COOLDOWN):
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento
+        self.fallos = 0
+        self.abierto_desde = None
+        # Inicio de la llamada de prueba en curso (si se cancela, caduca tras otro enfriamiento)
+        self._prueba_desde = None
+
+    @property
+    def estado(self):
+        if self.abierto_desde is None:
+            return "cerrado"
+        if time.monotonic() - self.abierto_desde < self.enfriamiento:
+            return "abierto"
+        return "semiabierto"
+
+    def permitir(self):
+        estado = self.estado
+        if estado == "cerrado":
+            return True
+        ahora = time.monotonic()
+        if estado == "semiabierto" and (self._prueba_desde is None or ahora - self._prueba_desde > self.enfriamiento):
+            self._prueba_desde = ahora
+            return True
+        return False
+
+    def exito(self):
+        if self.abierto_desde is not None:
+            logger.info("Circuito del modelo cerrado de nuevo")
+        self.fallos = 0
+        self.abierto_desde = None
+        self._prueba_desde = None
+
+    def fallo(self):
+        self.fallos += 1
+        if self._prueba_desde is not None or (self.abierto_desde is None and self.fallos >= self.umbral):
+            logger.warning(f"Circuito del modelo abierto tras {self.fallos} fallos seguidos")
+            self.abierto_desde = time.monotonic()
+        self._prueba_desde = None
+
+
+class LLMGateway:
+    """
+    Punto único de acceso al modelo de chat: plazo por llamada y total, reintentos
+    acotados con espera exponencial y jitter, límite de concurrencia, peticiones y
+    tokens por minuto, circuito ante fallos seguidos y elección entre un modelo rápido
+    y uno más potente según el tamaño del prompt y la complejidad de la pregunta.
+    """
+    def __init__(self, client, modelo_rapido=LLM_MODEL_FAST, modelo_fuerte=LLM_MODEL_STRONG, timeout=LLM_TIMEOUT,
+                 plazo=LLM_DEADLINE, reintentos=LLM_MAX_RETRIES, backoff=LLM_BACKOFF,
+                 max_concurrencia=LLM_MAX_CONCURRENCY, por_minuto=LLM_RPM, tokens_por_minuto=LLM_TPM,
+                 circuito=None, max_tokens_rapido=LLM_ROUTING_MAX_TOKENS, complejidad_fuerte=LLM_ROUTING_COMPLEXITY):
+        # Los reintentos los gestiona la pasarela, no el SDK
+        self.client = client.with_options(max_retries=0) if hasattr(client, "with_options") else client
+        self.modelo_rapido = modelo_rapido
+        self.modelo_fuerte = modelo_fuerte or modelo_rapido
+        self.timeout = timeout
+        self.plazo = plazo
+        self.reintentos = reintentos
+        self.backoff = backoff
+        self.limitador = Limitador(max_concurrencia, por_minuto)
+        self._tokens = TokenBucket(tokens_por_minuto / 60, tokens_por_minuto) if tokens_por_minuto else None
+        self.circuito = circuito or CircuitBreaker()
+        self.max_tokens_rapido = max_tokens_rapido
+        self.complejidad_fuerte = complejidad_fuerte
+        self.stats = {'llamadas': 0, 'reintentos': 0, 'fallidas': 0, 'rechazadas': 0, 'por_modelo': {}}
+
+    def elegir_modelo(self, mensajes, tokens):
+        """Modelo fuerte si el prompt es grande o la pregunta es compleja; el rápido en otro caso"""
+        if self.modelo_fuerte == self.modelo_rapido:
+            return self.modelo_rapido
+        if tokens > self.max_tokens_rapido or complejidad(mensajes[-1]["content"]) >= self.complejidad_fuerte:
+            return self.modelo_fuerte
+        return self.modelo_rapido
+
+    def _espera(self, intento, error):
+        """Espera exponencial con jitter completo, respetando Retry-After si el servidor lo envía"""
+        espera = random.uniform(0, self.backoff * 2 ** intento)
+        respuesta = getattr(error, "response", None)
+        retry_after = respuesta.headers.get("retry-after") if respuesta is not None else None
+        try:
+            return max(espera, float(retry_after)) if retry_after else espera
+        except ValueError:
+            return espera
+
+    async def completar(self, mensajes, modelo=None, plazo=None, tokens=None):
+        """
+        Pide una respuesta al modelo; lanza LLMNoDisponible si no se consigue a tiempo.
+        `tokens` es el tamaño del prompt si ya se conoce (si no, se cuenta aquí).
+        """
+        async with aclosing(self._llamar(mensajes, modelo, plazo, tokens, stream=False)) as llamada:
+            async for respuesta in llamada:
+                return respuesta
+
+    def completar_stream(self, mensajes, modelo=None, plazo=None, tokens=None):
+        """
+        Como completar pero va devolviendo el texto por fragmentos según llega. Solo se
+        reintenta hasta recibir el primero; un corte posterior lanza LLMNoDisponible.
+        """
+        return self._llamar(mensajes, modelo, plazo, tokens, stream=True)
+
+    async def _llamar(self, mensajes, modelo, plazo, tokens, stream):
+        if tokens is None:
+            tokens = sum(contar_tokens(m["content"]) for m in mensajes)
+        modelo = modelo or self.elegir_modelo(mensajes, tokens)
+        limite = time.monotonic() + (plazo or self.plazo)
+        self.stats['llamadas'] += 1
+        self.stats['por_modelo'][modelo] = self.stats['por_modelo'].get(modelo, 0) + 1
+
+        for intento in range(self.reintentos + 1):
+            if not self.circuito.permitir():
+                self.stats['rechazadas'] += 1
+                LLM_REQUESTS.labels(modelo, "rechazada").inc()
+                raise LLMNoDisponible("El modelo no está disponible temporalmente (circuito abierto).")
+
+            emitido = False
+            try:
+                async with self.limitador:
+                    if self._tokens is not None:
+                        await self._tokens.adquirir(tokens + TOKENS_RESPUESTA)
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        # El plazo se ha ido esperando turno: no es un fallo del modelo
+                        raise LLMNoDisponible("Demasiadas peticiones al modelo en curso. Inténtalo de nuevo más tarde.")
+                    opciones = {"stream": True} if stream else {}
+                    respuesta = await asyncio.wait_for(
+                        self.client.chat.completions.create(model=modelo, messages=mensajes, **opciones),
+                        timeout=min(self.timeout, restante)
+                    )
+                    if stream:
+                        # El plazo por llamada se aplica a cada fragmento: detecta respuestas atascadas
+                        fragmentos = respuesta.__aiter__()
+                        while True:
+                            restante = max(limite - time.monotonic(), 0)
+                            try:
+                                fragmento = await asyncio.wait_for(
+                                    fragmentos.__anext__(), timeout=min(self.timeout, restante)
+                                )
+                            except StopAsyncIteration:
+                                break
+                            texto = fragmento.choices[0].delta.content if fragmento.choices else None
+                            if texto:
+                                emitido = True
+                                yield texto
+            except ERRORES_REINTENTABLES as e:
+                self.circuito.fallo()
+                motivo = type(e).__name__
+                espera = self._espera(intento, e)
+                if emitido or intento == self.reintentos or time.monotonic() + espera >= limite:
+                    self.stats['fallidas'] += 1
+                    LLM_REQUESTS.labels(modelo, "fallida").inc()
+                    logger.error(f"El modelo {modelo} no respondió tras {intento + 1} intentos ({motivo})")
+                    raise LLMNoDisponible("El modelo no ha respondido a tiempo. Inténtalo de nuevo más tarde.") from e
+                self.stats['reintentos'] += 1
+                LLM_RETRIES.labels(motivo).inc()
+                logger.warning(f"Reintentando llamada a {modelo} en {espera:.2f}s (intento {intento + 1}, {motivo})")
+                await asyncio.sleep(espera)
+                continue
+            except LLMNoDisponible:
+                self.stats['fallidas'] += 1
+                LLM_REQUESTS.labels(modelo, "fallida").inc()
+                raise
+            except Exception:
+                # Errores no transitorios (petición inválida, autenticación...): no tiene sentido reintentar
+                self.circuito.exito()
+                self.stats['fallidas'] += 1
+                LLM_REQUESTS.labels(modelo, "fallida").inc()
+                raise
+
+            # Fuera del limitador: la respuesta completa no retiene la plaza mientras la procesa quien llama
+            self.circuito.exito()
+            LLM_REQUESTS.labels(modelo, "ok").inc()
+            if not stream:
+                yield respuesta
+            return
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            'circuito': self.circuito.estado,
+            'fallos_seguidos': self.circuito.fallos,
+            'limitador': self.limitador.get_stats()
+        }
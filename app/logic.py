@@ -1,5 +1,24 @@
 from sqlalchemy import text
+import asyncio
+import difflib
 import logging
+import re
+from collections import namedtuple
+from contextlib import aclosing, nullcontext
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import OptimizeError
+from sqlglot.optimizer.qualify import qualify
+from .schema_retrieval import contar_tokens
+from .cache import normalizar_pregunta
+from .serialization import a_columnar, FORMATO_COLUMNAR
+from .governor import ConsultaRechazada
+from .llm_gateway import LLMGateway, LLMNoDisponible
+from .config import SQL_REPAIR_ATTEMPTS
+from .telemetry import (
+    etapa, registrar_uso_llm, registrar_error_sql, CACHE_LOOKUPS, ROWS_RETURNED, SQL_VALIDATION,
+    ETAPA_PLANTILLA, ETAPA_PROMPT, ETAPA_LLM, ETAPA_VALIDACION, ETAPA_SQL
+)
 
 logger = logging.getLogger(__name__)
 
@@ -7,49 +26,295 @@ def es_sql_valido(sql):
     palabras_clave = ["SELECT", "SHOW", "DESCRIBE", "WITH"]
     return any(sql.strip().upper().startswith(p) for p in palabras_clave)
 
-def ejecutar_pregunta(client, engine, pregunta, db_metadata):
-    # Obtener descripción del esquema
-    schema_description = db_metadata.get_schema_description()
+PROMPT_SISTEMA = "Eres un experto en SQL. Tu única tarea es convertir preguntas en lenguaje natural en sentencias SQL válidas de MySQL. No debes explicar, solo generar SQL directamente. Aquí está la descripción del esquema de la base de datos:\n"
 
-    prompt = [
-        {"role": "system", "content": f"Eres un experto en SQL. Tu única tarea es convertir preguntas en lenguaje natural en sentencias SQL válidas de MySQL. No debes explicar, solo generar SQL directamente. Aquí está la descripción del esquema de la base de datos:\n{schema_description}"},
+def construir_prompt(mensaje_sistema, pregunta):
+    """Construye los mensajes que se envían al modelo"""
+    return [
+        {"role": "system", "content": mensaje_sistema},
         {"role": "user", "content": pregunta}
     ]
-    respuesta = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=prompt
-    )
-    sql = respuesta.choices[0].message.content.strip()
+
+def describir_esquema(db_metadata, pregunta, retriever=None):
+    """
+    Mensaje de sistema con el esquema, podado a las tablas relevantes si hay retriever.
+    Devuelve (mensaje, tablas, tokens del mensaje), con un solo renderizado de la descripción.
+    """
+    tablas = None
+    if retriever is not None:
+        tablas = retriever.select_tables(
+            pregunta, db_metadata.schema_info, db_metadata.get_fingerprint_token(), db_metadata.get_known_values()
+        )
+    return _mensaje_sistema(db_metadata, tablas)
+
+def _mensaje_sistema(db_metadata, tablas):
+    mensaje, tokens = db_metadata.get_system_prompt(PROMPT_SISTEMA, tables=tablas)
+    return mensaje, tablas, tokens
+
+def describir_esquema_lote(db_metadata, preguntas, retriever=None):
+    """Un solo mensaje de sistema para todo un lote: la unión de las tablas relevantes de cada pregunta"""
+    tablas = None
+    if retriever is not None:
+        fingerprint = db_metadata.get_fingerprint_token()
+        valores = db_metadata.get_known_values()
+        tablas = set()
+        for pregunta in preguntas:
+            seleccion = retriever.select_tables(pregunta, db_metadata.schema_info, fingerprint, valores)
+            if seleccion is None:
+                tablas = None
+                break
+            tablas.update(seleccion)
+    if tablas is not None:
+        tablas = sorted(tablas)
+    return _mensaje_sistema(db_metadata, tablas)
+
+async def describir_esquema_async(db_metadata, pregunta, retriever=None):
+    """describir_esquema desde código async: con embeddings la selección de tablas va al pool de hilos"""
+    if retriever is not None and retriever.bloqueante:
+        return await asyncio.to_thread(describir_esquema, db_metadata, pregunta, retriever)
+    return describir_esquema(db_metadata, pregunta, retriever)
+
+async def describir_esquema_lote_async(db_metadata, preguntas, retriever=None):
+    """describir_esquema_lote desde código async, con el mismo criterio que describir_esquema_async"""
+    if retriever is not None and retriever.bloqueante:
+        return await asyncio.to_thread(describir_esquema_lote, db_metadata, preguntas, retriever)
+    return describir_esquema_lote(db_metadata, preguntas, retriever)
+
+def registrar_prompt(prompt, tablas, tokens_sistema, db_metadata):
+    """
+    Registra el tamaño en tokens del prompt y cuántas tablas incluye; devuelve los tokens.
+    Los del mensaje de sistema ya vienen contados: solo se tokeniza la pregunta.
+    """
+    total = len(db_metadata.schema_info.get('tables', {}))
+    incluidas = total if tablas is None else len(tablas)
+    tokens = tokens_sistema + contar_tokens(prompt[-1]["content"])
+    logger.info(f"Prompt: {tokens} tokens ({incluidas}/{total} tablas)")
+    return tokens
+
+def limpiar_sql(contenido):
+    """Extrae la sentencia SQL de la respuesta del modelo"""
+    sql = contenido.strip()
 
     # Limpiar si viene con triple backticks ```sql
     if sql.startswith("```"):
         sql = sql.strip("```").replace("sql", "").strip()
-    
-    logger.info(f"SQL generado: {sql}")
+    return sql
+
+def tablas_de_ddl(sql):
+    """Tablas afectadas por una sentencia DDL (o DML), o lista vacía si no se pueden determinar"""
+    try:
+        sentencias = sqlglot.parse(sql, read="mysql")
+    except sqlglot.errors.ParseError:
+        return []
+    tablas = set()
+    for sentencia in sentencias:
+        if sentencia is None or isinstance(sentencia, exp.Command):
+            return []
+        tablas.update(tabla.name for tabla in sentencia.find_all(exp.Table) if tabla.name)
+    return sorted(tablas)
+
+# Sentencias que puede ejecutar el SQL generado por el modelo: lecturas y SHOW/DESCRIBE
+_SENTENCIAS_LECTURA = (exp.Query, exp.Show, exp.Describe)
 
-    # Validar si el SQL es válido
-    if not es_sql_valido(sql):
-        logger.error("El modelo no devolvió una consulta SQL válida.")
-        return {"error": "El modelo no devolvió una consulta SQL válida."}
+# Motivo del rechazo del validador; `reparable` si tiene sentido pedir al modelo que lo corrija
+# (SQL mal formado, tablas o columnas que no existen), no si pide escribir o varias sentencias
+Rechazo = namedtuple("Rechazo", ["motivo", "reparable"])
 
+def comprobar_sql(sql, db_metadata):
+    """validar_sql contra el esquema cargado, con el veredicto memorizado en el gestor de metadatos"""
+    return db_metadata.validation_verdict(sql, validar_sql)
+
+def validar_sql(sql, schema_info):
+    """
+    Valida el SQL generado contra los metadatos en memoria antes de enviarlo a la base de
+    datos: una única sentencia de lectura cuyas tablas y columnas existen. Devuelve None si
+    es válido o un Rechazo con el motivo concreto, pensado para devolvérselo al modelo.
+    """
+    try:
+        sentencias = [s for s in sqlglot.parse(sql, read="mysql") if s is not None]
+    except sqlglot.errors.ParseError as e:
+        detalle = e.errors[0]["description"] if e.errors else str(e)
+        return Rechazo(f"El SQL no se puede analizar: {detalle}.", True)
+    if not sentencias:
+        return Rechazo("No hay ninguna sentencia SQL.", True)
+    if len(sentencias) > 1:
+        return Rechazo("Solo se permite una sentencia SQL.", False)
+    arbol = sentencias[0]
+    if not isinstance(arbol, _SENTENCIAS_LECTURA):
+        return Rechazo(f"Solo se permiten consultas de lectura (SELECT, SHOW, DESCRIBE), no {arbol.key.upper()}.", False)
+
+    tablas = schema_info.get('tables', {})
+    if isinstance(arbol, exp.Show) or not tablas:
+        return None
+    current_db = schema_info.get('current_db')
+    ctes = {cte.alias_or_name for cte in arbol.find_all(exp.CTE)}
+    usadas, otra_base = {}, False
+    for tabla in arbol.find_all(exp.Table):
+        if tabla.db and tabla.db != current_db:
+            otra_base = True  # Sin metadatos de otras bases de datos (p. ej. information_schema)
+            continue
+        nombre = tabla.name
+        if not nombre or nombre in ctes or nombre.lower() == "dual":
+            continue
+        if nombre not in tablas:
+            parecidas = difflib.get_close_matches(nombre.lower(), [t.lower() for t in tablas], n=3)
+            sugerencia = [t for t in tablas if t.lower() in parecidas]
+            motivo = f"La tabla {nombre} no existe" + (f"; ¿quizás {', '.join(sugerencia)}?" if sugerencia else ".")
+            return Rechazo(motivo, True)
+        usadas[nombre] = tablas[nombre]
+    if isinstance(arbol, exp.Describe) or otra_base or not usadas:
+        return None
+
+    # Los nombres de columna no distinguen mayúsculas en MySQL: se resuelven en minúsculas
+    # (el árbol es solo para validar: se modifica en sitio)
+    esquema = {nombre.lower(): {c.name.lower(): "UNKNOWN" for c in info.columns} for nombre, info in usadas.items()}
+    for identificador in arbol.find_all(exp.Identifier):
+        identificador.set("this", identificador.this.lower())
+    try:
+        qualify(arbol, schema=esquema, dialect="mysql", validate_qualify_columns=True)
+    except OptimizeError as e:
+        return Rechazo(_columna_no_resuelta(str(e), usadas), True)
+    except Exception as e:
+        # Construcciones que sqlglot no sabe resolver: la base de datos tiene la última palabra
+        logger.debug(f"No se pudieron resolver las columnas de {sql}: {e}")
+    return None
+
+def _columna_no_resuelta(mensaje, usadas):
+    """Motivo legible de una columna que sqlglot no ha podido resolver contra las tablas usadas"""
+    encontrada = re.search(r"Column '(.+?)' could not be resolved|Unknown column: (\S+)", mensaje)
+    if encontrada is None:
+        return f"El SQL no encaja con el esquema: {mensaje}"
+    columna = (encontrada.group(1) or encontrada.group(2)).split(".")[-1].strip('"`')
+    con_columna = sorted(t for t, info in usadas.items() if any(c.name.lower() == columna for c in info.columns))
+    if len(con_columna) > 1:
+        return f"La columna {columna} es ambigua: existe en {', '.join(con_columna)}; califícala con la tabla."
+    if con_columna:
+        return f"La columna {columna} existe en {con_columna[0]} pero no se puede resolver en esa parte de la consulta."
+    columnas = sorted({c.name for info in usadas.values() for c in info.columns})
+    parecidas = difflib.get_close_matches(columna, columnas, n=3)
+    return (f"La columna {columna} no existe en {', '.join(sorted(usadas))}"
+            + (f"; ¿quizás {', '.join(parecidas)}?" if parecidas else "."))
+
+def prompt_reparacion(prompt, sql, error):
+    """Mensajes para pedir al modelo que corrija un SQL rechazado por el validador"""
+    return [
+        *prompt,
+        {"role": "assistant", "content": sql},
+        {"role": "user", "content": f"Ese SQL no es válido: {error} Corrígelo y devuelve solo la sentencia SQL."}
+    ]
+
+async def validar_generado(client, prompt, sql, db_metadata, reparar=True, limitador=None):
+    """
+    Valida el SQL y, si el rechazo es reparable y `reparar`, devuelve el motivo al modelo hasta
+    SQL_REPAIR_ATTEMPTS veces. Devuelve (sql, motivo) con motivo None si el último SQL es válido.
+    """
+    with etapa(ETAPA_VALIDACION):
+        rechazo = comprobar_sql(sql, db_metadata)
+    intentos = 0
+    while rechazo is not None and rechazo.reparable and reparar and intentos < SQL_REPAIR_ATTEMPTS:
+        intentos += 1
+        logger.warning(
+            f"SQL rechazado por el validador ({rechazo.motivo}); pidiendo corrección {intentos}/{SQL_REPAIR_ATTEMPTS}"
+        )
+        prompt = prompt_reparacion(prompt, sql, rechazo.motivo)
+        async with limitador or nullcontext():
+            with etapa(ETAPA_LLM):
+                respuesta = await llamar_modelo(client, prompt)
+        registrar_uso_llm(respuesta)
+        sql = limpiar_sql(respuesta.choices[0].message.content)
+        with etapa(ETAPA_VALIDACION):
+            rechazo = comprobar_sql(sql, db_metadata)
+    SQL_VALIDATION.labels("rejected" if rechazo is not None else "repaired" if intentos else "valid").inc()
+    return sql, rechazo.motivo if rechazo is not None else None
+
+def ejecutar_sql(engine, sql, db_metadata, formato=None, governor=None, offset=0, cache_resultados=None,
+                 reutilizar=True):
+    """
+    Ejecuta el SQL generado y devuelve la respuesta de la API (bloqueante).
+
+    Con un QueryGovernor la consulta se limita, se pagina a partir de offset y lleva
+    tiempo máximo; la respuesta incluye "siguiente_pagina" si quedan filas. Con una
+    ResultCache las lecturas se sirven de ella mientras sus tablas no cambien, y la
+    respuesta lleva "cache_resultado" (HIT, MISS o BYPASS si no es cacheable). Con
+    reutilizar=False (la petición desactiva la caché) no se busca ni se guarda, pero las
+    escrituras siguen invalidando los resultados de sus tablas.
+    """
+    consulta = None
+    if cache_resultados is not None and reutilizar:
+        cacheada, consulta = cache_resultados.buscar(
+            engine, sql, formato, offset, db_metadata.get_fingerprint_token()
+        )
+        if cacheada is not None:
+            cacheada["cache_resultado"] = "HIT"
+            return cacheada
+
+    respuesta = _ejecutar_sql(engine, sql, db_metadata, formato, governor, offset, cache_resultados)
+    if cache_resultados is not None:
+        cache_resultados.guardar(consulta, respuesta)
+        respuesta = {**respuesta, "cache_resultado": "MISS" if consulta is not None else "BYPASS"}
+    return respuesta
+
+def tras_escritura(sql, db_metadata, cache_resultados=None):
+    """
+    Lo que sigue a una sentencia sin filas ejecutada por el servicio (por cualquier camino):
+    invalida los resultados de sus tablas y, si es un DDL, refresca sus metadatos y avisa al
+    refrescador.
+    """
+    if cache_resultados is not None:
+        cache_resultados.invalidar(tablas_de_ddl(sql))
+
+    # Detectar si es una operación DDL
+    if db_metadata is not None and sql.strip().upper().startswith(("CREATE", "ALTER", "DROP")):
+        tablas = tablas_de_ddl(sql)
+        if tablas:
+            logger.info(f"Operación DDL detectada, refrescando metadatos de {tablas}.")
+            db_metadata.refresh_tables(tablas)
+        else:
+            logger.info("Operación DDL detectada, refrescando metadatos.")
+            db_metadata.refresh_metadata()
+        # El refrescador adelanta su próxima comprobación: tras un DDL suele haber más cambios
+        db_metadata.notify_ddl(tablas)
+
+def _ejecutar_sql(engine, sql, db_metadata, formato, governor, offset, cache_resultados):
     try:
         with engine.connect() as conn:
-            resultado = conn.execute(text(sql))
+            pagina = None
+            if governor is not None:
+                governor.comprobar_plan(conn, sql)
+                pagina = governor.preparar(sql, offset)
+                with governor.tiempo_limite(conn):
+                    resultado = conn.execute(text(pagina.sql))
+            else:
+                resultado = conn.execute(text(sql))
 
-            # Detectar si es una operación DDL
-            if sql.strip().upper().startswith(("CREATE", "ALTER", "DROP")):
-                logger.info("Operación DDL detectada, refrescando metadatos.")
-                db_metadata.refresh()
+            if not resultado.returns_rows:
+                tras_escritura(sql, db_metadata, cache_resultados)
 
             # Procesar resultados si no es DDL
             if resultado.returns_rows:
                 columnas = resultado.keys()
-                filas = resultado.fetchall()
-                datos = [dict(zip(columnas, fila)) for fila in filas]
-                return {"sql": sql, "resultados": datos}
+                siguiente = None
+                if pagina is not None:
+                    filas, siguiente = governor.leer_pagina(resultado, pagina)
+                else:
+                    filas = resultado.fetchall()
+                ROWS_RETURNED.inc(len(filas))
+                if formato == FORMATO_COLUMNAR:
+                    respuesta = {"sql": sql, **a_columnar(columnas, filas)}
+                else:
+                    datos = [dict(zip(columnas, fila)) for fila in filas]
+                    respuesta = {"sql": sql, "resultados": datos}
+                if pagina is not None:
+                    respuesta["siguiente_pagina"] = siguiente
+                return respuesta
             else:
                 return {"sql": sql, "resultados": "Operación ejecutada exitosamente."}
+    except ConsultaRechazada as e:
+        logger.warning(f"Consulta rechazada por el gobernador: {e}")
+        registrar_error_sql(e)
+        return {"sql": sql, "error": str(e)}
     except Exception as e:
+        registrar_error_sql(e)
         error_message = str(e)
         logger.error(f"Error al ejecutar SQL: {error_message}")
 
@@ -57,3 +322,319 @@ def ejecutar_pregunta(client, engine, pregunta, db_metadata):
         if "doesn't exist" in error_message or "no such table" in error_message:
             return {"sql": sql, "error": "La consulta hace referencia a una tabla inexistente."}
         return {"sql": sql, "error": error_message}
+
+def ejecutar_pregunta(client, engine, pregunta, db_metadata, retriever=None, plantillas=None):
+    # Con un TemplateStore, las preguntas que solo cambian un literal no llegan al modelo
+    fingerprint = db_metadata.get_fingerprint_token()
+    sql = None
+    if plantillas is not None:
+        sql = plantillas.get(pregunta, fingerprint, db_metadata.get_known_values())
+    if sql is not None:
+        logger.info(f"SQL obtenido de una plantilla: {sql}")
+        # Como en el camino async: se valida pero no se pide corrección al modelo
+        rechazo = comprobar_sql(sql, db_metadata)
+        if rechazo is not None:
+            logger.error(f"SQL de plantilla rechazado por el validador: {rechazo.motivo}")
+            plantillas.discard(pregunta, fingerprint)
+            return {"sql": sql, "error": f"El SQL generado no es válido: {rechazo.motivo}", "cache": "plantilla"}
+        resultado = ejecutar_sql(engine, sql, db_metadata)
+        if "error" in resultado:
+            plantillas.discard(pregunta, fingerprint)
+        return {**resultado, "cache": "plantilla"}
+
+    # Obtener descripción del esquema
+    mensaje_sistema, tablas, tokens_sistema = describir_esquema(db_metadata, pregunta, retriever)
+
+    prompt = construir_prompt(mensaje_sistema, pregunta)
+    registrar_prompt(prompt, tablas, tokens_sistema, db_metadata)
+    respuesta = client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=prompt
+    )
+    sql = limpiar_sql(respuesta.choices[0].message.content)
+
+    logger.info(f"SQL generado: {sql}")
+
+    # Validar el SQL contra los metadatos y pedir correcciones al modelo si no encaja
+    rechazo = comprobar_sql(sql, db_metadata)
+    for intento in range(1, SQL_REPAIR_ATTEMPTS + 1):
+        if rechazo is None or not rechazo.reparable:
+            break
+        logger.warning(
+            f"SQL rechazado por el validador ({rechazo.motivo}); pidiendo corrección {intento}/{SQL_REPAIR_ATTEMPTS}"
+        )
+        prompt = prompt_reparacion(prompt, sql, rechazo.motivo)
+        respuesta = client.chat.completions.create(model="gpt-3.5-turbo", messages=prompt)
+        sql = limpiar_sql(respuesta.choices[0].message.content)
+        rechazo = comprobar_sql(sql, db_metadata)
+    if rechazo is not None:
+        logger.error(f"SQL rechazado por el validador: {rechazo.motivo}")
+        return {"sql": sql, "error": f"El SQL generado no es válido: {rechazo.motivo}"}
+
+    resultado = ejecutar_sql(engine, sql, db_metadata)
+    if plantillas is not None and "error" not in resultado:
+        plantillas.put(pregunta, fingerprint, sql)
+    return resultado
+
+async def generar_sql_async(client, pregunta, db_metadata, cache=None, embedder=None, retriever=None,
+                            singleflight=None, esquema=None, limitador=None, plantillas=None):
+    """
+    Obtiene el SQL para una pregunta sin ejecutarlo: primero de la caché (exacta y, con
+    un embedder, por similitud), después de una plantilla aprendida si se pasa un
+    TemplateStore y si no, del modelo con el prompt podado por el retriever.
+    Con un SingleFlight, las preguntas idénticas concurrentes comparten una sola generación.
+    `esquema` es un (mensaje de sistema, tablas, tokens) ya calculado (p. ej. uno para todo un lote) y
+    `limitador` acota la concurrencia y el ritmo de las llamadas al modelo.
+
+    Devuelve {"sql", "origen", "fingerprint", "embedding"} o {"error"}.
+    """
+    def generar():
+        return _generar_sql_async(
+            client, pregunta, db_metadata, cache, embedder, retriever, esquema, limitador, plantillas
+        )
+
+    if singleflight is None:
+        return await generar()
+
+    clave = ("generar", normalizar_pregunta(pregunta), db_metadata.get_fingerprint_token())
+    return await singleflight.do(clave, generar)
+
+async def buscar_sql_conocido(pregunta, fingerprint, cache=None, embedder=None, plantillas=None,
+                              valores_conocidos=None):
+    """
+    SQL ya conocido para la pregunta: de la caché (exacta y, con un embedder, por similitud)
+    o ligado a partir de una plantilla aprendida (valores_conocidos justifica sus textos).
+    Devuelve (sql, origen, embedding) con sql None si hay que llamar al modelo; el
+    embedding calculado sirve para guardar después.
+    """
+    sql, origen, embedding = None, None, None
+    if cache is not None:
+        sql = await cache.get_async(pregunta, fingerprint)
+        origen = "exacta" if sql is not None else None
+        if sql is None and embedder is not None:
+            try:
+                embedding = await embedder(pregunta)
+                sql = cache.get_similar(embedding, fingerprint)
+                origen = "semantica" if sql is not None else None
+            except Exception as e:
+                logger.warning(f"No se pudo calcular el embedding de la pregunta: {e}")
+        if sql is None:
+            cache.record_miss()
+        CACHE_LOOKUPS.labels(origen or "miss").inc()
+
+    if sql is None and plantillas is not None:
+        with etapa(ETAPA_PLANTILLA):
+            sql = plantillas.get(pregunta, fingerprint, valores_conocidos)
+        origen = "plantilla" if sql is not None else None
+    return sql, origen, embedding
+
+async def _generar_sql_async(client, pregunta, db_metadata, cache, embedder, retriever, esquema, limitador,
+                             plantillas):
+    fingerprint = db_metadata.get_fingerprint_token()
+    sql, origen, embedding = await buscar_sql_conocido(
+        pregunta, fingerprint, cache, embedder, plantillas,
+        db_metadata.get_known_values() if plantillas is not None else None
+    )
+
+    if sql is None:
+        with etapa(ETAPA_PROMPT):
+            if esquema is None:
+                esquema = await describir_esquema_async(db_metadata, pregunta, retriever)
+            mensaje_sistema, tablas, tokens_sistema = esquema
+
+            prompt = construir_prompt(mensaje_sistema, pregunta)
+            tokens = registrar_prompt(prompt, tablas, tokens_sistema, db_metadata)
+        try:
+            async with limitador or nullcontext():
+                with etapa(ETAPA_LLM):
+                    respuesta = await llamar_modelo(client, prompt, tokens)
+        except LLMNoDisponible as e:
+            logger.error(f"Sin respuesta del modelo: {e}")
+            return {"error": str(e)}
+        registrar_uso_llm(respuesta)
+        sql = limpiar_sql(respuesta.choices[0].message.content)
+
+        logger.info(f"SQL generado: {sql}")
+    else:
+        logger.info(f"SQL obtenido de la caché ({origen}): {sql}")
+
+    # Solo se piden correcciones del SQL recién generado; el cacheado ya se validó con este esquema
+    try:
+        sql, error = await validar_generado(
+            client, prompt if origen is None else None, sql, db_metadata, origen is None, limitador
+        )
+    except LLMNoDisponible as e:
+        logger.error(f"Sin respuesta del modelo al pedir la corrección del SQL: {e}")
+        return {"error": str(e)}
+    if error is not None:
+        logger.error(f"SQL rechazado por el validador: {error}")
+        return {"sql": sql, "error": f"El SQL generado no es válido: {error}"}
+
+    return {"sql": sql, "origen": origen, "fingerprint": fingerprint, "embedding": embedding}
+
+async def generar_sql_stream(client, pregunta, db_metadata, cache=None, embedder=None, retriever=None,
+                             plantillas=None):
+    """
+    Como generar_sql_async pero devuelve el SQL según lo va emitiendo el modelo:
+    produce ("token", texto) por cada fragmento y al final ("sql", generacion) o
+    ("error", mensaje). Un acierto de caché o de plantilla, ya validado, produce
+    directamente ("sql", generacion).
+    """
+    fingerprint = db_metadata.get_fingerprint_token()
+    sql, origen, embedding = await buscar_sql_conocido(
+        pregunta, fingerprint, cache, embedder, plantillas,
+        db_metadata.get_known_values() if plantillas is not None else None
+    )
+    if sql is not None:
+        logger.info(f"SQL obtenido de la caché ({origen}): {sql}")
+        # Como en generar_sql_async: el SQL conocido se valida contra el esquema actual, sin reparar
+        sql, error = await validar_generado(client, None, sql, db_metadata, reparar=False)
+        if error is not None:
+            logger.error(f"SQL rechazado por el validador: {error}")
+            yield "error", f"El SQL generado no es válido: {error}"
+            return
+        yield "sql", {"sql": sql, "origen": origen, "fingerprint": fingerprint, "embedding": embedding}
+        return
+
+    with etapa(ETAPA_PROMPT):
+        mensaje_sistema, tablas, tokens_sistema = await describir_esquema_async(db_metadata, pregunta, retriever)
+        prompt = construir_prompt(mensaje_sistema, pregunta)
+        tokens = registrar_prompt(prompt, tablas, tokens_sistema, db_metadata)
+
+    partes = []
+    try:
+        with etapa(ETAPA_LLM):
+            async for texto in transmitir_modelo(client, prompt, tokens):
+                partes.append(texto)
+                yield "token", texto
+    except LLMNoDisponible as e:
+        logger.error(f"Sin respuesta del modelo: {e}")
+        yield "error", str(e)
+        return
+
+    sql = limpiar_sql("".join(partes))
+    logger.info(f"SQL generado: {sql}")
+    # Si no pasa la validación, la corrección llega completa en el evento final con el SQL
+    try:
+        sql, error = await validar_generado(client, prompt, sql, db_metadata)
+    except LLMNoDisponible as e:
+        logger.error(f"Sin respuesta del modelo al pedir la corrección del SQL: {e}")
+        yield "error", str(e)
+        return
+    if error is not None:
+        logger.error(f"SQL rechazado por el validador: {error}")
+        yield "error", f"El SQL generado no es válido: {error}"
+        return
+    yield "sql", {"sql": sql, "origen": None, "fingerprint": fingerprint, "embedding": embedding}
+
+async def transmitir_modelo(client, prompt, tokens=None):
+    """Fragmentos de texto de la respuesta del modelo según llegan (con la LLMGateway si se pasa una)"""
+    if isinstance(client, LLMGateway):
+        async with aclosing(client.completar_stream(prompt, tokens=tokens)) as fragmentos:
+            async for texto in fragmentos:
+                yield texto
+        return
+    respuesta = await client.chat.completions.create(model="gpt-3.5-turbo", messages=prompt, stream=True)
+    async for fragmento in respuesta:
+        texto = fragmento.choices[0].delta.content if fragmento.choices else None
+        if texto:
+            yield texto
+
+async def llamar_modelo(client, prompt, tokens=None):
+    """Llama al modelo a través de la LLMGateway si se pasa una, o directamente al cliente AsyncOpenAI"""
+    if isinstance(client, LLMGateway):
+        return await client.completar(prompt, tokens=tokens)
+    return await client.chat.completions.create(model="gpt-3.5-turbo", messages=prompt)
+
+def guardar_en_cache(cache, pregunta, generacion, plantillas=None):
+    """Guarda en la caché (y aprende como plantilla) un SQL recién generado por el modelo que se ha ejecutado sin error"""
+    if generacion["origen"] is not None:
+        return
+    if cache is not None:
+        cache.put(pregunta, generacion["fingerprint"], generacion["sql"], generacion["embedding"])
+    if plantillas is not None:
+        plantillas.put(pregunta, generacion["fingerprint"], generacion["sql"])
+
+async def guardar_en_cache_async(cache, pregunta, generacion, plantillas=None):
+    """guardar_en_cache desde código async: la escritura en el estado compartido no bloquea el event loop"""
+    if generacion["origen"] is not None:
+        return
+    if cache is not None:
+        await cache.put_async(pregunta, generacion["fingerprint"], generacion["sql"], generacion["embedding"])
+    if plantillas is not None:
+        plantillas.put(pregunta, generacion["fingerprint"], generacion["sql"])
+
+async def ejecutar_pregunta_async(client, engine, pregunta, db_metadata, executor=None, cache=None, embedder=None,
+                                  retriever=None, formato=None, governor=None, singleflight=None, esquema=None,
+                                  limitador=None, cache_resultados=None, plantillas=None, reutilizar_resultados=True):
+    """
+    Versión no bloqueante de ejecutar_pregunta: la llamada al modelo usa un cliente
+    AsyncOpenAI y el SQL se ejecuta en un pool de hilos acotado (executor).
+
+    Si se pasa una QuestionCache, se consulta antes de llamar al modelo (y, con un
+    embedder, también por similitud); solo se cachea el SQL, nunca las filas. Con un
+    SchemaRetriever el prompt solo incluye las tablas relevantes para la pregunta.
+    Con formato="columnar" las filas se devuelven como listas junto a columnas y tipos.
+    Con un QueryGovernor la ejecución queda limitada y paginada. Con un SingleFlight las
+    preguntas idénticas y los SQL idénticos en curso se ejecutan una sola vez. Con una
+    ResultCache las filas de las lecturas se reutilizan mientras sus tablas no cambien (salvo
+    con reutilizar_resultados=False, que solo deja la invalidación por escrituras). Con
+    un TemplateStore se aprende de cada SQL generado y las preguntas que solo cambian un
+    literal se responden ligándolo a una plantilla, sin llamar al modelo.
+    """
+    generacion = await generar_sql_async(
+        client, pregunta, db_metadata, cache, embedder, retriever, singleflight, esquema, limitador, plantillas
+    )
+    if "error" in generacion:
+        return generacion
+
+    loop = asyncio.get_running_loop()
+
+    async def ejecutar():
+        return await loop.run_in_executor(
+            executor, ejecutar_sql, engine, generacion["sql"], db_metadata, formato, governor, 0, cache_resultados,
+            reutilizar_resultados
+        )
+
+    with etapa(ETAPA_SQL):
+        if singleflight is None:
+            resultado = await ejecutar()
+        else:
+            resultado = await singleflight.do(("ejecutar", generacion["sql"], formato, reutilizar_resultados), ejecutar)
+    # El resultado puede ser compartido con otras peticiones: no se modifica en sitio
+    resultado = dict(resultado)
+
+    if generacion["origen"] is not None:
+        resultado["cache"] = generacion["origen"]
+        if generacion["origen"] == "plantilla" and "error" in resultado:
+            plantillas.discard(pregunta, generacion["fingerprint"])
+    elif "error" not in resultado:
+        await guardar_en_cache_async(cache, pregunta, generacion, plantillas)
+    return resultado
+
+async def ejecutar_lote_async(client, engine, preguntas, db_metadata, retriever=None, **kwargs):
+    """
+    Ejecuta un lote de preguntas en paralelo y va devolviendo (índice, resultado) según
+    terminan. El esquema del prompt se calcula una sola vez para todo el lote; el resto
+    de argumentos (executor, cache, limitador...) se pasan a ejecutar_pregunta_async.
+    """
+    esquema = await describir_esquema_lote_async(db_metadata, preguntas, retriever)
+
+    async def ejecutar(indice, pregunta):
+        try:
+            resultado = await ejecutar_pregunta_async(
+                client, engine, pregunta, db_metadata, retriever=retriever, esquema=esquema, **kwargs
+            )
+        except Exception as e:
+            logger.error(f"Error en la pregunta {indice} del lote: {e}")
+            resultado = {"error": str(e)}
+        return indice, resultado
+
+    tareas = [asyncio.ensure_future(ejecutar(indice, pregunta)) for indice, pregunta in enumerate(preguntas)]
+    try:
+        for siguiente in asyncio.as_completed(tareas):
+            yield await siguiente
+    finally:
+        # Si el cliente se desconecta se cancela lo que quede pendiente
+        for tarea in tareas:
+            tarea.cancel()
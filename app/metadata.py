@@ -1,143 +1,743 @@
-from sqlalchemy import inspect, text
+from sqlalchemy import inspect, text, bindparam
 import logging
 import json
+import hashlib
+import re
 from datetime import datetime
 import threading
 import time
+import asyncio
+import random
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from .singleflight import SingleFlightSync
+from .snapshot import clave_snapshot
+from .shared_state import identificador_proceso
+from .schema_retrieval import contar_tokens
+from .config import (
+    SCHEMA_CHANGE_DETECTION, SCHEMA_TOKEN_INTERVAL, METADATA_WORKERS, METADATA_EXACT_COUNTS, SHARED_LEASE_TTL,
+    METADATA_DETAILS_MAX_TABLES, METADATA_REFRESH_MIN_INTERVAL, METADATA_REFRESH_MAX_INTERVAL,
+    METADATA_REFRESH_WINDOW, METADATA_REFRESH_JITTER
+)
 
 logger = logging.getLogger(__name__)
 
+# Lo que queda residente de cada tabla: columnas y conteo estimado, en tuplas compactas e inmutables
+# (se comparten tal cual entre versiones de schema_info). references es (tabla, columna) o None.
+ColumnInfo = namedtuple("ColumnInfo", ["name", "type", "nullable", "key", "default", "extra", "references"])
+TableInfo = namedtuple("TableInfo", ["columns", "record_count"])
+# Detalle que se carga bajo demanda: filas de muestra, valores de ejemplo por columna de texto y conteo exacto
+TableDetails = namedtuple("TableDetails", ["sample_rows", "value_stats", "exact_count"])
+
+# Una sola consulta a information_schema que resume la estructura de la base de datos actual:
+# bases de datos, tablas (con CREATE_TIME), definiciones de columnas e índices. Sin UPDATE_TIME:
+# una escritura de datos no cambia el token (la frescura de los datos la comprueba ResultCache).
+CHANGE_TOKEN_QUERY = text("""
+    SELECT 'D' AS kind, SCHEMA_NAME AS table_name, '' AS item, '' AS definition, 0 AS pos
+      FROM information_schema.SCHEMATA
+    UNION ALL
+    SELECT 'S', DATABASE(), '', '', 0
+    UNION ALL
+    SELECT 'T', TABLE_NAME, '', CONCAT_WS('|', TABLE_TYPE, ENGINE, CREATE_TIME), 0
+      FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()
+    UNION ALL
+    SELECT 'C', TABLE_NAME, COLUMN_NAME,
+           CONCAT_WS('|', COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY, COLUMN_DEFAULT, EXTRA), ORDINAL_POSITION
+      FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE()
+    UNION ALL
+    SELECT 'I', TABLE_NAME, INDEX_NAME, CONCAT_WS('|', NON_UNIQUE, COLUMN_NAME, INDEX_TYPE), SEQ_IN_INDEX
+      FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE()
+""")
+
+# AUTO_INCREMENT=n de SHOW CREATE TABLE avanza con cada INSERT: no forma parte de la estructura
+_AUTO_INCREMENT = re.compile(r"\s+AUTO_INCREMENT=\d+")
+
+# Introspección en bloque: columnas con sus claves (y FKs declaradas) de todas las tablas
+_COLUMNS_SQL = """
+    SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, c.IS_NULLABLE, c.COLUMN_KEY, c.COLUMN_DEFAULT, c.EXTRA,
+           k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME
+      FROM information_schema.COLUMNS c
+      LEFT JOIN information_schema.KEY_COLUMN_USAGE k
+        ON k.TABLE_SCHEMA = c.TABLE_SCHEMA AND k.TABLE_NAME = c.TABLE_NAME
+       AND k.COLUMN_NAME = c.COLUMN_NAME AND k.REFERENCED_TABLE_NAME IS NOT NULL
+     WHERE c.TABLE_SCHEMA = DATABASE() {filter}
+     ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+"""
+COLUMNS_QUERY = text(_COLUMNS_SQL.format(filter=""))
+COLUMNS_QUERY_FILTERED = text(_COLUMNS_SQL.format(filter="AND c.TABLE_NAME IN :tables")).bindparams(
+    bindparam('tables', expanding=True)
+)
+
+# Conteos estimados (TABLE_ROWS) sin recorrer las tablas
+_TABLES_SQL = """
+    SELECT TABLE_NAME, TABLE_ROWS
+      FROM information_schema.TABLES
+     WHERE TABLE_SCHEMA = DATABASE() {filter}
+     ORDER BY TABLE_NAME
+"""
+TABLES_QUERY = text(_TABLES_SQL.format(filter=""))
+TABLES_QUERY_FILTERED = text(_TABLES_SQL.format(filter="AND TABLE_NAME IN :tables")).bindparams(
+    bindparam('tables', expanding=True)
+)
+
+
+def stable_digest(*parts):
+    """Resumen estable entre procesos (a diferencia de hash(), que cambia por proceso)"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+def _column_from_dict(column):
+    """ColumnInfo a partir del formato antiguo de snapshot (un diccionario por columna)"""
+    references = column.get('references')
+    return ColumnInfo(
+        column['name'], column['type'], column.get('nullable', True), column['key'], column.get('default'),
+        column.get('extra', ''), (references['table'], references['column']) if references else None
+    )
+
+
+def schema_to_json(schema_info):
+    """schema_info serializable: cada tabla como [conteo, [[campos de la columna], ...]]"""
+    return {
+        **schema_info,
+        'tables': {name: [info.record_count, [list(column) for column in info.columns]]
+                   for name, info in schema_info['tables'].items()}
+    }
+
+
+def schema_from_json(data):
+    """Inversa de schema_to_json (acepta también el formato antiguo con diccionarios)"""
+    tables = {}
+    for name, info in data['tables'].items():
+        if isinstance(info, dict):
+            tables[name] = TableInfo(tuple(_column_from_dict(c) for c in info['columns']), info['record_count'])
+            continue
+        record_count, columns = info
+        tables[name] = TableInfo(
+            tuple(ColumnInfo(*column[:6], tuple(column[6]) if column[6] else None) for column in columns),
+            record_count
+        )
+    return {**data, 'tables': tables}
+
+
 class DBMetadataManager:
-    def __init__(self, engine):
+    def __init__(self, engine, change_detection=SCHEMA_CHANGE_DETECTION, snapshot_store=None):
         self.engine = engine
+        self.change_detection = change_detection
         self.schema_info = {}
         self.last_check_time = datetime.now()
         self.last_fingerprint = None
-        self.refresh_metadata()
+        # Token del snapshot cargado en schema_info y último token observado por el refrescador
+        self.schema_token = None
+        self.observed_token = None
+        self.last_refresh_timings = {}
+        # Aviso al refrescador cuando el servicio ejecuta un DDL (lo instala MetadataRefresher.start)
+        self.on_ddl = None
+        # Refrescos concurrentes (petición, endpoint, refrescador) comparten una sola introspección
+        self._refresh_flight = SingleFlightSync("refresh_metadata")
+        # Descripción completa para el prompt, calculada una vez por snapshot: (schema_info, texto, tokens)
+        self._description = (None, None, None)
+        # Mensaje de sistema con la descripción completa: (descripción, prefijo, mensaje, tokens)
+        self._system_prompt = (None, None, None, None)
+        self._prefix_tokens = {}
+        # Veredictos del validador por SQL para el schema_info cargado, LRU: (schema_info, {sql: veredicto})
+        self._verdicts = (None, OrderedDict())
+        self._verdicts_lock = threading.Lock()
+        self.verdicts_max_entries = 1024
+        # Fragmentos de la descripción con sus tokens: se reutilizan entre refrescos si la tabla no cambia
+        self._fragments = {}
+        self._relationship_fragments = {}
+        self._header_fragments = {}
+        # Detalle de tablas cargado bajo demanda, LRU acotada: {tabla: (TableInfo, TableDetails)}
+        self._details = OrderedDict()
+        self._details_lock = threading.Lock()
+        self._details_pending = set()
+        self._details_executor = None
+        self.details_max_tables = METADATA_DETAILS_MAX_TABLES
+        self.details_stats = {'hits': 0, 'loads': 0, 'evictions': 0}
+        # Versión del detalle en memoria (cambia con cada carga o expulsión) y valores conocidos derivados
+        self.details_version = 0
+        self._known_values = (None, None, None)
+        # Con un snapshot en disco se arranca con él y se valida después (validate_snapshot)
+        self.snapshot_store = snapshot_store
+        self.snapshot_version = None
+        self.process_id = identificador_proceso()
+        self.snapshot_loaded = snapshot_store is not None and (
+            self._load_snapshot() or self._wait_for_shared_snapshot()
+        )
+        if not self.snapshot_loaded:
+            self.refresh_metadata()
+            if self.is_shared():
+                self.snapshot_store.liberar_lease(self.lease_name("introspeccion"), self.process_id)
+
+    def is_shared(self):
+        """Si el store admite leases, el estado se comparte con otros workers"""
+        return hasattr(self.snapshot_store, 'adquirir_lease')
+
+    def lease_name(self, role):
+        return f"{role}:{clave_snapshot(self.engine)}"
+
+    def _wait_for_shared_snapshot(self, timeout=60):
+        """Sin snapshot previo solo un worker hace la introspección inicial; el resto espera a que la publique"""
+        if not self.is_shared():
+            return False
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.snapshot_store.adquirir_lease(self.lease_name("introspeccion"), self.process_id, timeout):
+                return False
+            time.sleep(0.5)
+            if self._load_snapshot():
+                return True
+        logger.warning("Tiempo agotado esperando el snapshot de otro worker; se introspecciona localmente")
+        return False
+
+    def _load_snapshot(self):
+        """Carga schema_info, huella y descripción desde el snapshot en disco si existe"""
+        snapshot = self.snapshot_store.cargar(clave_snapshot(self.engine))
+        if snapshot is None or snapshot.get('change_detection') != self.change_detection:
+            return False
+        self.schema_info = schema_from_json(snapshot['schema_info'])
+        self.last_fingerprint = snapshot['fingerprint']
+        self.schema_token = self.observed_token = snapshot['schema_token']
+        description = snapshot['description']
+        tokens = snapshot.get('description_tokens')
+        self._description = (self.schema_info, description, tokens if tokens is not None else contar_tokens(description))
+        self.snapshot_version = snapshot['guardado']
+        logger.info(
+            f"Esquema cargado del snapshot en disco ({len(self.schema_info['tables'])} tablas, "
+            f"guardado hace {time.time() - snapshot['guardado']:.0f}s)"
+        )
+        return True
+
+    def _save_snapshot(self):
+        if self.snapshot_store is None:
+            return
+        self.snapshot_version = self.snapshot_store.guardar(clave_snapshot(self.engine), {
+            'change_detection': self.change_detection,
+            'schema_info': schema_to_json(self.schema_info),
+            'fingerprint': self.last_fingerprint,
+            'schema_token': self.schema_token,
+            'description': self.get_schema_description(),
+            'description_tokens': self.get_schema_description_tokens()
+        })
+
+    def sync_from_store(self):
+        """Recarga el snapshot compartido si otro worker ha publicado uno más reciente"""
+        version = self.snapshot_store.version(clave_snapshot(self.engine))
+        if version is None or version == self.snapshot_version:
+            return False
+        return self._load_snapshot()
+
+    def validate_snapshot(self):
+        """Comprueba en segundo plano que el snapshot cargado sigue vigente y lo refresca si no"""
+        if self.is_shared() and not self.snapshot_store.adquirir_lease(
+                self.lease_name("refresher"), self.process_id, SHARED_LEASE_TTL):
+            return True  # Lo valida el worker que tiene la lease del refrescador
+        if self.change_detection != "information_schema":
+            return self.refresh_metadata()
+        if self.poll_change_token():
+            logger.info("El esquema cambió desde que se guardó el snapshot; refrescando")
+            return self.refresh_metadata()
+        logger.info("Snapshot del esquema vigente")
+        return True
     
-    def refresh_metadata(self):
+    def refresh_metadata(self, exact_counts=METADATA_EXACT_COUNTS, force_tables=()):
         """Actualiza la información del esquema de la base de datos"""
+        force_tables = tuple(sorted(force_tables))
+        return self._refresh_flight.do(
+            ("refresh", exact_counts, force_tables), lambda: self._refresh_metadata(exact_counts, force_tables)
+        )
+
+    def notify_ddl(self, tables=()):
+        """Avisa al refrescador de un DDL ejecutado por el servicio"""
+        if self.on_ddl is not None:
+            self.on_ddl(tables)
+
+    def refresh_tables(self, tables, exact_counts=METADATA_EXACT_COUNTS):
+        """Vuelve a introspeccionar las tablas indicadas (p. ej. tras un DDL) además de las que hayan cambiado"""
+        return self.refresh_metadata(exact_counts=exact_counts, force_tables=tables)
+
+    def _tables_to_reload(self, previous, change_token, current_db, force_tables):
+        """
+        Compara huellas por tabla y devuelve (tablas a recargar, tablas eliminadas), o
+        (None, None) si hace falta una introspección completa.
+        """
+        previous_fingerprint = self.last_fingerprint
+        if (change_token is None or not previous.get('tables') or not previous_fingerprint
+                or 'tables' not in previous_fingerprint or previous.get('current_db') != current_db):
+            return None, None
+
+        old_tokens = previous_fingerprint['tables']
+        new_tokens = change_token['tables']
+        removed = (set(previous['tables']) | set(old_tokens)) - set(new_tokens)
+        to_reload = {table for table, token in new_tokens.items() if old_tokens.get(table) != token}
+        # Tablas forzadas (DDL) o que faltan en el snapshot anterior
+        to_reload |= (set(force_tables) | (set(new_tokens) - set(previous['tables']))) & set(new_tokens)
+        return to_reload, removed
+
+    def _refresh_metadata(self, exact_counts, force_tables):
         try:
+            timings = {}
+            previous = self.schema_info
+
+            # El token se calcula antes de introspeccionar: un cambio concurrente se verá en el próximo sondeo
+            change_token = None
+            if self.change_detection == "information_schema":
+                change_token = self.get_change_token()
+
+            # Fase 1: bases de datos, tablas, conteos estimados y columnas en una sola conexión
+            phase_start = time.perf_counter()
+            with self.engine.connect() as conn:
+                databases, current_db = self._get_databases_and_current(conn)
+                to_reload, removed = self._tables_to_reload(previous, change_token, current_db, force_tables)
+                if to_reload is None or to_reload:
+                    estimated_counts = self._get_estimated_counts(conn, to_reload)
+                    columns_by_table = self._get_columns_bulk(conn, to_reload)
+                else:
+                    estimated_counts, columns_by_table = {}, {}
+            timings['columns'] = time.perf_counter() - phase_start
+
+            # Copy-on-write: se construye un diccionario nuevo y se publica al final de una vez
+            incremental = to_reload is not None
+            tables = {}
+            if incremental:
+                tables = {
+                    name: info for name, info in previous['tables'].items()
+                    if name not in removed and name not in estimated_counts
+                }
+            # Fase 2: conteos exactos, solo si se piden explícitamente
+            if exact_counts:
+                phase_start = time.perf_counter()
+                estimated_counts = self._run_concurrently(self._get_exact_count, estimated_counts)
+                timings['counts'] = time.perf_counter() - phase_start
+
+            for table_name, record_count in estimated_counts.items():
+                tables[table_name] = TableInfo(tuple(columns_by_table.get(table_name, ())), record_count)
+
+            # Las muestras no se cargan aquí: se piden por tabla al usarla en un prompt (get_table_details)
+
+            tables = dict(sorted(tables.items()))
+
+            # Intenta identificar relaciones (en modo incremental solo las aristas afectadas)
+            if incremental:
+                affected = set(estimated_counts) | removed
+                relationships = [
+                    rel for rel in previous['relationships']
+                    if rel['table'] not in affected and rel['referenced_table'] not in affected
+                ]
+                relationships += self._identify_relationships(tables, sources=set(estimated_counts))
+                relationships += self._identify_relationships(
+                    tables, sources=set(tables) - affected, targets=affected
+                )
+            else:
+                relationships = self._identify_relationships(tables)
+
             self.schema_info = {
-                'databases': self._get_databases(),
-                'current_db': self._get_current_db(),
-                'tables': {},
-                'relationships': []
+                'databases': databases,
+                'current_db': current_db,
+                'tables': tables,
+                'relationships': relationships
             }
             
-            # Obtener información de tablas en la base de datos actual
-            for table_name in self._get_tables():
-                self.schema_info['tables'][table_name] = self._get_table_info(table_name)
-                
-            # Intenta identificar relaciones
-            self._identify_relationships()
-            
             # Actualizar huella digital
-            self.last_fingerprint = self.get_schema_fingerprint()
+            if change_token is not None:
+                self.last_fingerprint = change_token
+                self.schema_token = self.observed_token = change_token['token']
+            else:
+                self.last_fingerprint = self.get_schema_fingerprint()
             self.last_check_time = datetime.now()
+            self.last_refresh_timings = timings
+            # La descripción del prompt se renderiza aquí, una vez por versión, y no en la primera petición
+            self._full_description()
+            self._save_snapshot()
             
-            logger.info("Metadata de base de datos actualizada correctamente")
+            mode = (f"incremental: {len(estimated_counts)} recargadas, {len(removed)} eliminadas"
+                    if incremental else "completa")
+            logger.info(
+                f"Metadata de base de datos actualizada correctamente ({len(tables)} tablas, {mode}; "
+                + ", ".join(f"{phase}: {seconds:.3f}s" for phase, seconds in timings.items()) + ")"
+            )
             return True
         except Exception as e:
             logger.error(f"Error al actualizar metadata: {e}")
             return False
     
+    def _is_mysql(self):
+        """La introspección rápida usa information_schema de MySQL; el resto de motores usa el inspector de SQLAlchemy"""
+        return self.engine.url.get_backend_name() in ("mysql", "mariadb")
+
+    def _quote(self, name):
+        return self.engine.dialect.identifier_preparer.quote(name)
+
+    def _get_databases_and_current(self, conn):
+        """Bases de datos disponibles y la actual"""
+        if self._is_mysql():
+            databases = [row[0] for row in conn.execute(text("SHOW DATABASES"))]
+            return databases, conn.execute(text("SELECT DATABASE()")).scalar()
+        inspector = inspect(conn)
+        return inspector.get_schema_names(), inspector.default_schema_name
+
     def _get_databases(self):
         """Obtener todas las bases de datos disponibles"""
         with self.engine.connect() as conn:
-            result = conn.execute(text("SHOW DATABASES"))
-            return [row[0] for row in result]
+            return self._get_databases_and_current(conn)[0]
     
     def _get_current_db(self):
         """Obtener la base de datos actual"""
         with self.engine.connect() as conn:
-            result = conn.execute(text("SELECT DATABASE()"))
-            return result.scalar()
+            return self._get_databases_and_current(conn)[1]
     
     def _get_tables(self):
         """Obtener todas las tablas en la base de datos actual"""
         with self.engine.connect() as conn:
+            if not self._is_mysql():
+                return inspect(conn).get_table_names()
             result = conn.execute(text("SHOW TABLES"))
             return [row[0] for row in result]
+
+    def _get_estimated_counts(self, conn, tables=None):
+        """Conteo estimado de registros por tabla (TABLE_ROWS) sin recorrer las tablas"""
+        if not self._is_mysql():
+            # Sin estimación barata fuera de MySQL: se devuelven las tablas sin conteo
+            existing = inspect(conn).get_table_names()
+            return {table: None for table in existing if tables is None or table in tables}
+        query = TABLES_QUERY if tables is None else TABLES_QUERY_FILTERED
+        params = {} if tables is None else {'tables': list(tables)}
+        return {row[0]: row[1] for row in conn.execute(query, params)}
+
+    def _get_columns_inspector(self, conn, tables=None):
+        """Equivalente de _get_columns_bulk para motores sin information_schema (p. ej. SQLite)"""
+        inspector = inspect(conn)
+        existing = inspector.get_table_names()
+        columns_by_table = {}
+        for table in existing:
+            if tables is not None and table not in tables:
+                continue
+            primary_key = set(inspector.get_pk_constraint(table).get('constrained_columns') or [])
+            references = {}
+            for fk in inspector.get_foreign_keys(table):
+                for column, referred in zip(fk['constrained_columns'], fk['referred_columns']):
+                    references.setdefault(column, (fk['referred_table'], referred))
+            indexed = {column for index in inspector.get_indexes(table) for column in index['column_names'] if column}
+            columns = []
+            for info in inspector.get_columns(table):
+                name = info['name']
+                columns.append(ColumnInfo(
+                    name,
+                    str(info['type']),
+                    bool(info.get('nullable', True)),
+                    'PRI' if name in primary_key else 'MUL' if name in references or name in indexed else '',
+                    info.get('default'),
+                    'auto_increment' if info.get('autoincrement') is True else '',
+                    references.get(name)
+                ))
+            columns_by_table[table] = columns
+        return columns_by_table
+
+    def _get_columns_bulk(self, conn, tables=None):
+        """Columnas y claves de todas las tablas (o de las indicadas) en una sola consulta"""
+        if not self._is_mysql():
+            return self._get_columns_inspector(conn, tables)
+        query = COLUMNS_QUERY if tables is None else COLUMNS_QUERY_FILTERED
+        params = {} if tables is None else {'tables': list(tables)}
+        columns_by_table = {}
+        for row in conn.execute(query, params):
+            columns = columns_by_table.setdefault(row[0], [])
+            # Una columna con varias FKs aparece repetida: nos quedamos con la primera
+            if columns and columns[-1].name == row[1]:
+                continue
+            columns.append(ColumnInfo(
+                row[1], row[2], row[3] == 'YES', row[4], row[5], row[6], (row[7], row[8]) if row[7] else None
+            ))
+        return columns_by_table
+
+    def _get_sample_data(self, table_name):
+        """Obtener una muestra de datos de una tabla"""
+        try:
+            with self.engine.connect() as conn:
+                sample_result = conn.execute(text(f"SELECT * FROM {self._quote(table_name)} LIMIT 3"))
+                return tuple(tuple(row) for row in sample_result)
+        except Exception as e:
+            logger.warning(f"No se pudo obtener muestra de datos para {table_name}: {e}")
+            return ()
+
+    def _get_exact_count(self, table_name):
+        """Conteo exacto de registros (recorre la tabla: solo bajo demanda)"""
+        try:
+            with self.engine.connect() as conn:
+                return conn.execute(text(f"SELECT COUNT(*) FROM {self._quote(table_name)}")).scalar()
+        except Exception as e:
+            logger.warning(f"No se pudo obtener conteo para {table_name}: {e}")
+            return None
+
+    def _run_concurrently(self, func, table_names):
+        """Ejecuta func(tabla) en un pool de hilos acotado; cada hilo toma su conexión del pool"""
+        table_names = list(table_names)
+        if not table_names:
+            return {}
+        workers = min(METADATA_WORKERS, len(table_names))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="metadata") as executor:
+            return dict(zip(table_names, executor.map(func, table_names)))
     
-    def _get_table_info(self, table_name):
-        """Obtener información detallada de una tabla"""
-        with self.engine.connect() as conn:
-            # Obtener estructura de columnas
-            columns_result = conn.execute(text(f"DESCRIBE `{table_name}`"))
-            columns = [{
-                'name': row[0],
-                'type': row[1],
-                'nullable': row[2] == 'YES',
-                'key': row[3],
-                'default': row[4],
-                'extra': row[5]
-            } for row in columns_result]
-            
-            # Obtener una muestra de datos
-            try:
-                sample_result = conn.execute(text(f"SELECT * FROM `{table_name}` LIMIT 3"))
-                sample_data = [dict(row) for row in sample_result]
-            except Exception as e:
-                logger.warning(f"No se pudo obtener muestra de datos para {table_name}: {e}")
-                sample_data = []
-            
-            # Obtener conteo de registros (aproximado para tablas grandes)
-            try:
-                count_result = conn.execute(text(f"SELECT COUNT(*) FROM `{table_name}`"))
-                record_count = count_result.scalar()
-            except Exception as e:
-                logger.warning(f"No se pudo obtener conteo para {table_name}: {e}")
-                record_count = None
-            
-            return {
-                'columns': columns,
-                'record_count': record_count,
-                'sample_data': sample_data
-            }
-    
-    def _identify_relationships(self):
-        """Intenta identificar relaciones entre tablas basándose en nombres de columnas"""
+    def _identify_relationships(self, tables, sources=None, targets=None):
+        """
+        Intenta identificar relaciones entre tablas basándose en nombres de columnas.
+        Solo recorre las tablas `sources` (todas por defecto) y, si se indica, solo
+        devuelve relaciones hacia `targets`.
+        """
         relationships = []
         
         # Buscar columnas que parezcan foreign keys (terminan en _id)
-        for table_name, table_info in self.schema_info['tables'].items():
-            for column in table_info['columns']:
-                if column['name'].endswith('_id') and column['name'] != 'id':
-                    # Extraer el nombre de la tabla referenciada
-                    referenced_table = column['name'][:-3]
-                    # Verificar si existe en plural
-                    if referenced_table + 's' in self.schema_info['tables']:
-                        relationships.append({
-                            'table': table_name,
-                            'column': column['name'],
-                            'referenced_table': referenced_table + 's',
-                            'referenced_column': 'id'
-                        })
+        for table_name in (tables if sources is None else sources):
+            for column in tables[table_name].columns:
+                # Las FKs declaradas en information_schema tienen prioridad sobre la heurística
+                if column.references:
+                    relationship = {
+                        'table': table_name,
+                        'column': column.name,
+                        'referenced_table': column.references[0],
+                        'referenced_column': column.references[1]
+                    }
+                elif column.name.endswith('_id') and column.name != 'id':
+                    # Extraer el nombre de la tabla referenciada y verificar si existe en plural
+                    relationship = {
+                        'table': table_name,
+                        'column': column.name,
+                        'referenced_table': column.name[:-3] + 's',
+                        'referenced_column': 'id'
+                    }
+                else:
+                    continue
+
+                if relationship['referenced_table'] not in tables:
+                    continue
+                if targets is not None and relationship['referenced_table'] not in targets:
+                    continue
+                relationships.append(relationship)
         
-        self.schema_info['relationships'] = relationships
+        return relationships
     
-    def get_schema_description(self):
-        """Genera una descripción textual del esquema para usar en prompts"""
-        description = f"Base de datos actual: {self.schema_info['current_db']}\n"
-        description += "Bases de datos disponibles: " + ", ".join(self.schema_info['databases']) + "\n\n"
-        
-        description += "Tablas disponibles:\n"
-        for table_name, table_info in self.schema_info['tables'].items():
-            count_info = f" (~{table_info['record_count']} registros)" if table_info['record_count'] is not None else ""
-            description += f"- Tabla: {table_name}{count_info}\n"
-            description += "  Columnas:\n"
-            for column in table_info['columns']:
-                key_info = " (PK)" if column['key'] == 'PRI' else ""
-                description += f"    - {column['name']}: {column['type']}{key_info}\n"
-        
-        if self.schema_info['relationships']:
-            description += "\nRelaciones detectadas:\n"
-            for rel in self.schema_info['relationships']:
-                description += f"- {rel['table']}.{rel['column']} -> {rel['referenced_table']}.{rel['referenced_column']}\n"
-        
-        return description
+    def _table_fragment(self, table_name, table_info):
+        """Texto y tokens de una tabla en la descripción; se recalcula solo si cambian sus columnas o su conteo"""
+        cached = self._fragments.get(table_name)
+        # TableInfo es inmutable: misma instancia o mismo contenido, mismo fragmento
+        if cached is not None and (cached[0] is table_info or cached[0] == table_info):
+            return cached[1], cached[2]
+
+        count_info = f" (~{table_info.record_count} registros)" if table_info.record_count is not None else ""
+        lines = [f"- Tabla: {table_name}{count_info}\n", "  Columnas:\n"]
+        for column in table_info.columns:
+            key_info = " (PK)" if column.key == 'PRI' else ""
+            lines.append(f"    - {column.name}: {column.type}{key_info}\n")
+        text = "".join(lines)
+        tokens = contar_tokens(text)
+        self._fragments[table_name] = (table_info, text, tokens)
+        return text, tokens
+
+    def _relationship_fragment(self, rel):
+        key = (rel['table'], rel['column'], rel['referenced_table'], rel['referenced_column'])
+        cached = self._relationship_fragments.get(key)
+        if cached is None:
+            text = f"- {rel['table']}.{rel['column']} -> {rel['referenced_table']}.{rel['referenced_column']}\n"
+            cached = self._relationship_fragments[key] = (text, contar_tokens(text))
+        return cached
+
+    def _header_fragment(self, schema_info, relationships=False):
+        """Cabecera (bases de datos) o título de la sección de relaciones, con sus tokens"""
+        key = ('relaciones',) if relationships else (schema_info['current_db'], tuple(schema_info['databases']))
+        cached = self._header_fragments.get(key)
+        if cached is None:
+            if relationships:
+                text = "\nRelaciones detectadas:\n"
+            else:
+                text = (
+                    f"Base de datos actual: {schema_info['current_db']}\n"
+                    "Bases de datos disponibles: " + ", ".join(schema_info['databases']) + "\n\n"
+                    "Tablas disponibles:\n"
+                )
+            cached = self._header_fragments[key] = (text, contar_tokens(text))
+        return cached
+
+    def _render_description(self, schema_info, selected=None):
+        """Une los fragmentos de las tablas seleccionadas (todas si selected es None); devuelve (texto, tokens)"""
+        header, tokens = self._header_fragment(schema_info)
+        parts = [header]
+        tables = schema_info['tables']
+        # schema_info['tables'] está ordenado por nombre: con una selección solo se recorren sus tablas
+        names = tables if selected is None else sorted(name for name in selected if name in tables)
+        for table_name in names:
+            text, count = self._table_fragment(table_name, tables[table_name])
+            parts.append(text)
+            tokens += count
+
+        relationships = [
+            rel for rel in schema_info['relationships']
+            if selected is None or (rel['table'] in selected and rel['referenced_table'] in selected)
+        ]
+        if relationships:
+            text, count = self._header_fragment(schema_info, relationships=True)
+            parts.append(text)
+            tokens += count
+            for rel in relationships:
+                text, count = self._relationship_fragment(rel)
+                parts.append(text)
+                tokens += count
+        return "".join(parts), tokens
+
+    def _full_description(self):
+        """(texto, tokens) de la descripción completa, renderizada una vez por versión del esquema"""
+        schema_info = self.schema_info
+        cached_info, description, tokens = self._description
+        if cached_info is not schema_info:
+            # Nueva versión del esquema: se descartan los fragmentos de tablas que ya no existen
+            for table_name in self._fragments.keys() - schema_info['tables'].keys():
+                self._fragments.pop(table_name, None)
+            description, tokens = self._render_description(schema_info)
+            self._description = (schema_info, description, tokens)
+        return description, tokens
+
+    def describe(self, tables=None):
+        """(descripción del esquema para prompts, tokens) con un solo renderizado; opcionalmente solo de algunas tablas"""
+        if tables is None:
+            return self._full_description()
+        # Las tablas elegidas para un prompt son las que merece la pena tener con detalle en memoria
+        self.prefetch_table_details(tables)
+        return self._render_description(self.schema_info, set(tables))
+
+    def get_schema_description(self, tables=None):
+        """Genera una descripción textual del esquema para usar en prompts (opcionalmente solo de algunas tablas)"""
+        return self.describe(tables)[0]
+
+    def get_schema_description_tokens(self, tables=None):
+        """Tokens de la descripción sin volver a tokenizarla: suma de los fragmentos cacheados"""
+        return self.describe(tables)[1]
+
+    def get_system_prompt(self, prefix, tables=None):
+        """
+        (mensaje de sistema = prefix + descripción, tokens) sin volver a tokenizar. Con el
+        esquema completo el mensaje se construye una vez por versión del esquema.
+        """
+        prefix_tokens = self._prefix_tokens.get(prefix)
+        if prefix_tokens is None:
+            prefix_tokens = self._prefix_tokens[prefix] = contar_tokens(prefix)
+        if tables is not None:
+            description, tokens = self.describe(tables)
+            return prefix + description, prefix_tokens + tokens
+
+        description, tokens = self._full_description()
+        cached = self._system_prompt
+        if cached[0] is not description or cached[1] != prefix:
+            cached = self._system_prompt = (description, prefix, prefix + description, prefix_tokens + tokens)
+        return cached[2], cached[3]
     
+    def validation_verdict(self, sql, validate):
+        """
+        validate(sql, schema_info) para el esquema cargado, memorizado por versión del esquema
+        (se sustituye entero en cada refresco): el mismo SQL de la caché o de una plantilla no
+        se vuelve a analizar.
+        """
+        schema_info = self.schema_info
+        with self._verdicts_lock:
+            cached_info, verdicts = self._verdicts
+            if cached_info is not schema_info:
+                verdicts = OrderedDict()
+                self._verdicts = (schema_info, verdicts)
+            elif sql in verdicts:
+                verdicts.move_to_end(sql)
+                return verdicts[sql]
+        verdict = validate(sql, schema_info)
+        with self._verdicts_lock:
+            verdicts[sql] = verdict
+            while len(verdicts) > self.verdicts_max_entries:
+                verdicts.popitem(last=False)
+        return verdict
+
+    def get_table_details(self, table_name, exact_count=METADATA_EXACT_COUNTS):
+        """
+        Muestras, valores de ejemplo y (si se pide) conteo exacto de una tabla. Se cargan
+        la primera vez y se guardan en una LRU de details_max_tables tablas; una entrada
+        deja de valer cuando cambian las columnas o el conteo estimado de su tabla.
+        """
+        table_info = self.schema_info.get('tables', {}).get(table_name)
+        if table_info is None:
+            return None
+        with self._details_lock:
+            cached = self._details.get(table_name)
+            if cached is not None and cached[0] == table_info and (cached[1].exact_count is not None or not exact_count):
+                self._details.move_to_end(table_name)
+                self.details_stats['hits'] += 1
+                return cached[1]
+
+        sample_rows = self._get_sample_data(table_name)
+        value_stats = {}
+        for position, column in enumerate(table_info.columns):
+            values = {row[position] for row in sample_rows if position < len(row)}
+            values = sorted(v for v in values if isinstance(v, str) and len(v) <= 50)
+            if values:
+                value_stats[column.name] = tuple(values)
+        details = TableDetails(sample_rows, value_stats, self._get_exact_count(table_name) if exact_count else None)
+
+        with self._details_lock:
+            self._details[table_name] = (table_info, details)
+            self._details.move_to_end(table_name)
+            self.details_stats['loads'] += 1
+            self.details_version += 1
+            while len(self._details) > self.details_max_tables:
+                self._details.popitem(last=False)
+                self.details_stats['evictions'] += 1
+        return details
+
+    def get_known_values(self):
+        """
+        (versión, {tabla: {columna: valores}}) con los valores de ejemplo del detalle ya cargado
+        y vigente, sin E/S, para indexarlos en el retriever y justificar los textos de las
+        plantillas de SQL. Se recalcula solo cuando cambia el detalle en memoria o la versión
+        del esquema; la versión refleja ambos.
+        """
+        schema_info = self.schema_info
+        with self._details_lock:
+            version, cached_info, values = self._known_values
+            if version != self.details_version or cached_info is not schema_info:
+                tables = schema_info.get('tables', {})
+                values = {
+                    name: details.value_stats for name, (table_info, details) in self._details.items()
+                    if details.value_stats and tables.get(name) == table_info
+                }
+                self._known_values = (self.details_version, schema_info, values)
+            return (self.details_version, id(schema_info)), values
+
+    def prefetch_table_details(self, tables):
+        """Carga en segundo plano el detalle de las tablas que aún no lo tienen (no bloquea a quien llama)"""
+        with self._details_lock:
+            missing = [
+                name for name in tables
+                if name not in self._details_pending
+                and (name not in self._details or self._details[name][0] != self.schema_info['tables'].get(name))
+            ]
+            if not missing:
+                return
+            self._details_pending.update(missing)
+            if self._details_executor is None:
+                self._details_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metadata-details")
+
+        def load():
+            for name in missing:
+                try:
+                    # Nunca un COUNT(*) exacto desde la precarga: es un recorrido completo de la tabla
+                    self.get_table_details(name, exact_count=False)
+                finally:
+                    with self._details_lock:
+                        self._details_pending.discard(name)
+
+        self._details_executor.submit(load)
+
+    def get_details_stats(self):
+        with self._details_lock:
+            return {**self.details_stats, 'tables': len(self._details), 'max_tables': self.details_max_tables}
+
     def get_schema_fingerprint(self):
         """Genera una huella digital del esquema actual"""
         fingerprint = {}
@@ -149,28 +749,96 @@ class DBMetadataManager:
         current_db = self._get_current_db()
         fingerprint[current_db] = {}
         
-        # Para cada tabla, obtener una huella de su estructura
+        if not self._is_mysql():
+            # Sin CHECKSUM TABLE ni SHOW CREATE TABLE: huella de la estructura vía inspector
+            with self.engine.connect() as conn:
+                for table, columns in self._get_columns_inspector(conn).items():
+                    fingerprint[current_db][table] = stable_digest(json.dumps(columns, sort_keys=True, default=str))
+            return fingerprint
+
+        # Para cada tabla, una huella de su estructura (no CHECKSUM TABLE: cambia con cada escritura de datos)
         for table in self._get_tables():
             try:
                 with self.engine.connect() as conn:
-                    # Intentar usar CHECKSUM TABLE si está disponible
-                    try:
-                        result = conn.execute(text(f"CHECKSUM TABLE `{table}`"))
-                        checksum = result.scalar()
-                        fingerprint[current_db][table] = checksum
-                    except:
-                        # Alternativa: usar la estructura de la tabla como huella
-                        result = conn.execute(text(f"SHOW CREATE TABLE `{table}`"))
-                        create_stmt = result.fetchone()[1]
-                        fingerprint[current_db][table] = hash(create_stmt)
+                    result = conn.execute(text(f"SHOW CREATE TABLE `{table}`"))
+                    create_stmt = result.fetchone()[1]
+                    fingerprint[current_db][table] = stable_digest(_AUTO_INCREMENT.sub("", create_stmt))
             except Exception as e:
                 logger.warning(f"No se pudo obtener huella para tabla {table}: {e}")
                 fingerprint[current_db][table] = None
         
         return fingerprint
     
+    def get_change_token(self):
+        """Calcula el token estructural del esquema con una sola consulta a information_schema"""
+        databases = []
+        current_db = None
+        per_table = {}
+
+        with self.engine.connect() as conn:
+            if self._is_mysql():
+                rows = conn.execute(CHANGE_TOKEN_QUERY).fetchall()
+            else:
+                rows = self._change_token_rows_inspector(conn)
+
+        for kind, table_name, item, definition, pos in rows:
+            if kind == 'D':
+                databases.append(table_name)
+            elif kind == 'S':
+                current_db = table_name
+            else:
+                per_table.setdefault(table_name, []).append((kind, item, pos, definition))
+
+        tables = {
+            table: stable_digest(*sorted(parts, key=lambda p: tuple(str(x) for x in p)))
+            for table, parts in per_table.items()
+        }
+        token = stable_digest(current_db, *sorted(databases), *sorted(tables.items()))
+
+        return {
+            'token': token,
+            'databases': sorted(databases),
+            'current_db': current_db,
+            'tables': tables
+        }
+
+    def _change_token_rows_inspector(self, conn):
+        """Mismas filas (kind, tabla, elemento, definición, posición) que CHANGE_TOKEN_QUERY, vía inspector"""
+        databases, current_db = self._get_databases_and_current(conn)
+        rows = [('D', name, '', '', 0) for name in databases] + [('S', current_db, '', '', 0)]
+        for table, columns in self._get_columns_inspector(conn).items():
+            rows.append(('T', table, '', '', 0))
+            for pos, column in enumerate(columns, 1):
+                definition = "|".join(str(value) for value in column[1:6])
+                rows.append(('C', table, column.name, definition, pos))
+        return rows
+
+    def get_fingerprint_token(self):
+        """
+        Identificador estable de la versión de esquema cargada en schema_info. Solo depende de
+        la estructura, así que las cachés que se invalidan con él sobreviven a las escrituras.
+        """
+        if self.schema_token is not None:
+            return self.schema_token
+        if self.last_fingerprint is None:
+            return None
+        return stable_digest(json.dumps(self.last_fingerprint, sort_keys=True, default=str))
+
+    def poll_change_token(self):
+        """Recalcula el token observado (lo invoca el refrescador, nunca el camino de la petición)"""
+        try:
+            self.observed_token = self.get_change_token()['token']
+            self.last_check_time = datetime.now()
+        except Exception as e:
+            logger.error(f"Error al calcular el token de cambios del esquema: {e}")
+        return self.has_schema_changed()
+
     def has_schema_changed(self):
         """Comprueba si el esquema ha cambiado comparando huellas digitales"""
+        # En modo information_schema solo se compara el token cacheado: no hay E/S en la petición
+        if self.change_detection == "information_schema":
+            return self.observed_token is not None and self.observed_token != self.schema_token
+
         # Si no tenemos huella previa, asumimos que no hay cambios
         if self.last_fingerprint is None:
             return False
@@ -210,74 +878,210 @@ class DBMetadataManager:
 
 
 class MetadataRefresher:
-    def __init__(self, db_metadata, interval=900):  # 15 minutos por defecto
+    """
+    Refrescador de metadatos como tarea asyncio del lifespan. El periodo se adapta a la
+    frecuencia reciente de cambios (corto tras un cambio, se dobla hasta el máximo con el
+    esquema quieto), lleva jitter por worker y se despierta al momento con los DDL del servicio.
+    """
+    def __init__(self, db_metadata, interval=METADATA_REFRESH_MAX_INTERVAL, token_interval=SCHEMA_TOKEN_INTERVAL,
+                 lease_ttl=SHARED_LEASE_TTL, min_interval=METADATA_REFRESH_MIN_INTERVAL,
+                 window=METADATA_REFRESH_WINDOW, jitter=METADATA_REFRESH_JITTER):
         self.db_metadata = db_metadata
+        # Con estado compartido solo el worker que tiene la lease consulta MySQL; el resto sigue su snapshot
+        self.lease_ttl = lease_ttl
+        self.leader = None
+        # interval es el techo entre comprobaciones; el periodo con cambios recientes sale de token_interval
         self.interval = interval
-        self.thread = None
+        self.token_interval = token_interval
+        self.min_interval = min_interval
+        self.window = window
+        self.jitter = jitter
+        # Semilla por proceso: los workers no comprueban todos en el mismo instante
+        self._azar = random.Random(db_metadata.process_id)
+        self.changes = deque()
+        self.period = min_interval
         self.running = False
-        self.last_refresh = time.time()
-    
+        self.task = None
+        self._loop = None
+        self._event = None
+        self._ddl_pending = False
+        self.last_check = None
+        self.last_check_duration = None
+        self.last_refresh = None
+        self.last_refresh_duration = None
+        self.next_run = None
+
     def start(self):
-        """Inicia el proceso de actualización periódica en segundo plano"""
+        """Lanza la tarea de refresco en el bucle de eventos actual"""
         if self.running:
             logger.warning("El refrescador ya está en ejecución")
             return
-            
+
         self.running = True
-        self.thread = threading.Thread(target=self._refresh_loop)
-        self.thread.daemon = True  # El hilo terminará cuando termine el programa principal
-        self.thread.start()
-        logger.info(f"Iniciado refrescamiento automático de metadatos cada {self.interval} segundos")
-    
-    def stop(self):
-        """Detiene el proceso de actualización periódica"""
-        if not self.running:
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self.db_metadata.on_ddl = self.notify_ddl
+        self.task = asyncio.create_task(self._run(), name="metadata-refresher")
+        logger.info(f"Iniciado refrescamiento adaptativo de metadatos (cada {self.min_interval}-{self.interval}s)")
+
+    async def stop(self, timeout=5.0):
+        """Detiene la tarea esperando a que termine la comprobación en curso"""
+        if self.running:
+            self.running = False
+            self._wake()
+            if self.task is not None:
+                _, pendientes = await asyncio.wait({self.task}, timeout=timeout)
+                if pendientes:
+                    self.task.cancel()
+                    logger.warning("El refrescador no terminó a tiempo; tarea cancelada")
+                else:
+                    logger.info("Refrescador detenido correctamente")
+            self.db_metadata.on_ddl = None
+        else:
             logger.warning("El refrescador no está en ejecución")
-            return
-            
-        self.running = False
-        if self.thread:
-            self.thread.join(timeout=1.0)
-            logger.info("Refrescador detenido correctamente")
-    
-    def _refresh_loop(self):
-        """Bucle principal que ejecuta la actualización periódica"""
+        self.next_run = None
+
+        # Se libera la lease para que otro worker tome el relevo sin esperar a que caduque
+        if self.leader:
+            self.db_metadata.snapshot_store.liberar_lease(
+                self.db_metadata.lease_name("refresher"), self.db_metadata.process_id
+            )
+            self.leader = False
+
+    def _wake(self):
+        """Despierta la tarea; se puede llamar desde cualquier hilo"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    def notify_ddl(self, tables=()):
+        """Un DDL ejecutado por el servicio adelanta la siguiente comprobación y cuenta como cambio"""
+        self._ddl_pending = True
+        self._wake()
+
+    def _is_leader(self):
+        """Toma o renueva la lease del refrescador (siempre líder si no hay estado compartido)"""
+        if not self.db_metadata.is_shared():
+            return True
+        leader = self.db_metadata.snapshot_store.adquirir_lease(
+            self.db_metadata.lease_name("refresher"), self.db_metadata.process_id, self.lease_ttl
+        )
+        if leader != self.leader:
+            logger.info("Este worker es el refrescador de metadatos" if leader
+                        else "Otro worker refresca los metadatos; se seguirá el snapshot compartido")
+        self.leader = leader
+        return leader
+
+    async def _run(self):
+        """Bucle de la tarea: espera el periodo (o un aviso), comprueba y recalcula el periodo"""
+        delay = self.next_delay(time.time(), False)
         while self.running:
-            # Esperar hasta el próximo intervalo
-            time.sleep(min(10, self.interval))  # Comprobamos cada 10 segundos como máximo
-            
-            # Verificar si ha pasado el intervalo completo
-            current_time = time.time()
-            if current_time - self.last_refresh >= self.interval:
-                try:
-                    logger.info("Iniciando actualización periódica de metadatos")
-                    # Verificar cambios antes de actualizar completamente
-                    if self.db_metadata.has_schema_changed():
-                        self.db_metadata.refresh_metadata()
-                        logger.info("Metadatos actualizados por detección de cambios")
-                    else:
-                        logger.info("No se detectaron cambios en el esquema, omitiendo actualización completa")
-                    
-                    self.last_refresh = current_time
-                except Exception as e:
-                    logger.error(f"Error en actualización periódica de metadatos: {e}")
-    
+            self.next_run = time.time() + delay
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            if not self.running:
+                break
+
+            ddl, self._ddl_pending = self._ddl_pending, False
+            changed = False
+            inicio = time.perf_counter()
+            try:
+                # La comprobación hace E/S síncrona: se ejecuta fuera del bucle de eventos
+                changed = await asyncio.to_thread(self.tick, time.time())
+            except Exception as e:
+                logger.error(f"Error en actualización periódica de metadatos: {e}")
+            self.last_check_duration = time.perf_counter() - inicio
+            delay = self.next_delay(time.time(), changed or ddl)
+
+    def next_delay(self, current_time, changed):
+        """Periodo hasta la próxima comprobación según los cambios vistos en la ventana"""
+        if changed:
+            self.changes.append(current_time)
+        while self.changes and current_time - self.changes[0] > self.window:
+            self.changes.popleft()
+
+        if self.db_metadata.change_detection == "information_schema":
+            base, floor = self.token_interval, self.min_interval
+        else:
+            # La huella completa (SHOW CREATE por tabla) es cara: nunca más a menudo que el token
+            base, floor = self.interval, max(self.min_interval, self.token_interval)
+        if changed:
+            period = floor
+        else:
+            # Con k cambios recientes se apunta a base/k; sin ninguno, al techo. Se llega doblando
+            target = max(floor, base / len(self.changes)) if self.changes else self.interval
+            target = min(target, self.interval)
+            period = min(target, self.period * 2) if self.period < target else target
+        if self.db_metadata.is_shared():
+            # El líder tiene que renovar la lease antes de que caduque
+            period = min(period, self.lease_ttl / 2)
+        self.period = period
+        return period * self._azar.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def tick(self, current_time):
+        """Una comprobación del refrescador; devuelve True si el esquema cambió"""
+        self.last_check = current_time
+        if not self._is_leader():
+            if self.db_metadata.sync_from_store():
+                logger.info("Metadatos recargados del snapshot compartido")
+                self.last_refresh = current_time
+                return True
+            return False
+
+        if self.db_metadata.change_detection == "information_schema":
+            changed = self.db_metadata.poll_change_token()
+        else:
+            changed = self.db_metadata.has_schema_changed()
+        if not changed:
+            return False
+
+        inicio = time.perf_counter()
+        self.db_metadata.refresh_metadata()
+        self.last_refresh = current_time
+        self.last_refresh_duration = time.perf_counter() - inicio
+        logger.info(f"Metadatos actualizados por cambio en el esquema ({self.last_refresh_duration:.2f}s)")
+        return True
+
     def force_refresh(self):
         """Fuerza una actualización inmediata de los metadatos"""
         try:
+            inicio = time.perf_counter()
             result = self.db_metadata.refresh_metadata()
             self.last_refresh = time.time()
+            self.last_refresh_duration = time.perf_counter() - inicio
             return result
         except Exception as e:
             logger.error(f"Error al forzar actualización de metadatos: {e}")
             return False
-    
+
     def set_interval(self, seconds):
-        """Cambia el intervalo de actualización"""
+        """Cambia el intervalo máximo entre comprobaciones"""
         if seconds < 60:
             logger.warning(f"Intervalo demasiado corto ({seconds}s), estableciendo mínimo de 60s")
             seconds = 60
-        
+
         self.interval = seconds
+        self.period = min(self.period, seconds)
+        self._wake()
         logger.info(f"Intervalo de actualización cambiado a {seconds} segundos")
-        return True
\ No newline at end of file
+        return True
+
+    def get_stats(self):
+        """Estado del refrescador: periodo actual, últimas comprobaciones y próxima ejecución"""
+        def fecha(instante):
+            return datetime.fromtimestamp(instante).isoformat() if instante is not None else None
+
+        return {
+            'running': self.running,
+            'leader': self.leader,
+            'interval': round(self.period, 3),
+            'max_interval': self.interval,
+            'recent_changes': len(self.changes),
+            'last_check': fecha(self.last_check),
+            'last_check_duration': self.last_check_duration,
+            'last_refresh': fecha(self.last_refresh),
+            'last_refresh_duration': self.last_refresh_duration,
+            'next_run': fecha(self.next_run),
+        }
@@ -1,67 +1,155 @@
+import contextvars
+import hashlib
 import logging
+import os
+import queue
+import random
+import threading
 import time
-import json
-from functools import wraps
-from fastapi import Request
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler
+from .config import ACCESS_LOG_PATH, ACCESS_LOG_SAMPLE_RATE, ACCESS_LOG_MAX_PAYLOAD
+from .serialization import dumps
 
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("nl2sql.access")
 
-def log_api_request(func):
+# Resumen de la petición en curso que rellenan los endpoints (filas, hash del SQL...)
+_resumen = contextvars.ContextVar("resumen_acceso", default=None)
+
+def anotar_acceso(**campos):
+    """Añade campos al registro de acceso de la petición en curso (si lo hay)"""
+    resumen = _resumen.get()
+    if resumen is not None:
+        resumen.update(campos)
+
+def hash_sql(sql):
+    return hashlib.sha256(sql.encode("utf-8")).hexdigest()[:16]
+
+
+class _QueueHandlerSinFormato(QueueHandler):
+    """QueueHandler que encola el registro tal cual: el formateo ocurre fuera del camino de la petición"""
+    def prepare(self, record):
+        return record
+
+
+class EscritorEnLotes(threading.Thread):
+    """
+    Hilo que vacía la cola del log de acceso cada `intervalo` segundos y escribe todos
+    los registros pendientes con una sola escritura. Entre lotes duerme, así que no
+    compite por el GIL con las peticiones en cada registro.
+    """
+    _FIN = object()
+
+    def __init__(self, cola, ruta, intervalo=0.25):
+        super().__init__(name="access-log", daemon=True)
+        self.cola = cola
+        self.ruta = ruta
+        self.intervalo = intervalo
+
+    def _linea(self, record):
+        if isinstance(record.msg, dict):
+            return dumps(record.msg) + b"\n"
+        return record.getMessage().encode("utf-8") + b"\n"
+
+    def run(self):
+        with open(self.ruta, "ab") as fichero:
+            terminar = False
+            while not terminar:
+                time.sleep(self.intervalo)
+                lineas = []
+                while True:
+                    try:
+                        record = self.cola.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is self._FIN:
+                        terminar = True
+                        break
+                    try:
+                        lineas.append(self._linea(record))
+                    except Exception as e:
+                        logger.error(f"No se pudo serializar un registro de acceso: {e}")
+                if lineas:
+                    fichero.write(b"".join(lineas))
+                    fichero.flush()
+
+    def stop(self):
+        self.cola.put(self._FIN)
+        self.join(timeout=5)
+
+
+def configurar_log_acceso(ruta=ACCESS_LOG_PATH):
+    """Conecta el logger de acceso a una cola y arranca el hilo que escribe en el fichero"""
+    directorio = os.path.dirname(ruta)
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+
+    cola = queue.SimpleQueue()
+    access_logger.handlers = [_QueueHandlerSinFormato(cola)]
+    access_logger.setLevel(logging.INFO)
+    access_logger.propagate = False
+
+    escritor = EscritorEnLotes(cola, ruta)
+    escritor.start()
+    return escritor
+
+
+class AccessLogMiddleware:
     """
-    Decorador que intercepta y registra toda la información de una solicitud
-    a la API antes de procesarla.
+    Middleware ASGI que escribe un registro JSON por petición: método, ruta, estado,
+    duración, bytes de la respuesta y el resumen que anotan los endpoints (filas,
+    hash del SQL, origen de caché). Solo una fracción sample_rate de las peticiones
+    guarda los payloads, truncados a max_payload bytes.
     """
-    @wraps(func)
-    async def wrapper(req: Request, *args, **kwargs):
-        # Registrar tiempo de inicio
-        start_time = time.time()
-        
-        # Obtener la ruta de la solicitud
-        path = req.url.path
-        
-        # Obtener los datos de la solicitud
+    def __init__(self, app, sample_rate=ACCESS_LOG_SAMPLE_RATE, max_payload=ACCESS_LOG_MAX_PAYLOAD):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.max_payload = max_payload
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        inicio = time.perf_counter()
+        muestreada = self.sample_rate > 0 and random.random() < self.sample_rate
+        resumen = {}
+        token = _resumen.set(resumen)
+        estado = {"status": 500, "bytes": 0}
+        cuerpo_peticion = bytearray()
+        cuerpo_respuesta = bytearray()
+
+        async def receive_con_captura():
+            mensaje = await receive()
+            if mensaje["type"] == "http.request" and len(cuerpo_peticion) < self.max_payload:
+                cuerpo_peticion.extend(mensaje.get("body", b"")[:self.max_payload - len(cuerpo_peticion)])
+            return mensaje
+
+        async def send_con_conteo(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado["status"] = mensaje["status"]
+            elif mensaje["type"] == "http.response.body":
+                cuerpo = mensaje.get("body", b"")
+                estado["bytes"] += len(cuerpo)
+                if muestreada and len(cuerpo_respuesta) < self.max_payload:
+                    cuerpo_respuesta.extend(cuerpo[:self.max_payload - len(cuerpo_respuesta)])
+            await send(mensaje)
+
         try:
-            # Clonar el cuerpo de la solicitud
-            body_bytes = await req.body()
-            # Restaurar el cuerpo para que la función original pueda leerlo
-            req._body = body_bytes
-            
-            # Intentar decodificar como JSON
-            try:
-                body = json.loads(body_bytes.decode())
-            except json.JSONDecodeError:
-                body = body_bytes.decode()
-                
-            # Registrar los detalles de la solicitud
-            logger.info(f"API Request: {path}")
-            logger.info(f"Request Body: {json.dumps(body, ensure_ascii=False)}")
-            
-            # Capturar información del contexto de base de datos
-            db_context = {
-                "current_db": kwargs.get("metadata_manager", {}).schema_info.get("current_db", "unknown"),
-                "tables_count": len(kwargs.get("metadata_manager", {}).schema_info.get("tables", {})),
-                "has_schema_changed": kwargs.get("metadata_manager", {}).has_schema_changed()
+            await self.app(scope, receive_con_captura if muestreada else receive, send_con_conteo)
+        finally:
+            _resumen.reset(token)
+            registro = {
+                "ts": datetime.now(timezone.utc).isoformat(),
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": estado["status"],
+                "duration_ms": round((time.perf_counter() - inicio) * 1000, 2),
+                "bytes": estado["bytes"],
+                **resumen
             }
-            logger.info(f"DB Context: {json.dumps(db_context, ensure_ascii=False)}")
-            
-        except Exception as e:
-            logger.error(f"Error al interceptar solicitud: {e}")
-        
-        # Ejecutar la función original
-        response = await func(*args, **kwargs)
-        
-        # Registrar tiempo de finalización y duración
-        end_time = time.time()
-        duration = end_time - start_time
-        
-        # Registrar respuesta y duración
-        try:
-            logger.info(f"API Response: {json.dumps(response, ensure_ascii=False)}")
-        except:
-            logger.info("No se pudo serializar la respuesta para el log")
-            
-        logger.info(f"Request Duration: {duration:.2f}s")
-        
-        return response
-    
-    return wrapper
\ No newline at end of file
+            if muestreada:
+                registro["request_body"] = cuerpo_peticion.decode("utf-8", "replace")
+                registro["response_body"] = cuerpo_respuesta.decode("utf-8", "replace")
+            access_logger.info(registro)
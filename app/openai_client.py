@@ -1,5 +1,21 @@
-from openai import OpenAI
-from .config import OPENAI_API_KEY
+from openai import OpenAI, AsyncOpenAI
+from .llm_gateway import LLMGateway
+from .config import OPENAI_API_KEY, CACHE_EMBEDDING_MODEL, LLM_TIMEOUT, LLM_MAX_RETRIES
 
 def preparar_modelo():
-    return OpenAI(api_key=OPENAI_API_KEY)
+    # Camino síncrono: plazo y reintentos (exponenciales con jitter) del propio SDK
+    return OpenAI(api_key=OPENAI_API_KEY, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES)
+
+def preparar_modelo_async():
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=LLM_TIMEOUT)
+
+def preparar_gateway_async(client=None):
+    """Pasarela con plazos, reintentos, límites, circuito y enrutado de modelos sobre el cliente AsyncOpenAI"""
+    return LLMGateway(client or preparar_modelo_async())
+
+def preparar_embedder_async(client, model=CACHE_EMBEDDING_MODEL):
+    """Devuelve una corrutina texto -> embedding usando el cliente AsyncOpenAI"""
+    async def embed(texto):
+        respuesta = await client.embeddings.create(model=model, input=texto)
+        return respuesta.data[0].embedding
+    return embed
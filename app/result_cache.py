@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+import sqlglot
+from sqlglot import exp
+from sqlalchemy import text, bindparam
+from .serialization import dumps
+from .config import (
+    RESULT_CACHE_MAX_BYTES, RESULT_CACHE_MAX_ENTRY_BYTES, RESULT_CACHE_TTL, RESULT_CACHE_VALIDATION,
+    RESULT_CACHE_VERSION_TTL
+)
+
+logger = logging.getLogger(__name__)
+
+# Funciones cuyo resultado cambia entre ejecuciones aunque no cambien los datos
+_NO_DETERMINISTAS = {
+    "NOW", "SYSDATE", "CURDATE", "CURTIME", "CURRENT_DATE", "CURRENT_TIME", "CURRENT_TIMESTAMP", "LOCALTIME",
+    "LOCALTIMESTAMP", "UTC_DATE", "UTC_TIME", "UTC_TIMESTAMP", "UNIX_TIMESTAMP", "RAND", "UUID", "UUID_SHORT",
+    "CONNECTION_ID", "LAST_INSERT_ID", "FOUND_ROWS", "ROW_COUNT", "USER", "CURRENT_USER", "SESSION_USER",
+    "SYSTEM_USER", "DATABASE", "SLEEP", "GET_LOCK", "BENCHMARK"
+}
+
+# Versión de cada tabla según information_schema; `reciente` indica una escritura en el último segundo
+# (UPDATE_TIME tiene resolución de segundos: otra escritura en ese mismo segundo no la movería)
+_VERSIONES_QUERY = text("""
+    SELECT TABLE_NAME, UPDATE_TIME, UPDATE_TIME >= NOW() - INTERVAL 1 SECOND
+      FROM information_schema.TABLES
+     WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN :tablas
+""").bindparams(bindparam("tablas", expanding=True))
+
+# clave: (SQL normalizado, formato, offset); versiones: {tabla: versión} leídas antes de ejecutar;
+# generaciones: invalidaciones locales vistas al buscar (si cambian al guardar, el resultado puede ser viejo)
+Consulta = namedtuple("Consulta", ["clave", "tablas", "versiones", "generaciones", "fingerprint", "cacheable"])
+
+
+def analizar_sql(sql):
+    """
+    (SQL normalizado, tablas que lee) si la sentencia es una única lectura determinista
+    sobre tablas de la base de datos actual; None si su resultado no se puede cachear.
+    """
+    try:
+        sentencias = [s for s in sqlglot.parse(sql, read="mysql") if s is not None]
+    except sqlglot.errors.ParseError:
+        return None
+    if len(sentencias) != 1 or not isinstance(sentencias[0], exp.Query):
+        return None
+    arbol = sentencias[0]
+    if arbol.find(exp.Lock) is not None or arbol.args.get("locks"):
+        return None
+    for funcion in arbol.find_all(exp.Func):
+        nombre = funcion.name if isinstance(funcion, exp.Anonymous) else funcion.sql_name()
+        if nombre.upper() in _NO_DETERMINISTAS:
+            return None
+
+    ctes = {cte.alias for cte in arbol.find_all(exp.CTE)}
+    tablas = set()
+    for tabla in arbol.find_all(exp.Table):
+        if tabla.db:
+            return None  # Otra base de datos: sus versiones no se consultan
+        if tabla.name and tabla.name not in ctes:
+            tablas.add(tabla.name)
+    if not tablas:
+        return None
+    return arbol.sql(dialect="mysql"), frozenset(tablas)
+
+
+class ResultCache:
+    """
+    Caché de resultados de SQL de solo lectura, por sentencia normalizada.
+
+    Cada entrada recuerda las tablas que lee y su versión cuando se ejecutó: deja de
+    valer si se mueve el UPDATE_TIME (o el CHECKSUM TABLE) de alguna, si una sentencia
+    DDL/DML que pasa por el servicio toca alguna de ellas o si cambia la huella del
+    esquema. Las versiones se consultan como mucho cada `version_ttl` segundos por tabla.
+    La expulsión es LRU acotada por bytes (tamaño de la respuesta serializada) y las
+    entradas caducan a los `ttl` segundos en cualquier caso.
+    """
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, max_entry_bytes=RESULT_CACHE_MAX_ENTRY_BYTES,
+                 ttl=RESULT_CACHE_TTL, validation=RESULT_CACHE_VALIDATION, version_ttl=RESULT_CACHE_VERSION_TTL):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.validation = validation
+        self.version_ttl = version_ttl
+        self.fingerprint = None
+        self.bytes = 0
+        self._entries = OrderedDict()   # clave -> (respuesta, tablas, versiones, tamaño, expira)
+        self._por_tabla = {}            # tabla -> {claves}
+        self._versiones = {}            # tabla -> (versión, reciente, comprobada_en)
+        self._generaciones = {}         # tabla -> invalidaciones locales (None: vaciado completo)
+        self._analisis = OrderedDict()  # SQL tal cual -> analizar_sql(sql)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'uncacheable': 0, 'evictions': 0, 'invalidations': 0}
+
+    def _analizar(self, sql):
+        with self._lock:
+            if sql in self._analisis:
+                self._analisis.move_to_end(sql)
+                return self._analisis[sql]
+        analisis = analizar_sql(sql)
+        with self._lock:
+            self._analisis[sql] = analisis
+            while len(self._analisis) > 1024:
+                self._analisis.popitem(last=False)
+        return analisis
+
+    def _leer_versiones(self, engine, tablas):
+        """{tabla: (versión, reciente)} según el modo de validación, reutilizando las lecturas recientes"""
+        if self.validation == "none" or engine.url.get_backend_name() not in ("mysql", "mariadb"):
+            return {tabla: (None, False) for tabla in tablas}
+        ahora = time.monotonic()
+        with self._lock:
+            versiones = {
+                tabla: entrada[:2] for tabla in tablas
+                if (entrada := self._versiones.get(tabla)) is not None and ahora - entrada[2] < self.version_ttl
+            }
+        pendientes = sorted(set(tablas) - set(versiones))
+        if not pendientes:
+            return versiones
+
+        leidas = {tabla: (None, False) for tabla in pendientes}
+        with engine.connect() as conn:
+            if self.validation == "checksum":
+                preparer = engine.dialect.identifier_preparer
+                filas = conn.execute(text("CHECKSUM TABLE " + ", ".join(preparer.quote(t) for t in pendientes)))
+                for tabla, fila in zip(pendientes, filas):
+                    leidas[tabla] = (fila[1], False)
+            else:
+                try:
+                    # En MySQL 8 information_schema cachea UPDATE_TIME durante horas salvo que se desactive
+                    conn.execute(text("SET SESSION information_schema_stats_expiry = 0"))
+                except Exception:
+                    pass
+                for nombre, actualizada, reciente in conn.execute(_VERSIONES_QUERY, {"tablas": pendientes}):
+                    leidas[nombre] = (str(actualizada) if actualizada is not None else None, bool(reciente))
+        with self._lock:
+            for tabla, (version, reciente) in leidas.items():
+                self._versiones[tabla] = (version, reciente, ahora)
+        return {**versiones, **leidas}
+
+    def _check_fingerprint(self, fingerprint):
+        """Vacía la caché si la huella del esquema ha cambiado (debe llamarse con el lock tomado)"""
+        if fingerprint != self.fingerprint:
+            if self._entries:
+                self.stats['invalidations'] += 1
+                logger.info("Huella del esquema cambiada, invalidando caché de resultados")
+            self._vaciar()
+            self.fingerprint = fingerprint
+
+    def _generaciones_de(self, tablas):
+        return {tabla: self._generaciones.get(tabla, 0) for tabla in (None, *tablas)}
+
+    def _vaciar(self):
+        self._generaciones[None] = self._generaciones.get(None, 0) + 1
+        self._entries.clear()
+        self._por_tabla.clear()
+        self._versiones.clear()
+        self.bytes = 0
+
+    def _quitar(self, clave):
+        respuesta, tablas, versiones, tamanio, expira = self._entries.pop(clave)
+        self.bytes -= tamanio
+        for tabla in tablas:
+            claves = self._por_tabla.get(tabla)
+            if claves is not None:
+                claves.discard(clave)
+                if not claves:
+                    del self._por_tabla[tabla]
+
+    def buscar(self, engine, sql, formato=None, offset=0, fingerprint=None):
+        """
+        Devuelve (respuesta, consulta): la respuesta cacheada (una copia) o None, y la
+        Consulta que hay que pasar a guardar() tras ejecutar el SQL en caso de fallo.
+        """
+        analisis = self._analizar(sql)
+        if analisis is None:
+            with self._lock:
+                self.stats['uncacheable'] += 1
+            return None, None
+        sql_normalizado, tablas = analisis
+        clave = (sql_normalizado, formato, offset)
+
+        try:
+            versiones = self._leer_versiones(engine, tablas)
+        except Exception as e:
+            logger.warning(f"No se pudieron leer las versiones de {sorted(tablas)}: {e}")
+            with self._lock:
+                self.stats['uncacheable'] += 1
+            return None, None
+        # Con una escritura en el último segundo la versión no es fiable: se ejecuta y no se guarda
+        cacheable = not any(reciente for _, reciente in versiones.values())
+        versiones = {tabla: version for tabla, (version, _) in versiones.items()}
+
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            entrada = self._entries.get(clave)
+            if entrada is not None:
+                if entrada[4] >= time.monotonic() and entrada[2] == versiones:
+                    self._entries.move_to_end(clave)
+                    self.stats['hits'] += 1
+                    return dict(entrada[0]), None
+                self._quitar(clave)
+            self.stats['misses'] += 1
+            generaciones = self._generaciones_de(tablas)
+        return None, Consulta(clave, tablas, versiones, generaciones, fingerprint, cacheable)
+
+    def guardar(self, consulta, respuesta):
+        """Guarda la respuesta de una consulta sin error si cabe y sus tablas no han cambiado entretanto"""
+        if consulta is None or not consulta.cacheable or "error" in respuesta:
+            return
+        tamanio = len(dumps(respuesta))
+        if tamanio > self.max_entry_bytes:
+            return
+        with self._lock:
+            # Una invalidación durante la ejecución: el resultado puede no reflejarla
+            if consulta.fingerprint != self.fingerprint or consulta.generaciones != self._generaciones_de(consulta.tablas):
+                return
+            if consulta.clave in self._entries:
+                self._quitar(consulta.clave)
+            self._entries[consulta.clave] = (
+                respuesta, consulta.tablas, consulta.versiones, tamanio, time.monotonic() + self.ttl
+            )
+            self.bytes += tamanio
+            for tabla in consulta.tablas:
+                self._por_tabla.setdefault(tabla, set()).add(consulta.clave)
+            while self.bytes > self.max_bytes and self._entries:
+                self._quitar(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def invalidar(self, tablas=None):
+        """Descarta los resultados que leen alguna de las tablas (todos si no se saben las tablas)"""
+        with self._lock:
+            self.stats['invalidations'] += 1
+            if not tablas:
+                self._vaciar()
+                return
+            for tabla in tablas:
+                self._versiones.pop(tabla, None)
+                self._generaciones[tabla] = self._generaciones.get(tabla, 0) + 1
+                for clave in list(self._por_tabla.get(tabla, ())):
+                    self._quitar(clave)
+
+    def clear(self):
+        with self._lock:
+            self._vaciar()
+
+    def get_stats(self):
+        with self._lock:
+            consultas = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': self.stats['hits'] / consultas if consultas else 0.0,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes
+            }
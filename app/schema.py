@@ -2,3 +2,6 @@ from pydantic import BaseModel
 
 class PreguntaRequest(BaseModel):
     pregunta: str
+
+class PreguntasLoteRequest(BaseModel):
+    preguntas: list[str]
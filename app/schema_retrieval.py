@@ -0,0 +1,216 @@
+import logging
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+from .config import SCHEMA_TOP_K, SCHEMA_EMBEDDING_MODEL
+
+try:
+    import tiktoken
+except ImportError:  # Dependencia opcional: sin ella el conteo de tokens es una estimación
+    tiktoken = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # Dependencia opcional: sin ella solo se usa el índice léxico
+    SentenceTransformer = None
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+
+def contar_tokens(texto):
+    """Cuenta los tokens de un texto (con tiktoken si está instalado, si no ~4 caracteres por token)"""
+    global _encoding
+    if tiktoken is None:
+        return len(texto) // 4 + 1
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return len(_encoding.encode(texto))
+
+def _raiz(palabra):
+    """Stemming mínimo para que 'clientes', 'cliente' y 'client' coincidan"""
+    if len(palabra) > 3 and palabra.endswith("s"):
+        palabra = palabra[:-1]
+    if len(palabra) > 3 and palabra.endswith("e"):
+        palabra = palabra[:-1]
+    return palabra
+
+def tokenizar(texto):
+    """Separa texto e identificadores (snake_case, camelCase) en términos normalizados"""
+    texto = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(texto))
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return [_raiz(t) for t in re.split(r"[^a-z0-9]+", texto) if len(t) > 1]
+
+
+class SchemaRetriever:
+    """
+    Selecciona las tablas relevantes para una pregunta antes de construir el prompt.
+
+    Usa un índice BM25 sobre nombres de tabla y de columna y sobre los valores de ejemplo
+    de las tablas cuyo detalle ya está en memoria (opcionalmente combinado con embeddings
+    locales de los nombres) y añade a las top-k sus vecinas según
+    schema_info['relationships']. El índice se reconstruye cuando cambia la huella del
+    esquema; si solo cambian los valores conocidos se rehacen únicamente los documentos de
+    las tablas afectadas. Los embeddings se calculan solo con la huella.
+    """
+    def __init__(self, top_k=SCHEMA_TOP_K, embedding_model=SCHEMA_EMBEDDING_MODEL, k1=1.5, b=0.75):
+        self.top_k = top_k
+        self.k1 = k1
+        self.b = b
+        self.fingerprint = None
+        self.values_version = None
+        self._lock = threading.Lock()
+        # Índice publicado de una vez (con select_tables en hilos, rank lo lee sin lock):
+        # ({tabla: Counter de términos}, idf, longitud media, vecinas, {tabla: vector})
+        self._index = ({}, {}, 0.0, {}, {})
+        # Estado para actualizar el índice por tabla: términos de los nombres, valores indexados,
+        # frecuencia de documento de cada término y longitud total de los documentos
+        self._names = {}
+        self._values = {}
+        self._df = Counter()
+        self._total_len = 0
+        self._model = None
+        if embedding_model and SentenceTransformer is not None:
+            self._model = SentenceTransformer(embedding_model)
+        elif embedding_model:
+            logger.warning("sentence-transformers no está instalado; se usará solo el índice léxico")
+
+    @property
+    def bloqueante(self):
+        """Si seleccionar tablas calcula embeddings (CPU): entonces no debe hacerse en el event loop"""
+        return self._model is not None
+
+    def _documento(self, table_name, table_info):
+        terminos = tokenizar(table_name) * 3  # El nombre de la tabla pesa más que el resto
+        for column in table_info.columns:
+            terminos += tokenizar(column.name) * 2
+        return terminos
+
+    def _con_valores(self, table_name, table_values):
+        terminos = list(self._names[table_name])
+        for column_values in (table_values or {}).values():
+            for value in column_values:
+                terminos += tokenizar(value)
+        return Counter(terminos)
+
+    def _idf(self, freq, n):
+        return math.log(1 + (n - freq + 0.5) / (freq + 0.5))
+
+    def build(self, schema_info, fingerprint, known_values=None):
+        """
+        (Re)construye el índice si ha cambiado la huella del esquema; si solo han cambiado los
+        valores conocidos, actualiza los documentos de sus tablas. known_values es (versión,
+        {tabla: {columna: valores}}) o None.
+        """
+        version, values = known_values or (None, {})
+        with self._lock:
+            same_schema = fingerprint is not None and fingerprint == self.fingerprint
+            if same_schema and version == self.values_version:
+                return
+            if same_schema:
+                self._actualizar_valores(values)
+            else:
+                self._reconstruir(schema_info, values)
+            self.values_version = version
+            self.fingerprint = fingerprint
+
+    def _reconstruir(self, schema_info, values):
+        """Índice completo para un esquema nuevo (con el lock tomado)"""
+        self._names = {
+            table_name: self._documento(table_name, table_info)
+            for table_name, table_info in schema_info.get('tables', {}).items()
+        }
+        self._values = {table_name: values.get(table_name) for table_name in self._names}
+        docs = {table_name: self._con_valores(table_name, self._values[table_name]) for table_name in self._names}
+        n = len(docs) or 1
+        self._df = Counter(term for doc in docs.values() for term in doc)
+        self._total_len = sum(sum(doc.values()) for doc in docs.values())
+        idf = {term: self._idf(freq, n) for term, freq in self._df.items()}
+
+        neighbours = {}
+        for rel in schema_info.get('relationships', []):
+            neighbours.setdefault(rel['table'], set()).add(rel['referenced_table'])
+            neighbours.setdefault(rel['referenced_table'], set()).add(rel['table'])
+        table_vectors = {}
+        if self._model is not None:
+            texts = [f"{name}: " + " ".join(terminos) for name, terminos in self._names.items()]
+            vectors = self._model.encode(texts, normalize_embeddings=True)
+            table_vectors = dict(zip(self._names, vectors))
+
+        self._index = (docs, idf, self._total_len / n, neighbours, table_vectors)
+
+    def _actualizar_valores(self, values):
+        """
+        Rehace solo los documentos de las tablas cuyos valores conocidos cambiaron y el idf de
+        sus términos (con el lock tomado): cargar el detalle de una tabla no recorre el esquema.
+        """
+        docs, idf, _, neighbours, table_vectors = self._index
+        changed = [name for name in self._names if values.get(name) != self._values.get(name)]
+        if not changed:
+            return
+        docs, idf = dict(docs), dict(idf)
+        n = len(docs) or 1
+        terms = set()
+        for table_name in changed:
+            old = docs[table_name]
+            self._values[table_name] = values.get(table_name)
+            new = docs[table_name] = self._con_valores(table_name, self._values[table_name])
+            self._df.subtract(old.keys())
+            self._df.update(new.keys())
+            self._total_len += sum(new.values()) - sum(old.values())
+            terms |= old.keys() | new.keys()
+        for term in terms:
+            freq = self._df[term]
+            if freq > 0:
+                idf[term] = self._idf(freq, n)
+            else:
+                del self._df[term]
+                idf.pop(term, None)
+        self._index = (docs, idf, self._total_len / n, neighbours, table_vectors)
+
+    def rank(self, pregunta):
+        """Devuelve [(tabla, puntuación)] ordenado de más a menos relevante"""
+        docs, idf, avg_len, _, table_vectors = self._index
+        query = set(tokenizar(pregunta))
+        scores = {}
+        for table_name, doc in docs.items():
+            length = sum(doc.values())
+            score = 0.0
+            for term in query:
+                tf = doc.get(term)
+                if tf:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / (avg_len or 1))
+                    score += idf[term] * tf * (self.k1 + 1) / norm
+            scores[table_name] = score
+
+        if self._model is not None and table_vectors:
+            query_vector = self._model.encode([pregunta], normalize_embeddings=True)[0]
+            top = max(scores.values(), default=0.0) or 1.0
+            for table_name, vector in table_vectors.items():
+                # Se combina la puntuación BM25 normalizada con la similitud coseno
+                scores[table_name] = scores.get(table_name, 0.0) / top + float(query_vector @ vector)
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def select_tables(self, pregunta, schema_info, fingerprint, known_values=None):
+        """Tablas a incluir en el prompt, o None si no hace falta podar"""
+        tables = schema_info.get('tables', {})
+        if not self.top_k or len(tables) <= self.top_k:
+            return None
+
+        self.build(schema_info, fingerprint, known_values)
+        ranking = [(name, score) for name, score in self.rank(pregunta) if score > 0]
+        if not ranking:
+            logger.info("Ninguna tabla coincide con la pregunta; se usa el esquema completo")
+            return None
+
+        selected = [name for name, _ in ranking[:self.top_k]]
+        neighbours = self._index[3]
+        for name in list(selected):
+            for neighbour in sorted(neighbours.get(name, ())):
+                if neighbour not in selected:
+                    selected.append(neighbour)
+        return selected
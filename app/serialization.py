@@ -0,0 +1,73 @@
+from datetime import timedelta
+from decimal import Decimal
+import orjson
+from fastapi.responses import JSONResponse
+
+FORMATO_COLUMNAR = "columnar"
+MEDIA_TYPE_COLUMNAR = "application/vnd.nl2sql.columnar+json"
+
+def _por_defecto(valor):
+    """Tipos que orjson no serializa por sí mismo (datetime/date/time/UUID sí los trata de forma nativa)"""
+    if isinstance(valor, Decimal):
+        # Igual que el encoder de FastAPI: entero si no tiene decimales, float en otro caso
+        return int(valor) if valor.as_tuple().exponent >= 0 else float(valor)
+    if isinstance(valor, timedelta):
+        return valor.total_seconds()
+    if isinstance(valor, (bytes, bytearray, memoryview)):
+        return bytes(valor).decode("utf-8", "replace")
+    if isinstance(valor, (set, frozenset)):
+        return list(valor)
+    return str(valor)
+
+def dumps(contenido):
+    """Serializa a JSON (bytes) con orjson"""
+    return orjson.dumps(contenido, default=_por_defecto, option=orjson.OPT_NON_STR_KEYS)
+
+
+class RespuestaJSONRapida(JSONResponse):
+    """JSONResponse que serializa con orjson en lugar de jsonable_encoder + json.dumps"""
+    def render(self, content):
+        return dumps(content)
+
+
+def _nombre_tipo(valor):
+    if isinstance(valor, bool):
+        return "bool"
+    if isinstance(valor, int):
+        return "int"
+    if isinstance(valor, (float, Decimal)):
+        return "number"
+    if isinstance(valor, (bytes, bytearray, memoryview)):
+        return "bytes"
+    if hasattr(valor, "isoformat"):
+        return type(valor).__name__  # datetime, date, time
+    return "string"
+
+def inferir_tipos(filas, num_columnas):
+    """Tipo de cada columna según el primer valor no nulo que aparece"""
+    tipos = [None] * num_columnas
+    pendientes = num_columnas
+    for fila in filas:
+        if not pendientes:
+            break
+        for i, valor in enumerate(fila):
+            if tipos[i] is None and valor is not None:
+                tipos[i] = _nombre_tipo(valor)
+                pendientes -= 1
+    return [t or "null" for t in tipos]
+
+def a_columnar(columnas, filas):
+    """Resultado compacto: nombres de columna una sola vez y filas como listas"""
+    columnas = list(columnas)
+    filas = [tuple(fila) for fila in filas]
+    return {
+        "columnas": columnas,
+        "tipos": inferir_tipos(filas, len(columnas)),
+        "filas": filas
+    }
+
+def elegir_formato(format, accept):
+    """Formato de respuesta pedido por query (?format=columnar) o por cabecera Accept"""
+    if format == FORMATO_COLUMNAR or MEDIA_TYPE_COLUMNAR in (accept or ""):
+        return FORMATO_COLUMNAR
+    return None
@@ -0,0 +1,181 @@
+import logging
+import os
+import socket
+import time
+import uuid
+import orjson
+from .serialization import dumps
+from .snapshot import SchemaSnapshotStore
+from .config import SHARED_STATE_URL, SCHEMA_SNAPSHOT_PATH
+
+try:
+    import redis
+except ImportError:  # Dependencia opcional: sin ella el estado compartido usa SQLite
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+def identificador_proceso():
+    """Identificador único de este worker para las leases"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class SQLiteSharedState(SchemaSnapshotStore):
+    """
+    Estado compartido entre los workers de una misma máquina sobre el fichero SQLite
+    del snapshot: el snapshot del esquema (con su versión para detectar cambios),
+    leases para elegir un único refrescador y la caché pregunta -> SQL.
+    """
+    def __init__(self, path=SCHEMA_SNAPSHOT_PATH):
+        super().__init__(path)
+        with self._conectar() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (nombre TEXT PRIMARY KEY, duenio TEXT, expira REAL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS preguntas "
+                "(fingerprint TEXT, clave TEXT, sql TEXT, expira REAL, PRIMARY KEY (fingerprint, clave))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS preguntas_expira ON preguntas (expira)")
+
+    def adquirir_lease(self, nombre, duenio, ttl):
+        """Toma o renueva la lease si está libre, caducada o ya es nuestra; devuelve si la tenemos"""
+        ahora = time.time()
+        try:
+            with self._conectar() as conn:
+                cursor = conn.execute(
+                    "INSERT INTO leases (nombre, duenio, expira) VALUES (?, ?, ?) "
+                    "ON CONFLICT (nombre) DO UPDATE SET duenio = excluded.duenio, expira = excluded.expira "
+                    "WHERE leases.duenio = excluded.duenio OR leases.expira < ?",
+                    (nombre, duenio, ahora + ttl, ahora)
+                )
+                return cursor.rowcount == 1
+        except Exception as e:
+            logger.warning(f"No se pudo adquirir la lease {nombre}: {e}")
+            return False
+
+    def liberar_lease(self, nombre, duenio):
+        try:
+            with self._conectar() as conn:
+                conn.execute("DELETE FROM leases WHERE nombre = ? AND duenio = ?", (nombre, duenio))
+        except Exception as e:
+            logger.warning(f"No se pudo liberar la lease {nombre}: {e}")
+
+    def cache_get(self, clave, fingerprint):
+        try:
+            with self._conectar() as conn:
+                fila = conn.execute(
+                    "SELECT sql FROM preguntas WHERE fingerprint = ? AND clave = ? AND expira >= ?",
+                    (fingerprint, clave, time.time())
+                ).fetchone()
+            return fila[0] if fila else None
+        except Exception as e:
+            logger.warning(f"Error leyendo la caché compartida: {e}")
+            return None
+
+    def cache_put(self, clave, fingerprint, sql, ttl):
+        ahora = time.time()
+        try:
+            with self._conectar() as conn:
+                conn.execute("DELETE FROM preguntas WHERE expira < ?", (ahora,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO preguntas (fingerprint, clave, sql, expira) VALUES (?, ?, ?, ?)",
+                    (fingerprint, clave, sql, ahora + ttl)
+                )
+        except Exception as e:
+            logger.warning(f"Error escribiendo en la caché compartida: {e}")
+
+
+# Toma o renueva la lease de forma atómica: KEYS[1] = lease, ARGV = (dueño, ttl en ms)
+_LUA_ADQUIRIR = """
+local actual = redis.call('GET', KEYS[1])
+if not actual or actual == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+_LUA_LIBERAR = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisSharedState:
+    """Misma interfaz que SQLiteSharedState sobre Redis, para workers en varias máquinas"""
+    def __init__(self, url=SHARED_STATE_URL, prefijo="nl2sql"):
+        if redis is None:
+            raise RuntimeError("SHARED_STATE_URL apunta a Redis pero el paquete redis no está instalado")
+        self.prefijo = prefijo
+        self._redis = redis.Redis.from_url(url, decode_responses=False)
+        self._adquirir = self._redis.register_script(_LUA_ADQUIRIR)
+        self._liberar = self._redis.register_script(_LUA_LIBERAR)
+
+    def _clave(self, *partes):
+        return ":".join((self.prefijo,) + partes)
+
+    def cargar(self, clave):
+        try:
+            guardado, datos = self._redis.hmget(self._clave("snapshot", clave), "guardado", "datos")
+            if datos is None:
+                return None
+            snapshot = orjson.loads(datos)
+            snapshot['guardado'] = float(guardado)
+            return snapshot
+        except Exception as e:
+            logger.warning(f"No se pudo leer el snapshot del esquema de Redis: {e}")
+            return None
+
+    def version(self, clave):
+        try:
+            guardado = self._redis.hget(self._clave("snapshot", clave), "guardado")
+            return float(guardado) if guardado is not None else None
+        except Exception as e:
+            logger.warning(f"No se pudo leer la versión del snapshot de Redis: {e}")
+            return None
+
+    def guardar(self, clave, snapshot):
+        try:
+            guardado = time.time()
+            self._redis.hset(self._clave("snapshot", clave), mapping={"guardado": guardado, "datos": dumps(snapshot)})
+            return guardado
+        except Exception as e:
+            logger.warning(f"No se pudo guardar el snapshot del esquema en Redis: {e}")
+            return None
+
+    def adquirir_lease(self, nombre, duenio, ttl):
+        try:
+            return bool(self._adquirir(keys=[self._clave("lease", nombre)], args=[duenio, int(ttl * 1000)]))
+        except Exception as e:
+            logger.warning(f"No se pudo adquirir la lease {nombre}: {e}")
+            return False
+
+    def liberar_lease(self, nombre, duenio):
+        try:
+            self._liberar(keys=[self._clave("lease", nombre)], args=[duenio])
+        except Exception as e:
+            logger.warning(f"No se pudo liberar la lease {nombre}: {e}")
+
+    def cache_get(self, clave, fingerprint):
+        try:
+            sql = self._redis.get(self._clave("pregunta", fingerprint, clave))
+            return sql.decode("utf-8") if sql is not None else None
+        except Exception as e:
+            logger.warning(f"Error leyendo la caché compartida: {e}")
+            return None
+
+    def cache_put(self, clave, fingerprint, sql, ttl):
+        try:
+            self._redis.set(self._clave("pregunta", fingerprint, clave), sql, px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Error escribiendo en la caché compartida: {e}")
+
+
+def crear_estado_compartido(url=SHARED_STATE_URL, path=SCHEMA_SNAPSHOT_PATH):
+    """Redis si SHARED_STATE_URL es redis://..., si no SQLite local en SCHEMA_SNAPSHOT_PATH (None si está vacío)"""
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisSharedState(url)
+    if path:
+        return SQLiteSharedState(path)
+    return None
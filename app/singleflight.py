@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """
+    Agrupa llamadas asyncio concurrentes con la misma clave: solo la primera ejecuta
+    la corrutina y el resto espera y recibe su mismo resultado (o excepción).
+
+    La ejecución compartida corre en su propia tarea, así que si se cancela la petición
+    que la inició el resto de peticiones en espera no se ven afectadas.
+    """
+    def __init__(self, nombre="singleflight"):
+        self.nombre = nombre
+        self._en_vuelo = {}
+        self.ejecuciones = 0
+        self.compartidas = 0
+
+    async def do(self, clave, fn):
+        tarea = self._en_vuelo.get(clave)
+        if tarea is None:
+            self.ejecuciones += 1
+            tarea = asyncio.ensure_future(fn())
+            self._en_vuelo[clave] = tarea
+            tarea.add_done_callback(lambda t: self._liberar(clave, t))
+        else:
+            self.compartidas += 1
+            logger.debug(f"{self.nombre}: esperando ejecución en curso para {clave!r}")
+        return await asyncio.shield(tarea)
+
+    def _liberar(self, clave, tarea):
+        if self._en_vuelo.get(clave) is tarea:
+            del self._en_vuelo[clave]
+        # Evita el aviso "exception was never retrieved" si todos los que esperaban se cancelaron
+        if not tarea.cancelled():
+            tarea.exception()
+
+    def get_stats(self):
+        return {'ejecuciones': self.ejecuciones, 'compartidas': self.compartidas, 'en_vuelo': len(self._en_vuelo)}
+
+
+class SingleFlightSync:
+    """Equivalente de SingleFlight para llamadas bloqueantes desde varios hilos"""
+
+    class _Llamada:
+        __slots__ = ("hecho", "resultado", "error")
+
+        def __init__(self):
+            self.hecho = threading.Event()
+            self.resultado = None
+            self.error = None
+
+    def __init__(self, nombre="singleflight"):
+        self.nombre = nombre
+        self._lock = threading.Lock()
+        self._en_vuelo = {}
+        self.ejecuciones = 0
+        self.compartidas = 0
+
+    def do(self, clave, fn):
+        with self._lock:
+            llamada = self._en_vuelo.get(clave)
+            lider = llamada is None
+            if lider:
+                llamada = self._Llamada()
+                self._en_vuelo[clave] = llamada
+                self.ejecuciones += 1
+            else:
+                self.compartidas += 1
+
+        if not lider:
+            llamada.hecho.wait()
+        else:
+            try:
+                llamada.resultado = fn()
+            except BaseException as e:
+                llamada.error = e
+            finally:
+                with self._lock:
+                    del self._en_vuelo[clave]
+                llamada.hecho.set()
+
+        if llamada.error is not None:
+            raise llamada.error
+        return llamada.resultado
@@ -0,0 +1,85 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import orjson
+from .serialization import dumps
+from .config import SCHEMA_SNAPSHOT_PATH
+
+logger = logging.getLogger(__name__)
+
+
+def clave_snapshot(engine):
+    """Clave del snapshot: URL de la base de datos sin la contraseña"""
+    return engine.url.render_as_string(hide_password=True)
+
+
+class SchemaSnapshotStore:
+    """
+    Guarda en un fichero SQLite local el último schema_info (con su huella y la
+    descripción para el prompt) de cada base de datos, para poder servir peticiones
+    nada más arrancar y validar el esquema en segundo plano.
+    """
+    def __init__(self, path=SCHEMA_SNAPSHOT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        directorio = os.path.dirname(path)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        with self._conectar() as conn:
+            # WAL: varios procesos pueden leer mientras uno escribe
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots (clave TEXT PRIMARY KEY, guardado REAL, datos BLOB)"
+            )
+
+    @contextmanager
+    def _conectar(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:  # commit o rollback
+                yield conn
+        finally:
+            conn.close()
+
+    def cargar(self, clave):
+        """Devuelve el snapshot guardado para la clave, o None si no hay o no se puede leer"""
+        try:
+            with self._conectar() as conn:
+                fila = conn.execute("SELECT guardado, datos FROM snapshots WHERE clave = ?", (clave,)).fetchone()
+            if fila is None:
+                return None
+            snapshot = orjson.loads(fila[1])
+            snapshot['guardado'] = fila[0]
+            return snapshot
+        except Exception as e:
+            logger.warning(f"No se pudo leer el snapshot del esquema de {self.path}: {e}")
+            return None
+
+    def version(self, clave):
+        """Momento en que se guardó el snapshot de la clave (None si no hay): sirve para detectar cambios"""
+        try:
+            with self._conectar() as conn:
+                fila = conn.execute("SELECT guardado FROM snapshots WHERE clave = ?", (clave,)).fetchone()
+            return fila[0] if fila else None
+        except Exception as e:
+            logger.warning(f"No se pudo leer la versión del snapshot de {self.path}: {e}")
+            return None
+
+    def guardar(self, clave, snapshot):
+        """Sustituye el snapshot de la clave y devuelve su versión; los errores solo se registran"""
+        try:
+            datos = dumps(snapshot)
+            guardado = time.time()
+            with self._lock, self._conectar() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO snapshots (clave, guardado, datos) VALUES (?, ?, ?)",
+                    (clave, guardado, datos)
+                )
+            logger.info(f"Snapshot del esquema guardado ({len(datos)} bytes)")
+            return guardado
+        except Exception as e:
+            logger.warning(f"No se pudo guardar el snapshot del esquema en {self.path}: {e}")
+            return None
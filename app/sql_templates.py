@@ -0,0 +1,386 @@
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+import sqlglot
+from sqlglot import exp
+from .config import TEMPLATE_MAX_ENTRIES, TEMPLATE_TTL, TEMPLATE_MIN_SUPPORT
+
+logger = logging.getLogger(__name__)
+
+# Tipos de hueco: un número de la pregunta, un entero (LIMIT/OFFSET), un mes escrito con letra
+# (literal numérico 1-12) o un texto
+NUMERO = "numero"
+ENTERO = "entero"
+MES = "mes"
+TEXTO = "texto"
+
+MESES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7, "agosto": 8,
+    "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12
+}
+
+# Transformaciones de mayúsculas que convierten el texto de la pregunta en el literal del SQL
+_TRANSFORMACIONES = {
+    "igual": lambda texto: texto,
+    "minusculas": str.lower,
+    "mayusculas": str.upper,
+    "titulo": str.title,
+}
+
+_TOKEN = re.compile(r"\d+(?:[.,]\d+)*|\w+")
+# Números con los separadores del español: "." de miles y "," decimal ("1.000" es mil y "2,5" dos y medio)
+_NUMERO = re.compile(r"(\d{1,3}(?:\.\d{3})+|\d+)(?:,(\d+))?")
+
+# Hueco de la pregunta: posición del primer token, número de tokens y tipo
+Hueco = namedtuple("Hueco", ["inicio", "longitud", "tipo"])
+# arbol: SQL con marcadores h0, h1...; ligaduras: {marcador: (índice del hueco, tipo, formato)};
+# tokens: longitud de la pregunta; valores: tuplas de valores distintos con las que el modelo
+# ha generado esta misma plantilla; tablas: las que lee el SQL
+Plantilla = namedtuple("Plantilla", ["arbol", "sql", "ligaduras", "mascara", "tokens", "valores", "expira", "tablas"])
+
+
+def _normalizar(texto):
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+def _numero(token):
+    """Literal SQL del número escrito en la pregunta, o None si no es un número sin ambigüedad"""
+    coincidencia = _NUMERO.fullmatch(token)
+    if coincidencia is None:
+        return None  # "2.5": en español el punto solo separa miles
+    entero, decimales = coincidencia.groups()
+    entero = entero.replace(".", "")
+    return f"{entero}.{decimales}" if decimales else entero
+
+def _columna(literal):
+    """Nombre de la columna con la que se compara el literal (=, LIKE, IN...), o None"""
+    padre = literal.parent
+    if isinstance(padre, exp.In):
+        otro = padre.this
+    elif isinstance(padre, exp.Binary):
+        otro = padre.left if padre.right is literal else padre.right
+    else:
+        return None
+    return otro.name if isinstance(otro, exp.Column) else None
+
+def tokenizar(pregunta):
+    """[(token normalizado, inicio, fin)] con las posiciones en la pregunta original"""
+    return [(_normalizar(m.group()), m.start(), m.end()) for m in _TOKEN.finditer(pregunta)]
+
+def _posiciones(normalizados, objetivo):
+    n = len(objetivo)
+    return [i for i in range(len(normalizados) - n + 1) if normalizados[i:i + n] == objetivo]
+
+def _alinear(literal, pregunta, tokens, normalizados):
+    """
+    (Hueco, formato) del fragmento de la pregunta del que sale el literal; None si no sale
+    de ninguno y False si sale de varios (la alineación sería ambigua). El formato de un
+    texto lleva la columna con la que se compara.
+    """
+    if literal.is_string:
+        valor = literal.this
+        nucleo = valor.strip("%")
+        if not nucleo:
+            return None
+        prefijo, sufijo = valor[:valor.index(nucleo)], valor[valor.index(nucleo) + len(nucleo):]
+        objetivo = [t for t, _, _ in tokenizar(nucleo)]
+        if not objetivo:
+            return None
+        posiciones = _posiciones(normalizados, objetivo)
+        if len(posiciones) != 1:
+            return False if posiciones else None
+        inicio = posiciones[0]
+        texto = pregunta[tokens[inicio][1]:tokens[inicio + len(objetivo) - 1][2]]
+        for nombre, transformar in _TRANSFORMACIONES.items():
+            if transformar(texto) == nucleo:
+                return Hueco(inicio, len(objetivo), TEXTO), (prefijo, nombre, sufijo, _columna(literal))
+        return None
+
+    valor = literal.this
+    if isinstance(literal.parent, (exp.Limit, exp.Offset)):
+        # LIMIT y OFFSET solo admiten enteros
+        return _unico([Hueco(i, 1, ENTERO) for i, token in enumerate(normalizados) if _numero(token) == valor])
+    candidatos = [Hueco(i, 1, NUMERO) for i, token in enumerate(normalizados) if _numero(token) == valor]
+    if valor.isdigit() and 1 <= int(valor) <= 12:
+        candidatos += [Hueco(i, 1, MES) for i, token in enumerate(normalizados) if MESES.get(token) == int(valor)]
+    return _unico(candidatos)
+
+def _unico(candidatos):
+    if len(candidatos) != 1:
+        return False if candidatos else None
+    return candidatos[0], None
+
+def abstraer(pregunta, sql):
+    """
+    Abstrae un par pregunta -> SQL en (patrón, máscara, árbol, ligaduras, valores, número
+    de tokens de la pregunta, tablas del SQL): los literales del SQL que salen de un único fragmento de
+    la pregunta pasan a ser huecos. None si no hay ningún hueco, si el SQL no es una
+    única sentencia o si algún literal se puede alinear con más de un fragmento.
+    """
+    try:
+        sentencias = [s for s in sqlglot.parse(sql, read="mysql") if s is not None]
+    except sqlglot.errors.ParseError:
+        return None
+    if len(sentencias) != 1:
+        return None
+    tokens = tokenizar(pregunta)
+    normalizados = [t for t, _, _ in tokens]
+
+    huecos = []
+    ligaduras = {}
+    marcadores = {}
+    for literal in list(sentencias[0].find_all(exp.Literal)):
+        alineacion = _alinear(literal, pregunta, tokens, normalizados)
+        if alineacion is False:
+            return None
+        if alineacion is None:
+            continue
+        hueco, formato = alineacion
+        if hueco not in huecos:
+            fin = hueco.inicio + hueco.longitud
+            if any(h.inicio < fin and hueco.inicio < h.inicio + h.longitud for h in huecos):
+                return None  # Fragmentos solapados con tipos o longitudes distintos
+            huecos.append(hueco)
+        marcador = f"h{len(ligaduras)}"
+        ligaduras[marcador] = (hueco, hueco.tipo, formato)
+        marcadores[id(literal)] = marcador
+    if not huecos:
+        return None
+
+    huecos.sort()
+    mascara = tuple(huecos)
+    ligaduras = {marcador: (huecos.index(hueco), tipo, formato) for marcador, (hueco, tipo, formato) in ligaduras.items()}
+    arbol = sentencias[0].transform(
+        lambda nodo: exp.Placeholder(this=marcadores[id(nodo)]) if id(nodo) in marcadores else nodo, copy=False
+    )
+    valores = _valores(pregunta, tokens, mascara)
+    tablas = frozenset(tabla.name for tabla in arbol.find_all(exp.Table))
+    return _patron(normalizados, mascara), mascara, arbol, ligaduras, valores, len(tokens), tablas
+
+def _patron(normalizados, mascara):
+    """Tokens de la pregunta con cada hueco sustituido por su tipo y longitud"""
+    patron, posicion = [], 0
+    for hueco in mascara:
+        patron.extend(normalizados[posicion:hueco.inicio])
+        patron.append(f"<{hueco.tipo}:{hueco.longitud}>")
+        posicion = hueco.inicio + hueco.longitud
+    patron.extend(normalizados[posicion:])
+    return tuple(patron)
+
+def _encaja(normalizados, mascara):
+    """Si los tokens de cada hueco son del tipo que pide"""
+    for hueco in mascara:
+        if hueco.inicio + hueco.longitud > len(normalizados):
+            return False
+        token = normalizados[hueco.inicio]
+        if hueco.tipo == NUMERO and _numero(token) is None:
+            return False
+        if hueco.tipo == ENTERO and not (_numero(token) or "").isdigit():
+            return False
+        if hueco.tipo == MES and token not in MESES:
+            return False
+    return True
+
+def _valores(pregunta, tokens, mascara):
+    valores = []
+    for hueco in mascara:
+        primero, ultimo = tokens[hueco.inicio], tokens[hueco.inicio + hueco.longitud - 1]
+        if hueco.tipo in (NUMERO, ENTERO):
+            valores.append(_numero(primero[0]))
+        elif hueco.tipo == MES:
+            valores.append(str(MESES[primero[0]]))
+        else:
+            valores.append(pregunta[primero[1]:ultimo[2]])
+    return tuple(valores)
+
+def _ligar(plantilla, valores):
+    """SQL de la plantilla con los valores como literales (sqlglot los escapa al generar el SQL)"""
+    def literal(nodo):
+        if not isinstance(nodo, exp.Placeholder) or nodo.name not in plantilla.ligaduras:
+            return nodo
+        indice, tipo, formato = plantilla.ligaduras[nodo.name]
+        if tipo != TEXTO:
+            return exp.Literal.number(valores[indice])
+        prefijo, transformacion, sufijo, _ = formato
+        return exp.Literal.string(prefijo + _TRANSFORMACIONES[transformacion](valores[indice]) + sufijo)
+    return plantilla.arbol.transform(literal).sql(dialect="mysql")
+
+def _justificado(plantilla, valores, valores_conocidos):
+    """
+    Si cada texto a ligar ya salió en un ejemplo del modelo o es un valor conocido de su
+    columna: un texto cualquiera ("en total") no es necesariamente un valor del dato.
+    """
+    conocidos = valores_conocidos[1] if valores_conocidos else {}
+    for indice, tipo, formato in plantilla.ligaduras.values():
+        if tipo != TEXTO:
+            continue
+        valor = _normalizar(valores[indice])
+        if any(_normalizar(ejemplo[indice]) == valor for ejemplo in plantilla.valores):
+            continue
+        columna = formato[3]
+        columnas = (conocidos.get(tabla, {}).get(columna, ()) for tabla in plantilla.tablas) if columna else ()
+        if not any(_normalizar(conocido) == valor for valores_columna in columnas for conocido in valores_columna):
+            return False
+    return True
+
+
+class TemplateStore:
+    """
+    Plantillas pregunta -> SQL aprendidas de las respuestas del modelo.
+
+    Cada par que se ha ejecutado sin error se abstrae alineando los literales del SQL con
+    fragmentos de la pregunta ("ventas de marzo" -> MONTH(fecha) = 3). Una plantilla solo
+    se usa cuando el modelo ha generado el mismo SQL con `min_support` valores distintos;
+    entonces una pregunta que solo cambia esos valores se responde ligándolos al SQL sin
+    llamar al modelo. Los números se leen con los separadores del español, LIMIT y OFFSET
+    solo admiten enteros y un texto solo se liga si ya salió en un ejemplo o es un valor
+    conocido de su columna. Si el modelo genera otro SQL para el mismo patrón, o el SQL de una
+    plantilla falla, la plantilla vuelve a empezar. Expulsión LRU, TTL y vaciado si
+    cambia la huella del esquema.
+    """
+    def __init__(self, max_entries=TEMPLATE_MAX_ENTRIES, ttl=TEMPLATE_TTL, min_support=TEMPLATE_MIN_SUPPORT):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_support = min_support
+        self.fingerprint = None
+        self._plantillas = OrderedDict()  # patrón -> Plantilla
+        self._mascaras = {}               # número de tokens -> {máscara: plantillas que la usan}
+        self._lock = threading.Lock()
+        self.latencia = 0.0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'learned': 0,
+            'conflicts': 0,
+            'discarded': 0,
+            'evictions': 0,
+            'invalidations': 0
+        }
+
+    def _check_fingerprint(self, fingerprint):
+        """Vacía las plantillas si la huella del esquema ha cambiado (debe llamarse con el lock tomado)"""
+        if fingerprint != self.fingerprint:
+            if self._plantillas:
+                self.stats['invalidations'] += 1
+                logger.info("Huella del esquema cambiada, invalidando plantillas de SQL")
+            self._plantillas.clear()
+            self._mascaras.clear()
+            self.fingerprint = fingerprint
+
+    def _quitar(self, patron):
+        plantilla = self._plantillas.pop(patron)
+        mascaras = self._mascaras[plantilla.tokens]
+        mascaras[plantilla.mascara] -= 1
+        if not mascaras[plantilla.mascara]:
+            del mascaras[plantilla.mascara]
+
+    def _encontrar(self, normalizados, now):
+        """(patrón, plantilla activa) que encaja con los tokens, o (None, None) (con el lock tomado)"""
+        # Primero las máscaras con menos tokens en huecos: más tokens fijos, coincidencia más segura
+        mascaras = sorted(self._mascaras.get(len(normalizados), ()), key=lambda m: sum(h.longitud for h in m))
+        for mascara in mascaras:
+            if not _encaja(normalizados, mascara):
+                continue
+            patron = _patron(normalizados, mascara)
+            plantilla = self._plantillas.get(patron)
+            if plantilla is None or plantilla.mascara != mascara:
+                continue
+            if plantilla.expira < now:
+                self._quitar(patron)
+                continue
+            if len(plantilla.valores) >= self.min_support:
+                return patron, plantilla
+        return None, None
+
+    def get(self, pregunta, fingerprint, valores_conocidos=None):
+        """
+        SQL para la pregunta ligado a partir de una plantilla activa, o None. valores_conocidos
+        es (versión, {tabla: {columna: valores}}) como lo da DBMetadataManager.get_known_values().
+        """
+        inicio = time.perf_counter()
+        tokens = tokenizar(pregunta)
+        normalizados = [t for t, _, _ in tokens]
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            patron, plantilla = self._encontrar(normalizados, time.monotonic())
+            if plantilla is None:
+                self.stats['misses'] += 1
+                return None
+            self._plantillas.move_to_end(patron)
+
+        valores = _valores(pregunta, tokens, plantilla.mascara)
+        if not _justificado(plantilla, valores, valores_conocidos):
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+        try:
+            sql = _ligar(plantilla, valores)
+        except Exception as e:
+            logger.warning(f"No se pudo ligar la plantilla {plantilla.sql}: {e}")
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+        with self._lock:
+            self.stats['hits'] += 1
+            self.latencia += time.perf_counter() - inicio
+        return sql
+
+    def put(self, pregunta, fingerprint, sql):
+        """Aprende del SQL que el modelo generó para la pregunta y se ejecutó sin error"""
+        abstraccion = abstraer(pregunta, sql)
+        if abstraccion is None:
+            return
+        patron, mascara, arbol, ligaduras, valores, tokens, tablas = abstraccion
+        sql_plantilla = arbol.sql(dialect="mysql")
+        expira = time.monotonic() + self.ttl
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            anterior = self._plantillas.get(patron)
+            if anterior is not None and anterior.sql == sql_plantilla:
+                self._plantillas[patron] = anterior._replace(valores=anterior.valores | {valores}, expira=expira)
+                self._plantillas.move_to_end(patron)
+                return
+            if anterior is not None:
+                # El mismo patrón de pregunta ha dado otro SQL: la plantilla no era fiable
+                self.stats['conflicts'] += 1
+                self._quitar(patron)
+            self._plantillas[patron] = Plantilla(
+                arbol, sql_plantilla, ligaduras, mascara, tokens, frozenset([valores]), expira, tablas
+            )
+            mascaras = self._mascaras.setdefault(tokens, {})
+            mascaras[mascara] = mascaras.get(mascara, 0) + 1
+            self.stats['learned'] += 1
+            while len(self._plantillas) > self.max_entries:
+                self._quitar(next(iter(self._plantillas)))
+                self.stats['evictions'] += 1
+
+    def discard(self, pregunta, fingerprint):
+        """Descarta la plantilla que respondió a la pregunta (su SQL ha fallado al ejecutarse)"""
+        normalizados = [t for t, _, _ in tokenizar(pregunta)]
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            patron, plantilla = self._encontrar(normalizados, time.monotonic())
+            if plantilla is not None:
+                logger.warning(f"Descartada la plantilla {plantilla.sql}")
+                self._quitar(patron)
+                self.stats['discarded'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._plantillas.clear()
+            self._mascaras.clear()
+
+    def get_stats(self):
+        """Aciertos del camino rápido, su latencia media y plantillas activas"""
+        with self._lock:
+            consultas = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': self.stats['hits'] / consultas if consultas else 0.0,
+                'avg_latency_ms': self.latencia / self.stats['hits'] * 1000 if self.stats['hits'] else 0.0,
+                'templates': len(self._plantillas),
+                'active': sum(len(p.valores) >= self.min_support for p in self._plantillas.values())
+            }
@@ -0,0 +1,136 @@
+from sqlalchemy import text
+from contextlib import aclosing, nullcontext
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+import logging
+import time
+from .config import STREAM_CHUNK_SIZE
+from .serialization import dumps
+from .logic import generar_sql_stream, guardar_en_cache_async, tras_escritura
+from .telemetry import TIME_TO_FIRST, ETAPA_SQL, etapa, registrar_error_sql
+
+logger = logging.getLogger(__name__)
+
+def _linea(registro):
+    return dumps(registro) + b"\n"
+
+def leer_bloques(engine, sql, chunk_size=STREAM_CHUNK_SIZE, governor=None, cache_resultados=None, db_metadata=None):
+    """
+    Ejecuta el SQL con un cursor de servidor y produce {"columnas"}, bloques {"filas"}
+    de chunk_size filas y {"fin", "total_filas"} (o solo {"resultados"} si la sentencia
+    no devuelve filas). Con un QueryGovernor se comprueba el plan, la consulta lleva
+    tiempo máximo y no se leen más de max_rows filas ("fin" lleva entonces "limitado").
+    Una escritura invalida los resultados de sus tablas en la ResultCache y un DDL refresca
+    los metadatos de db_metadata, igual que en ejecutar_sql. Los errores se propagan a quien
+    consume.
+    """
+    tope = None
+    if governor is not None:
+        sql, tope = governor.preparar_stream(sql)
+    with engine.connect() as conn:
+        if governor is not None:
+            governor.comprobar_plan(conn, sql)
+        with governor.tiempo_limite(conn) if governor is not None else nullcontext():
+            resultado = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(text(sql))
+            if not resultado.returns_rows:
+                tras_escritura(sql, db_metadata, cache_resultados)
+                yield {"resultados": "Operación ejecutada exitosamente."}
+                return
+
+            yield {"columnas": list(resultado.keys())}
+            total = 0
+            for bloque in resultado.partitions(chunk_size):
+                if tope is not None and total + len(bloque) > tope:
+                    # Sin LIMIT reescribible (SQL que no se pudo analizar) el tope se aplica al leer
+                    bloque = bloque[:tope - total]
+                    total += len(bloque)
+                    if bloque:
+                        yield {"filas": [list(fila) for fila in bloque]}
+                    yield {"fin": True, "total_filas": total, "limitado": True}
+                    return
+                total += len(bloque)
+                yield {"filas": [list(fila) for fila in bloque]}
+            fin = {"fin": True, "total_filas": total}
+            if governor is not None:
+                fin["limitado"] = total >= governor.max_rows
+            yield fin
+
+def generar_ndjson(engine, sql, chunk_size=STREAM_CHUNK_SIZE, al_terminar=None, governor=None,
+                   cache_resultados=None, db_metadata=None, al_fallar=None):
+    """
+    Ejecuta el SQL con un cursor de servidor y emite NDJSON: primero una cabecera
+    {"sql", "columnas"} y después bloques {"filas": [[...], ...]} de chunk_size filas.
+
+    La memoria queda acotada a un bloque sea cual sea el tamaño del resultado. Si la
+    consulta falla se emite una línea {"error"} y se llama a al_fallar(); al_terminar() se
+    llama solo si el resultado se ha transmitido completo. Con un QueryGovernor se aplican sus límites; las
+    escrituras invalidan la ResultCache y los DDL refrescan los metadatos de db_metadata.
+    """
+    try:
+        for indice, bloque in enumerate(leer_bloques(engine, sql, chunk_size, governor, cache_resultados, db_metadata)):
+            yield _linea({"sql": sql, **bloque} if indice == 0 else bloque)
+    except Exception as e:
+        logger.error(f"Error al transmitir resultados: {e}")
+        if al_fallar is not None:
+            al_fallar()
+        yield _linea({"sql": sql, "error": str(e)})
+        return
+
+    if al_terminar is not None:
+        al_terminar()
+
+def evento_sse(nombre, datos):
+    return b"event: " + nombre.encode("ascii") + b"\ndata: " + dumps(datos) + b"\n\n"
+
+async def generar_sse(client, pregunta, db_metadata, engine, cache=None, embedder=None, retriever=None,
+                      chunk_size=STREAM_CHUNK_SIZE, governor=None, plantillas=None, cache_resultados=None):
+    """
+    Server-sent events para /preguntar: eventos "token" con el SQL según lo escribe el
+    modelo, "sql" con la sentencia final validada, y en cuanto termina la generación se
+    ejecuta y se emiten "columnas", bloques "filas" según los entrega el cursor y "fin"
+    (o "resultados" si no devuelve filas). Cualquier fallo se emite como evento "error".
+    Con un QueryGovernor el cursor lleva sus límites de filas, tiempo y plan; con un
+    TemplateStore las preguntas que solo cambian un literal no llegan al modelo; con una
+    ResultCache las escrituras la invalidan; los DDL refrescan los metadatos.
+    """
+    inicio = time.perf_counter()
+    generacion = None
+    primer_token = True
+    eventos = generar_sql_stream(client, pregunta, db_metadata, cache, embedder, retriever, plantillas)
+    async with aclosing(eventos):
+        async for tipo, datos in eventos:
+            if tipo == "token":
+                if primer_token:
+                    TIME_TO_FIRST.labels("sql_token").observe(time.perf_counter() - inicio)
+                    primer_token = False
+                yield evento_sse("token", {"texto": datos})
+            elif tipo == "error":
+                yield evento_sse("error", {"error": datos})
+                return
+            else:
+                generacion = datos
+
+    sql = generacion["sql"]
+    yield evento_sse("sql", {"sql": sql, "cache": generacion["origen"]})
+
+    # La lectura del cursor es bloqueante: cada bloque se pide en el pool de hilos
+    bloques = leer_bloques(engine, sql, chunk_size, governor, cache_resultados, db_metadata)
+    primera_fila = True
+    try:
+        with etapa(ETAPA_SQL):
+            async for bloque in iterate_in_threadpool(bloques):
+                if "filas" in bloque and primera_fila and bloque["filas"]:
+                    TIME_TO_FIRST.labels("row").observe(time.perf_counter() - inicio)
+                    primera_fila = False
+                yield evento_sse(next(iter(bloque)), bloque)
+    except Exception as e:
+        logger.error(f"Error al transmitir resultados: {e}")
+        registrar_error_sql(e)
+        if generacion["origen"] == "plantilla":
+            plantillas.discard(pregunta, generacion["fingerprint"])
+        yield evento_sse("error", {"sql": sql, "error": str(e)})
+        return
+    finally:
+        # Si el cliente se desconecta a mitad, se cierra el cursor y se devuelve la conexión al pool
+        await run_in_threadpool(bloques.close)
+
+    await guardar_en_cache_async(cache, pregunta, generacion, plantillas)
@@ -0,0 +1,129 @@
+import contextvars
+import logging
+import time
+import uuid
+from contextlib import aclosing, contextmanager, nullcontext
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from .database import obtener_metricas_pool
+
+logger = logging.getLogger(__name__)
+
+# Etapas del pipeline NL->SQL
+ETAPA_ESQUEMA = "schema_check"
+ETAPA_PLANTILLA = "template"
+ETAPA_PROMPT = "prompt"
+ETAPA_LLM = "llm"
+ETAPA_VALIDACION = "validate"
+ETAPA_SQL = "sql"
+ETAPA_SERIALIZACION = "serialize"
+
+STAGE_SECONDS = Histogram(
+    "nl2sql_stage_seconds", "Duración de cada etapa del pipeline NL->SQL", ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+TIME_TO_FIRST = Histogram(
+    "nl2sql_time_to_first_seconds", "Modo SSE: tiempo hasta el primer token de SQL y hasta la primera fila",
+    ["event"], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+)
+LLM_TOKENS = Counter("nl2sql_llm_tokens_total", "Tokens enviados y recibidos del modelo", ["direction"])
+LLM_REQUESTS = Counter("nl2sql_llm_requests_total", "Llamadas al modelo por modelo y resultado", ["model", "result"])
+LLM_RETRIES = Counter("nl2sql_llm_retries_total", "Reintentos de llamadas al modelo por motivo", ["reason"])
+CACHE_LOOKUPS = Counter("nl2sql_cache_lookups_total", "Consultas a la caché de preguntas", ["result"])
+SQL_VALIDATION = Counter(
+    "nl2sql_sql_validation_total", "Validación local del SQL generado: válido, reparado o rechazado", ["result"]
+)
+SQL_ERRORS = Counter("nl2sql_sql_errors_total", "Errores al ejecutar SQL por clase", ["error_class"])
+ROWS_RETURNED = Counter("nl2sql_rows_returned_total", "Filas devueltas a los clientes")
+
+# Spans de la petición en curso: lista de (etapa, inicio relativo, duración)
+_traza = contextvars.ContextVar("traza", default=None)
+
+
+class Traza:
+    __slots__ = ("id", "inicio", "spans")
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:16]
+        self.inicio = time.perf_counter()
+        self.spans = []
+
+
+def iniciar_traza():
+    """Abre una traza para la petición en curso y la devuelve"""
+    traza = Traza()
+    _traza.set(traza)
+    return traza
+
+def finalizar_traza(traza):
+    """Registra en el log todas las etapas de la traza en una sola línea"""
+    total = time.perf_counter() - traza.inicio
+    etapas = " ".join(f"{nombre}@{inicio * 1000:.1f}+{duracion * 1000:.1f}ms" for nombre, inicio, duracion in traza.spans)
+    logger.info(f"Traza {traza.id}: total={total * 1000:.1f}ms {etapas}")
+
+async def trazar_stream(traza, cuerpo, nombre_etapa=None):
+    """
+    Cuerpo de una StreamingResponse que cierra la traza cuando termina de transmitirse (o se
+    corta), no al devolver la respuesta: así recoge las etapas que ocurren durante el stream.
+    Un iterador síncrono se lee en el pool de hilos; con nombre_etapa toda la lectura cuenta
+    como esa etapa.
+    """
+    _traza.set(traza)
+    cerrar = None
+    if not hasattr(cuerpo, "__aiter__"):
+        cerrar = getattr(cuerpo, "close", None)
+        cuerpo = iterate_in_threadpool(cuerpo)
+    try:
+        with etapa(nombre_etapa) if nombre_etapa else nullcontext():
+            async with aclosing(cuerpo):
+                async for bloque in cuerpo:
+                    yield bloque
+    finally:
+        # Si el cliente se desconecta a mitad, el generador síncrono cierra su cursor
+        if cerrar is not None:
+            await run_in_threadpool(cerrar)
+        finalizar_traza(traza)
+
+@contextmanager
+def etapa(nombre):
+    """Mide una etapa: la observa en el histograma y la añade a la traza actual si la hay"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        STAGE_SECONDS.labels(nombre).observe(duracion)
+        traza = _traza.get()
+        if traza is not None:
+            traza.spans.append((nombre, inicio - traza.inicio, duracion))
+
+def registrar_uso_llm(respuesta):
+    """Suma los tokens de entrada y salida de una respuesta del modelo"""
+    uso = getattr(respuesta, "usage", None)
+    if uso is not None:
+        LLM_TOKENS.labels("in").inc(uso.prompt_tokens or 0)
+        LLM_TOKENS.labels("out").inc(uso.completion_tokens or 0)
+
+def registrar_error_sql(error):
+    """Cuenta un error de SQL por la clase del error del driver (o de la excepción)"""
+    original = getattr(error, "orig", None)
+    SQL_ERRORS.labels(type(original or error).__name__).inc()
+
+
+class PoolCollector:
+    """Expone las métricas de los pools de conexiones como gauges"""
+    def collect(self):
+        saturacion = GaugeMetricFamily("nl2sql_db_pool_saturation", "Conexiones en uso / capacidad", labels=["pool"])
+        en_uso = GaugeMetricFamily("nl2sql_db_pool_checked_out", "Conexiones en uso", labels=["pool"])
+        espera = GaugeMetricFamily("nl2sql_db_pool_max_wait_seconds", "Espera máxima en checkout", labels=["pool"])
+        for metricas in obtener_metricas_pool():
+            saturacion.add_metric([metricas['pool']], metricas['saturation'])
+            en_uso.add_metric([metricas['pool']], metricas['checked_out'])
+            espera.add_metric([metricas['pool']], metricas['max_wait'])
+        yield saturacion
+        yield en_uso
+        yield espera
+
+
+REGISTRY.register(PoolCollector())
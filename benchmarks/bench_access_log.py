@@ -0,0 +1,81 @@
+"""
+Latencia p50/p99 de un endpoint que devuelve N filas con el log de acceso
+desactivado, con el log síncrono anterior (json.dumps de toda la respuesta en el
+camino de la petición) y con AccessLogMiddleware. Uso:
+
+    python -m benchmarks.bench_access_log --peticiones 2000 --filas 2000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from app.middleware import AccessLogMiddleware, configurar_log_acceso
+
+
+def crear_app(filas, modo, ruta_log):
+    app = FastAPI()
+    datos = [{"id": i, "nombre": f"cliente {i}", "total": i * 1.5} for i in range(filas)]
+
+    if modo == "sincrono":
+        log_sincrono = logging.getLogger("bench.sincrono")
+        log_sincrono.addHandler(logging.FileHandler(ruta_log))
+        log_sincrono.setLevel(logging.INFO)
+        log_sincrono.propagate = False
+
+        @app.post("/preguntar")
+        async def preguntar():
+            respuesta = {"sql": "SELECT ...", "resultados": datos}
+            log_sincrono.info(f"API Response: {json.dumps(respuesta, ensure_ascii=False)}")
+            return respuesta
+    else:
+        @app.post("/preguntar")
+        async def preguntar():
+            return {"sql": "SELECT ...", "resultados": datos}
+
+    if modo == "middleware":
+        app.add_middleware(AccessLogMiddleware)
+    return app
+
+
+async def medir(app, peticiones, concurrencia):
+    latencias = []
+    semaforo = asyncio.Semaphore(concurrencia)
+    transporte = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench") as cliente:
+        async def una():
+            async with semaforo:
+                inicio = time.perf_counter()
+                await cliente.post("/preguntar", json={"pregunta": "ventas"})
+                latencias.append(time.perf_counter() - inicio)
+        await asyncio.gather(*(una() for _ in range(peticiones)))
+    latencias.sort()
+    return statistics.median(latencias), latencias[int(len(latencias) * 0.99) - 1]
+
+
+def main(peticiones, filas, concurrencia):
+    directorio = tempfile.mkdtemp()
+    listener = configurar_log_acceso(os.path.join(directorio, "access.log"))
+    print(f"{peticiones} peticiones, {filas} filas por respuesta, concurrencia {concurrencia}")
+    for modo in ("desactivado", "sincrono", "middleware"):
+        app = crear_app(filas, modo, os.path.join(directorio, "app.log"))
+        asyncio.run(medir(app, 50, concurrencia))  # calentamiento
+        p50, p99 = asyncio.run(medir(app, peticiones, concurrencia))
+        print(f"{modo:<12} p50 {p50 * 1000:7.2f} ms   p99 {p99 * 1000:7.2f} ms")
+    listener.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--peticiones", type=int, default=2000)
+    parser.add_argument("--filas", type=int, default=2000)
+    parser.add_argument("--concurrencia", type=int, default=16)
+    args = parser.parse_args()
+    main(args.peticiones, args.filas, args.concurrencia)
@@ -0,0 +1,121 @@
+"""
+Benchmark de carga del pipeline de /preguntar: compara el camino bloqueante
+(ejecutar_pregunta dentro de una corrutina) con ejecutar_pregunta_async.
+
+No necesita red ni MySQL: usa un cliente OpenAI falso con latencia fija y una
+base SQLite temporal. Uso:
+
+    python -m benchmarks.bench_async_pipeline --latencia 0.2 --peticiones 64
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, text
+
+from app.logic import ejecutar_pregunta, ejecutar_pregunta_async
+from app.metadata import ColumnInfo, TableInfo
+
+SQL_FALSO = "SELECT id, nombre FROM clientes LIMIT 5"
+
+
+def _respuesta(contenido):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=contenido))])
+
+
+class ClienteFalso:
+    """Imita OpenAI().chat.completions.create con una latencia bloqueante"""
+    def __init__(self, latencia):
+        self.latencia = latencia
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, **kwargs):
+        time.sleep(self.latencia)
+        return _respuesta(SQL_FALSO)
+
+
+class ClienteAsyncFalso:
+    """Imita AsyncOpenAI().chat.completions.create con una latencia no bloqueante"""
+    def __init__(self, latencia):
+        self.latencia = latencia
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, **kwargs):
+        await asyncio.sleep(self.latencia)
+        return _respuesta(SQL_FALSO)
+
+
+class MetadatosFalsos:
+    schema_info = {
+        'tables': {'clientes': TableInfo((
+            ColumnInfo('id', 'int', 'NO', 'PRI', None, '', None),
+            ColumnInfo('nombre', 'text', 'YES', '', None, '', None)
+        ), None)},
+        'relationships': []
+    }
+
+    def get_fingerprint_token(self):
+        return "bench"
+
+    def get_system_prompt(self, prefix, tables=None):
+        descripcion = "Tablas disponibles:\n- Tabla: clientes\n  Columnas:\n    - id: int (PK)\n    - nombre: varchar(50)\n"
+        return prefix + descripcion, 30
+
+    def validation_verdict(self, sql, validate):
+        return validate(sql, self.schema_info)
+
+
+def crear_engine_sqlite():
+    ruta = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{ruta}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE clientes (id INTEGER PRIMARY KEY, nombre TEXT)"))
+        conn.execute(text("INSERT INTO clientes (nombre) VALUES " + ",".join(f"('c{i}')" for i in range(100))))
+    return engine
+
+
+async def _medir(n, peticion):
+    inicio = time.perf_counter()
+    await asyncio.gather(*(peticion() for _ in range(n)))
+    return n / (time.perf_counter() - inicio)
+
+
+async def main(latencia, peticiones, concurrencias):
+    engine = crear_engine_sqlite()
+    metadatos = MetadatosFalsos()
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sql")
+    cliente = ClienteFalso(latencia)
+    cliente_async = ClienteAsyncFalso(latencia)
+
+    print(f"latencia LLM simulada: {latencia:.3f}s")
+    print(f"{'en vuelo':>9} | {'bloqueante req/s':>17} | {'async req/s':>12}")
+    for concurrencia in concurrencias:
+        semaforo = asyncio.Semaphore(concurrencia)
+
+        async def bloqueante():
+            async with semaforo:
+                return ejecutar_pregunta(cliente, engine, "pregunta", metadatos)
+
+        async def no_bloqueante():
+            async with semaforo:
+                return await ejecutar_pregunta_async(cliente_async, engine, "pregunta", metadatos, executor)
+
+        n = max(peticiones, concurrencia)
+        rps_bloqueante = await _medir(n, bloqueante)
+        rps_async = await _medir(n, no_bloqueante)
+        print(f"{concurrencia:>9} | {rps_bloqueante:>17.1f} | {rps_async:>12.1f}")
+
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latencia", type=float, default=0.2)
+    parser.add_argument("--peticiones", type=int, default=32)
+    parser.add_argument("--concurrencias", type=int, nargs="+", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+    asyncio.run(main(args.latencia, args.peticiones, args.concurrencias))
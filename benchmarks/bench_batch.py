@@ -0,0 +1,55 @@
+"""
+Tiempo de un lote de preguntas enviadas una a una (como hacen hoy los informes)
+frente a /preguntar-lote con distintas concurrencias y con límite por minuto.
+Usa el cliente falso y la base SQLite de bench_async_pipeline. Uso:
+
+    python -m benchmarks.bench_batch --preguntas 32 --latencia 0.2
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.limiter import Limitador
+from app.logic import ejecutar_lote_async, ejecutar_pregunta_async
+from benchmarks.bench_async_pipeline import ClienteAsyncFalso, MetadatosFalsos, crear_engine_sqlite
+
+
+async def main(preguntas, latencia, concurrencias, por_minuto):
+    engine = crear_engine_sqlite()
+    metadatos = MetadatosFalsos()
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sql")
+    cliente = ClienteAsyncFalso(latencia)
+    lote = [f"pregunta {i}" for i in range(preguntas)]
+
+    inicio = time.perf_counter()
+    for pregunta in lote:
+        await ejecutar_pregunta_async(cliente, engine, pregunta, metadatos, executor)
+    secuencial = time.perf_counter() - inicio
+    print(f"{preguntas} preguntas, {latencia * 1000:.0f} ms por llamada al modelo")
+    print(f"  secuencial:            {secuencial:6.2f}s")
+
+    async def medir(limitador):
+        inicio = time.perf_counter()
+        async for _ in ejecutar_lote_async(cliente, engine, lote, metadatos, executor=executor, limitador=limitador):
+            pass
+        return time.perf_counter() - inicio
+
+    for concurrencia in concurrencias:
+        duracion = await medir(Limitador(concurrencia))
+        print(f"  lote, concurrencia {concurrencia:3d}: {duracion:6.2f}s  (x{secuencial / duracion:.1f})")
+    # Con límite por minuto: ráfaga inicial de 8 llamadas y después el ritmo fijado
+    duracion = await medir(Limitador(8, por_minuto))
+    print(f"  lote, 8 y {por_minuto}/min:   {duracion:6.2f}s  (x{secuencial / duracion:.1f}, "
+          f"{preguntas / duracion:.1f}/s)")
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preguntas", type=int, default=32)
+    parser.add_argument("--latencia", type=float, default=0.2)
+    parser.add_argument("--concurrencias", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--por-minuto", type=int, default=600)
+    args = parser.parse_args()
+    asyncio.run(main(args.preguntas, args.latencia, args.concurrencias, args.por_minuto))
@@ -0,0 +1,67 @@
+"""
+Memoria residente y tiempo de refresco de DBMetadataManager sobre un esquema SQLite
+grande (1000 tablas por defecto): introspección completa, memoria que queda
+retenida tras ella y coste de cargar el detalle (muestras, valores, conteo) de las
+pocas tablas que usa una pregunta frente a cargarlo de todas. Uso:
+
+    python -m benchmarks.bench_metadata_memory --tablas 1000 --filas 20
+"""
+import argparse
+import gc
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from app.metadata import DBMetadataManager
+from benchmarks.bench_nl2sql import crear_base
+
+
+def memoria(funcion):
+    """Bytes que quedan retenidos tras ejecutar funcion() (y su resultado)"""
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    resultado = funcion()
+    gc.collect()
+    retenida = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return retenida, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tablas", type=int, default=1000)
+    parser.add_argument("--filas", type=int, default=20)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    engine = crear_base(args.tablas, args.filas, os.path.join(tempfile.mkdtemp(), "esquema.db"))
+    print(f"{args.tablas} tablas x {args.filas} filas")
+
+    tiempos = []
+    for _ in range(args.repeticiones):
+        inicio = time.perf_counter()
+        DBMetadataManager(engine)
+        tiempos.append(time.perf_counter() - inicio)
+    print(f"  introspección completa:   {min(tiempos) * 1000:8.0f} ms (mejor de {args.repeticiones})")
+
+    residente, gestor = memoria(lambda: DBMetadataManager(engine))
+    print(f"  memoria residente:        {residente / 2**20:8.2f} MiB")
+
+    if hasattr(gestor, "get_table_details"):
+        nombres = list(gestor.schema_info['tables'])
+        inicio = time.perf_counter()
+        detalle, _ = memoria(lambda: [gestor.get_table_details(nombre) for nombre in nombres[:3]])
+        print(f"  detalle de 3 tablas:      {detalle / 2**20:8.2f} MiB en {(time.perf_counter() - inicio) * 1000:.0f} ms")
+        gestor.details_max_tables = len(nombres)
+        inicio = time.perf_counter()
+        todo, _ = memoria(lambda: [gestor.get_table_details(nombre) for nombre in nombres])
+        print(f"  detalle de todas:         {todo / 2**20:8.2f} MiB en {(time.perf_counter() - inicio) * 1000:.0f} ms")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Banco de pruebas sin red de la API: levanta la aplicación de main.py en proceso
+(httpx + ASGI) sobre una base SQLite sembrada y un modelo falso determinista, y
+mide latencia p50/p95/p99 y peticiones por segundo de /preguntar, /preguntar-sql
+y del refresco de metadatos para esquemas pequeño, mediano y enorme. Uso:
+
+    python -m benchmarks.bench_nl2sql --esquemas pequeno,mediano --peticiones 200 --concurrencia 16
+
+Las cifras solo son comparables entre ejecuciones en la misma máquina: sirven
+para ver regresiones, no como medida absoluta. El refresco de metadatos sobre
+SQLite recorre el inspector de SQLAlchemy, no las consultas a information_schema
+de MySQL: esa cifra no detecta regresiones del camino de producción.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, text
+
+# Número de tablas y filas por tabla de cada esquema
+ESQUEMAS = {
+    "pequeno": (5, 1000),
+    "mediano": (60, 200),
+    "enorme": (600, 20),
+}
+
+
+def _respuesta(contenido):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=contenido))],
+        usage=None
+    )
+
+
+def sql_para(prompt):
+    """SQL determinista para la pregunta del último mensaje: cuenta o lista filas de la tabla citada"""
+    pregunta = prompt[-1]["content"]
+    tabla = re.search(r"\btabla_\d+\b", pregunta)
+    if tabla is None:
+        return "SELECT 1"
+    if "cuántos" in pregunta.lower():
+        return f"SELECT COUNT(*) AS total FROM {tabla.group(0)}"
+    return f"SELECT id, nombre, importe FROM {tabla.group(0)} ORDER BY importe DESC LIMIT 20"
+
+
+class ModeloFalso:
+    """
+    Imita AsyncOpenAI().chat.completions.create: misma pregunta, mismo SQL, con una
+    latencia media `latencia` y un jitter uniforme de ±`jitter` reproducible por semilla.
+    """
+    def __init__(self, latencia=0.05, jitter=0.0, semilla=0):
+        self.latencia = latencia
+        self.jitter = jitter
+        self._azar = random.Random(semilla)
+        self.llamadas = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _espera(self):
+        return max(self.latencia + self._azar.uniform(-self.jitter, self.jitter), 0)
+
+    async def _create(self, model, messages, stream=False, **kwargs):
+        self.llamadas += 1
+        await asyncio.sleep(self._espera())
+        return _respuesta(sql_para(messages))
+
+
+def crear_base(tablas, filas, ruta, semilla=0):
+    """Base SQLite con `tablas` tablas de `filas` filas, cada una con clave ajena a la anterior"""
+    azar = random.Random(semilla)
+    engine = create_engine(f"sqlite:///{ruta}")
+    with engine.begin() as conn:
+        for i in range(tablas):
+            referencia = f", padre_id INTEGER REFERENCES tabla_{i - 1}(id)" if i else ""
+            conn.execute(text(
+                f"CREATE TABLE tabla_{i} (id INTEGER PRIMARY KEY, nombre VARCHAR(40) NOT NULL, "
+                f"importe NUMERIC(10, 2), creado DATE{referencia})"
+            ))
+            conn.execute(text(f"CREATE INDEX tabla_{i}_importe ON tabla_{i} (importe)"))
+            valores = [
+                {"nombre": f"fila {j}", "importe": round(azar.uniform(0, 1000), 2),
+                 "creado": f"2024-{azar.randint(1, 12):02d}-{azar.randint(1, 28):02d}",
+                 "padre_id": azar.randint(1, filas)}
+                for j in range(filas)
+            ]
+            columnas = "nombre, importe, creado" + (", padre_id" if i else "")
+            parametros = ":nombre, :importe, :creado" + (", :padre_id" if i else "")
+            conn.execute(text(f"INSERT INTO tabla_{i} ({columnas}) VALUES ({parametros})"), valores)
+    return engine
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano sobre una lista de segundos"""
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))]
+
+
+def informe(nombre, latencias, duracion, errores=0):
+    ms = [v * 1000 for v in latencias]
+    print(
+        f"  {nombre:<15} p50 {percentil(ms, 50):8.1f} ms  p95 {percentil(ms, 95):8.1f} ms  "
+        f"p99 {percentil(ms, 99):8.1f} ms  {len(latencias) / duracion:8.1f} req/s"
+        + (f"  ({errores} errores)" if errores else "")
+    )
+
+
+async def cargar(http, ruta, cuerpos, concurrencia):
+    """Lanza las peticiones con `concurrencia` en vuelo; devuelve latencias, duración y errores"""
+    semaforo = asyncio.Semaphore(concurrencia)
+    latencias = []
+    errores = 0
+
+    async def una(cuerpo):
+        nonlocal errores
+        async with semaforo:
+            inicio = time.perf_counter()
+            respuesta = await http.post(ruta, json=cuerpo)
+            latencias.append(time.perf_counter() - inicio)
+            errores += respuesta.status_code != 200 or "error" in respuesta.json()
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(una(cuerpo) for cuerpo in cuerpos))
+    return latencias, time.perf_counter() - inicio, errores
+
+
+def preparar_app(engine, modelo):
+    """Importa main y sustituye lo que el lifespan conectaría (MySQL, OpenAI) por la base y el modelo locales"""
+    import main
+    from app.cache import QuestionCache
+    from app.llm_gateway import LLMGateway
+    from app.metadata import DBMetadataManager
+    from app.result_cache import ResultCache
+    from app.sql_templates import TemplateStore
+
+    main.engine = engine
+    main.metadata_manager = DBMetadataManager(engine)
+    main.llm = LLMGateway(modelo)
+    # Sin caché compartida ni embeddings: cada pregunta distinta llega al modelo
+    main.question_cache = QuestionCache()
+    main.embedder = None
+    if main.result_cache is not None:
+        main.result_cache = ResultCache()
+    if main.template_store is not None:
+        main.template_store = TemplateStore()
+    return main
+
+
+async def medir(esquema, peticiones, concurrencia, refrescos, latencia, jitter, semilla):
+    import httpx
+
+    tablas, filas = ESQUEMAS[esquema]
+    ruta = os.path.join(tempfile.mkdtemp(), f"{esquema}.db")
+    inicio = time.perf_counter()
+    engine = crear_base(tablas, filas, ruta, semilla)
+    print(f"{esquema}: {tablas} tablas x {filas} filas (sembrada en {time.perf_counter() - inicio:.1f}s)")
+
+    modelo = ModeloFalso(latencia, jitter, semilla)
+    main = preparar_app(engine, modelo)
+
+    latencias = []
+    inicio = time.perf_counter()
+    for _ in range(refrescos):
+        t = time.perf_counter()
+        main.metadata_manager.refresh_metadata()
+        latencias.append(time.perf_counter() - t)
+    # Camino del inspector (SQLite), no el de information_schema que se usa con MySQL
+    informe("refresco*", latencias, time.perf_counter() - inicio)
+    print("  * refresco sobre SQLite (inspector de SQLAlchemy), no comparable con el de MySQL")
+
+    azar = random.Random(semilla)
+    preguntas = [
+        {"pregunta": f"{azar.choice(['¿Cuántos registros hay en', 'Lista los mayores importes de'])} "
+                     f"tabla_{azar.randrange(tablas)} (consulta {i})"}
+        for i in range(peticiones)
+    ]
+    sentencias = [{"sql": sql_para([{"content": p["pregunta"]}])} for p in preguntas]
+
+    transporte = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench") as http:
+        informe("/preguntar", *await cargar(http, "/preguntar", preguntas, concurrencia))
+        informe("/preguntar-sql", *await cargar(http, "/preguntar-sql", sentencias, concurrencia))
+    engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--esquemas", default="pequeno,mediano,enorme")
+    parser.add_argument("--peticiones", type=int, default=200)
+    parser.add_argument("--concurrencia", type=int, default=16)
+    parser.add_argument("--refrescos", type=int, default=5)
+    parser.add_argument("--latencia", type=float, default=0.05, help="latencia media del modelo falso (s)")
+    parser.add_argument("--jitter", type=float, default=0.01, help="variación máxima de la latencia (s)")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    # Antes de importar main: sin clave real, sin snapshot compartido y logs solo por consola
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["SCHEMA_SNAPSHOT_PATH"] = ""
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"Modelo falso: {args.latencia * 1000:.0f} ± {args.jitter * 1000:.0f} ms, "
+          f"{args.peticiones} peticiones con concurrencia {args.concurrencia}")
+    for esquema in args.esquemas.split(","):
+        asyncio.run(medir(esquema, args.peticiones, args.concurrencia, args.refrescos,
+                          args.latencia, args.jitter, args.semilla))
+
+
+if __name__ == "__main__":
+    main()
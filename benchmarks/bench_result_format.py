@@ -0,0 +1,62 @@
+"""
+Compara bytes en el cable y CPU de serialización por cada 100k filas entre el
+formato actual (lista de dicts con jsonable_encoder + JSONResponse) y el formato
+columnar con orjson. Uso:
+
+    python -m benchmarks.bench_result_format --filas 100000
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.serialization import RespuestaJSONRapida, a_columnar
+
+COLUMNAS = ["id", "cliente", "total", "descuento", "creado", "activo"]
+
+
+def generar_filas(n):
+    inicio = datetime(2024, 1, 1)
+    return [
+        (i, f"cliente {i % 977}", Decimal(f"{i % 10000}.{i % 100:02d}"), i * 0.01,
+         inicio + timedelta(minutes=i), i % 2 == 0)
+        for i in range(n)
+    ]
+
+
+def medir(nombre, construir, repeticiones, escala):
+    cpu = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.process_time()
+        cuerpo = construir()
+        cpu = min(cpu, time.process_time() - inicio)
+    print(f"{nombre:<28} {len(cuerpo) * escala / 1e6:>10.2f} MB {cpu * escala * 1000:>10.1f} ms CPU")
+    return len(cuerpo), cpu
+
+
+def main(n, repeticiones):
+    filas = generar_filas(n)
+    escala = 100_000 / n
+
+    def objetos():
+        datos = [dict(zip(COLUMNAS, fila)) for fila in filas]
+        return JSONResponse(jsonable_encoder({"sql": "SELECT ...", "resultados": datos})).body
+
+    def columnar():
+        return RespuestaJSONRapida({"sql": "SELECT ...", **a_columnar(COLUMNAS, filas)}).body
+
+    print(f"por cada 100k filas ({len(COLUMNAS)} columnas, mejor de {repeticiones}):")
+    bytes_obj, cpu_obj = medir("lista de dicts (actual)", objetos, repeticiones, escala)
+    bytes_col, cpu_col = medir("columnar + orjson", columnar, repeticiones, escala)
+    print(f"reducción: {1 - bytes_col / bytes_obj:.0%} bytes, {cpu_obj / cpu_col:.1f}x menos CPU")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--filas", type=int, default=100_000)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+    main(args.filas, args.repeticiones)
@@ -0,0 +1,100 @@
+"""
+Latencia percibida de /preguntar: respuesta completa (modelo + todas las filas) frente
+al modo SSE, midiendo tiempo hasta el primer token de SQL, hasta el SQL completo,
+hasta la primera fila y total. Modelo falso que emite tokens con un retardo fijo y
+base SQLite temporal. Uso:
+
+    python -m benchmarks.bench_sse --tokens 40 --retardo-token 0.02 --filas 200000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, text
+
+from app.logic import ejecutar_pregunta_async
+from app.metadata import ColumnInfo, TableInfo
+from app.streaming import generar_sse
+from benchmarks.bench_async_pipeline import MetadatosFalsos
+
+SQL = "SELECT id, nombre, total FROM ventas ORDER BY id"
+
+
+class ClienteStreamingFalso:
+    """Imita AsyncOpenAI: con stream=True emite el SQL por tokens, si no lo devuelve entero al final"""
+    def __init__(self, tokens, retardo):
+        # El SQL palabra a palabra, completado con espacios hasta el número de tokens pedido
+        self.fragmentos = [palabra + " " for palabra in SQL.split(" ")]
+        self.fragmentos += [" "] * max(tokens - len(self.fragmentos), 0)
+        self.retardo = retardo
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, stream=False, **kwargs):
+        if not stream:
+            await asyncio.sleep(self.retardo * len(self.fragmentos))
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=SQL))], usage=None)
+
+        async def fragmentos():
+            for texto in self.fragmentos:
+                await asyncio.sleep(self.retardo)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=texto))])
+        return fragmentos()
+
+
+class MetadatosVentas(MetadatosFalsos):
+    """Metadatos con la tabla ventas, para que el SQL del modelo falso pase la validación"""
+    schema_info = {
+        'tables': {'ventas': TableInfo((
+            ColumnInfo('id', 'int', 'NO', 'PRI', None, '', None),
+            ColumnInfo('nombre', 'text', 'YES', '', None, '', None),
+            ColumnInfo('total', 'real', 'YES', '', None, '', None)
+        ), None)},
+        'relationships': []
+    }
+
+
+def crear_engine(filas):
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ventas (id INTEGER PRIMARY KEY, nombre TEXT, total REAL)"))
+        conn.execute(text(
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :filas) "
+            "INSERT INTO ventas SELECT i, 'cliente ' || i, i * 1.5 FROM n"
+        ), {"filas": filas})
+    return engine
+
+
+async def main(tokens, retardo, filas):
+    engine = crear_engine(filas)
+    metadatos = MetadatosVentas()
+    cliente = ClienteStreamingFalso(tokens, retardo)
+
+    inicio = time.perf_counter()
+    await ejecutar_pregunta_async(cliente, engine, "ventas", metadatos)
+    completa = time.perf_counter() - inicio
+
+    marcas = {}
+    inicio = time.perf_counter()
+    async for evento in generar_sse(cliente, "ventas", metadatos, engine):
+        nombre = evento.split(b"\n", 1)[0].removeprefix(b"event: ").decode()
+        marcas.setdefault(nombre, time.perf_counter() - inicio)
+    total = time.perf_counter() - inicio
+
+    print(f"{len(cliente.fragmentos)} tokens a {retardo * 1000:.0f} ms, {filas} filas")
+    print(f"  respuesta completa:        {completa * 1000:7.0f} ms hasta ver nada")
+    print(f"  SSE primer token de SQL:   {marcas['token'] * 1000:7.0f} ms")
+    print(f"  SSE SQL completo:          {marcas['sql'] * 1000:7.0f} ms")
+    print(f"  SSE primera fila:          {marcas['filas'] * 1000:7.0f} ms")
+    print(f"  SSE total:                 {total * 1000:7.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--retardo-token", type=float, default=0.02)
+    parser.add_argument("--filas", type=int, default=200000)
+    args = parser.parse_args()
+    asyncio.run(main(args.tokens, args.retardo_token, args.filas))
@@ -0,0 +1,143 @@
+"""
+Camino rápido de plantillas de SQL: lanza preguntas que solo cambian un literal
+("ventas del cliente 42", "ventas de marzo"...) contra ejecutar_pregunta_async con
+un modelo falso y compara latencias con y sin TemplateStore, junto con la tasa de
+aciertos de las plantillas y las llamadas al modelo que se evitan. Uso:
+
+    python -m benchmarks.bench_templates --preguntas 500 --latencia 0.05
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, text
+
+from app.logic import ejecutar_pregunta_async
+from app.metadata import DBMetadataManager
+from app.sql_templates import MESES, TemplateStore
+from benchmarks.bench_nl2sql import ModeloFalso, _respuesta, percentil
+
+CIUDADES = ["Madrid", "Lugo", "Soria", "Cádiz", "Teruel", "Girona"]
+
+# Plantillas de pregunta y el SQL que el modelo falso genera para cada una
+PREGUNTAS = [
+    ("¿Cuánto ha comprado el cliente {cliente}?", "SELECT SUM(importe) AS total FROM ventas WHERE cliente_id = {cliente}"),
+    ("Ventas de {mes_nombre}", "SELECT COUNT(*) AS ventas, SUM(importe) AS total FROM ventas WHERE mes = {mes}"),
+    ("Clientes de {ciudad}", "SELECT id, nombre FROM clientes WHERE ciudad = '{ciudad}' ORDER BY nombre"),
+    ("Las {n} mayores ventas", "SELECT id, importe FROM ventas ORDER BY importe DESC LIMIT {n}"),
+]
+
+
+class ModeloPlantillas(ModeloFalso):
+    """Modelo falso que devuelve el SQL de la plantilla de pregunta que encaja con el mensaje"""
+    async def _create(self, model, messages, stream=False, **kwargs):
+        self.llamadas += 1
+        await asyncio.sleep(self._espera())
+        pregunta = messages[-1]["content"].split("Mi pregunta es: ", 1)[-1]
+        for plantilla, sql in PREGUNTAS:
+            patron = re.escape(plantilla)
+            for nombre in ("cliente", "mes_nombre", "ciudad", "n"):
+                patron = patron.replace(re.escape("{" + nombre + "}"), f"(?P<{nombre}>.+?)")
+            encontrada = re.fullmatch(patron, pregunta)
+            if encontrada:
+                valores = encontrada.groupdict()
+                if "mes_nombre" in valores:
+                    valores["mes"] = MESES[valores.pop("mes_nombre")]
+                return _respuesta(sql.format(**valores))
+        return _respuesta("SELECT 1")
+
+
+def crear_base(ruta, semilla=0):
+    azar = random.Random(semilla)
+    engine = create_engine(f"sqlite:///{ruta}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE clientes (id INTEGER PRIMARY KEY, nombre TEXT, ciudad TEXT)"))
+        conn.execute(text(
+            "CREATE TABLE ventas (id INTEGER PRIMARY KEY, cliente_id INTEGER REFERENCES clientes(id), "
+            "mes INTEGER, importe NUMERIC(10, 2))"
+        ))
+        conn.execute(text("INSERT INTO clientes (nombre, ciudad) VALUES (:nombre, :ciudad)"), [
+            {"nombre": f"cliente {i}", "ciudad": azar.choice(CIUDADES)} for i in range(200)
+        ])
+        conn.execute(text("INSERT INTO ventas (cliente_id, mes, importe) VALUES (:cliente, :mes, :importe)"), [
+            {"cliente": azar.randint(1, 200), "mes": azar.randint(1, 12), "importe": round(azar.uniform(1, 500), 2)}
+            for _ in range(5000)
+        ])
+    return engine
+
+
+def generar_preguntas(cantidad, semilla):
+    azar = random.Random(semilla)
+    meses = list(MESES)
+    preguntas = []
+    for _ in range(cantidad):
+        plantilla, _ = azar.choice(PREGUNTAS)
+        preguntas.append("Base de datos actual: tienda. Mi pregunta es: " + plantilla.format(
+            cliente=azar.randint(1, 200), mes_nombre=azar.choice(meses), ciudad=azar.choice(CIUDADES),
+            n=azar.randint(2, 50)
+        ))
+    return preguntas
+
+
+async def medir(engine, preguntas, latencia, jitter, semilla, plantillas):
+    modelo = ModeloPlantillas(latencia, jitter, semilla)
+    metadatos = DBMetadataManager(engine)
+    executor = ThreadPoolExecutor(max_workers=8)
+    latencias = {"plantilla": [], "modelo": []}
+    errores = 0
+    inicio = time.perf_counter()
+    for pregunta in preguntas:
+        t = time.perf_counter()
+        resultado = await ejecutar_pregunta_async(modelo, engine, pregunta, metadatos, executor, plantillas=plantillas)
+        latencias["plantilla" if resultado.get("cache") == "plantilla" else "modelo"].append(time.perf_counter() - t)
+        errores += "error" in resultado
+    duracion = time.perf_counter() - inicio
+    executor.shutdown()
+    return latencias, duracion, modelo.llamadas, errores
+
+
+def informe(nombre, latencias, duracion, llamadas, errores):
+    todas = [v * 1000 for lista in latencias.values() for v in lista]
+    print(f"  {nombre:<16} p50 {percentil(todas, 50):7.1f} ms  p95 {percentil(todas, 95):7.1f} ms  "
+          f"{len(todas) / duracion:7.1f} preguntas/s  {llamadas} llamadas al modelo"
+          + (f"  ({errores} errores)" if errores else ""))
+    for camino, valores in latencias.items():
+        if valores:
+            ms = [v * 1000 for v in valores]
+            print(f"    {camino:<14} {len(valores):5d} preguntas  p50 {percentil(ms, 50):7.2f} ms  "
+                  f"p95 {percentil(ms, 95):7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preguntas", type=int, default=500)
+    parser.add_argument("--latencia", type=float, default=0.05, help="latencia media del modelo falso (s)")
+    parser.add_argument("--jitter", type=float, default=0.01, help="variación máxima de la latencia (s)")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    engine = crear_base(os.path.join(tempfile.mkdtemp(), "tienda.db"), args.semilla)
+    preguntas = generar_preguntas(args.preguntas, args.semilla)
+    print(f"{args.preguntas} preguntas de {len(PREGUNTAS)} formas, modelo falso de "
+          f"{args.latencia * 1000:.0f} ± {args.jitter * 1000:.0f} ms")
+
+    informe("sin plantillas", *asyncio.run(medir(engine, preguntas, args.latencia, args.jitter, args.semilla, None)))
+    plantillas = TemplateStore()
+    informe("con plantillas", *asyncio.run(
+        medir(engine, preguntas, args.latencia, args.jitter, args.semilla, plantillas)
+    ))
+    stats = plantillas.get_stats()
+    print(f"  camino rápido: {stats['hit_rate']:.1%} de aciertos, {stats['avg_latency_ms']:.2f} ms de media "
+          f"por búsqueda y ligado, {stats['active']} plantillas activas")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,49 +9,119 @@ function alternarModo() {
   document.getElementById("toggleModo").innerText = modoChat ? "Cambiar a modo simple" : "Cambiar a modo chat";
 }
 
-// 🧠 Pregunta desde el modo chat
+// 🧠 Pregunta desde el modo chat: el SQL aparece según lo escribe el modelo y las filas según llegan
 function enviarPregunta() {
   const input = document.getElementById("pregunta");
   const pregunta = input.value.trim();
   if (!pregunta) return;
 
-  // Mostrar loading
   const historial = document.getElementById("historial");
-  const loadingDiv = document.createElement("div");
-  loadingDiv.className = "flex items-center space-x-2 my-4 text-gray-500";
-  loadingDiv.innerHTML = `
-    <svg class="animate-spin h-5 w-5" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24">
-      <circle class="opacity-25" cx="12" cy="12" r="10" stroke="currentColor" stroke-width="4"></circle>
-      <path class="opacity-75" fill="currentColor" d="M4 12a8 8 0 018-8V0C5.373 0 0 5.373 0 12h4z"></path>
-    </svg>
-    <span>Procesando consulta...</span>
+  const contenedor = document.createElement("div");
+  contenedor.className = "mb-4 last:mb-0";
+  contenedor.innerHTML = `
+    <div class="bg-gray-100 p-3 rounded-lg mb-2">
+      <p class="font-semibold">Tú:</p>
+      <p></p>
+    </div>
+    <div class="ml-4">
+      <p class="font-semibold">SQL:</p>
+      <div class="bg-gray-800 text-gray-200 p-3 rounded-lg my-2 overflow-x-auto">
+        <code></code>
+      </div>
+      <div class="mt-2">
+        <div class="flex items-center space-x-2 my-4 text-gray-500">
+          <svg class="animate-spin h-5 w-5" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24">
+            <circle class="opacity-25" cx="12" cy="12" r="10" stroke="currentColor" stroke-width="4"></circle>
+            <path class="opacity-75" fill="currentColor" d="M4 12a8 8 0 018-8V0C5.373 0 0 5.373 0 12h4z"></path>
+          </svg>
+          <span>Procesando consulta...</span>
+        </div>
+      </div>
+    </div>
+    <hr class="my-4 border-gray-200">
   `;
-  historial.appendChild(loadingDiv);
+  contenedor.querySelector("p:not(.font-semibold)").textContent = pregunta;
+  historial.appendChild(contenedor);
+  historial.scrollTop = historial.scrollHeight;
+  input.value = ""; // limpiar input
 
-  fetch("http://localhost:8000/preguntar", {
+  const codigo = contenedor.querySelector("code");
+  const resultado = contenedor.querySelector(".mt-2");
+  let sql = null;
+  let tbody = null;
+
+  fetch("http://localhost:8000/preguntar?sse=true", {
     method: "POST",
-    headers: { "Content-Type": "application/json" },
+    headers: { "Content-Type": "application/json", "Accept": "text/event-stream" },
     body: JSON.stringify({ pregunta })
   })
-  .then(res => res.json())
-  .then(data => {
-    historial.removeChild(loadingDiv); // Remover indicador de carga
-    mostrarEnHistorial(pregunta, data);
-    input.value = ""; // limpiar input
-
-    if (data.sql && !data.error) {
-      guardarConsulta(pregunta, data.sql);
+  .then(res => leerEventos(res, (evento, data) => {
+    if (evento === "token") {
+      codigo.textContent += data.texto;
+    } else if (evento === "sql") {
+      sql = data.sql;
+      codigo.textContent = data.sql;
+    } else if (evento === "columnas") {
+      resultado.innerHTML = renderizarTabla(data.columnas, []);
+      tbody = resultado.querySelector("tbody");
+    } else if (evento === "filas") {
+      tbody.insertAdjacentHTML("beforeend", renderizarFilas(data.filas));
+    } else if (evento === "fin") {
+      if (data.total_filas === 0) {
+        resultado.innerHTML = `<p>✅ Consulta ejecutada. Sin resultados.</p>`;
+      }
+      guardarConsulta(pregunta, sql);
+    } else if (evento === "resultados") {
+      resultado.innerHTML = `<p>✅ ${data.resultados}</p>`;
+      guardarConsulta(pregunta, sql);
+    } else if (evento === "error") {
+      resultado.innerHTML = renderizarRespuesta(data);
     }
-  })
+    historial.scrollTop = historial.scrollHeight;
+  }))
   .catch(error => {
-    historial.removeChild(loadingDiv); // Remover indicador de carga
+    resultado.innerHTML = "";
     const errorDiv = document.createElement("div");
     errorDiv.className = "bg-red-100 border border-red-400 text-red-700 px-4 py-3 rounded my-4";
     errorDiv.textContent = `Error: ${error.message}`;
-    historial.appendChild(errorDiv);
+    resultado.appendChild(errorDiv);
   });
 }
 
+// 📡 Lee una respuesta text/event-stream y llama a alEvento(nombre, datos) por cada evento
+async function leerEventos(res, alEvento) {
+  // Un 422 o un 500 no es un flujo de eventos: se muestra como error
+  if (!res.ok) {
+    let datos;
+    try {
+      datos = await res.json();
+    } catch {
+      datos = {};
+    }
+    const detalle = datos.error || (typeof datos.detail === "string" ? datos.detail : JSON.stringify(datos.detail || ""));
+    throw new Error(`HTTP ${res.status}${detalle ? `: ${detalle}` : ""}`);
+  }
+  const lector = res.body.getReader();
+  const decodificador = new TextDecoder();
+  let pendiente = "";
+  while (true) {
+    const { value, done } = await lector.read();
+    if (done) break;
+    pendiente += decodificador.decode(value, { stream: true });
+    const bloques = pendiente.split("\n\n");
+    pendiente = bloques.pop();
+    for (const bloque of bloques) {
+      let evento = "message";
+      let datos = "";
+      for (const linea of bloque.split("\n")) {
+        if (linea.startsWith("event: ")) evento = linea.slice(7);
+        else if (linea.startsWith("data: ")) datos += linea.slice(6);
+      }
+      alEvento(evento, JSON.parse(datos));
+    }
+  }
+}
+
 // ⚡ Pregunta directa desde modo simple
 function enviarPreguntaSimple() {
   const input = document.getElementById("preguntaSimple");
@@ -70,7 +140,7 @@ function enviarPreguntaSimple() {
     </div>
   `;
 
-  fetch("http://localhost:8000/preguntar", {
+  fetch("http://localhost:8000/preguntar?format=columnar", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify({ pregunta })
@@ -124,25 +194,74 @@ function renderizarRespuesta(data) {
     return `<p style="color: red;">❌ Error: ${data.error}</p>`;
   }
 
+  // Formato columnar: { columnas, tipos, filas: [[...]] }
+  if (data.filas) {
+    if (data.filas.length === 0) {
+      return `<p>✅ Consulta ejecutada. Sin resultados.</p>`;
+    }
+    return renderizarTabla(data.columnas, data.filas, data.siguiente_pagina);
+  }
+
   if (!data.resultados || data.resultados.length === 0) {
     return `<p>✅ Consulta ejecutada. Sin resultados.</p>`;
   }
 
+  if (!Array.isArray(data.resultados)) {
+    return `<p>✅ ${data.resultados}</p>`;
+  }
+
   const columnas = Object.keys(data.resultados[0]);
-  const filasHTML = data.resultados.map(row =>
-    `<tr>${columnas.map(col => `<td>${row[col]}</td>`).join("")}</tr>`
+  return renderizarTabla(columnas, data.resultados.map(row => columnas.map(col => row[col])), data.siguiente_pagina);
+}
+
+// 🧾 Filas HTML a partir de arrays de valores
+function renderizarFilas(filas) {
+  return filas.map(fila =>
+    `<tr>${fila.map(valor => `<td>${valor}</td>`).join("")}</tr>`
   ).join("");
+}
 
+// 🧾 Tabla HTML a partir de columnas y filas como arrays
+function renderizarTabla(columnas, filas, siguientePagina) {
   const encabezado = columnas.map(col => `<th>${col}</th>`).join("");
+  const botonMas = siguientePagina
+    ? `<button class="mt-2 text-blue-600" onclick="cargarMas(this, '${siguientePagina}')">Cargar más</button>`
+    : "";
 
   return `
     <table class="tabla-resultado">
       <thead><tr>${encabezado}</tr></thead>
-      <tbody>${filasHTML}</tbody>
+      <tbody>${renderizarFilas(filas)}</tbody>
     </table>
+    ${botonMas}
   `;
 }
 
+// ⏬ Pedir la siguiente página de resultados y añadirla a la tabla
+function cargarMas(boton, token) {
+  boton.disabled = true;
+  fetch("http://localhost:8000/pagina?format=columnar", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ token })
+  })
+  .then(res => res.json())
+  .then(data => {
+    if (data.error) {
+      boton.outerHTML = `<p style="color: red;">❌ Error: ${data.error}</p>`;
+      return;
+    }
+    const tbody = boton.previousElementSibling.querySelector("tbody");
+    tbody.insertAdjacentHTML("beforeend", renderizarFilas(data.filas));
+    if (data.siguiente_pagina) {
+      boton.onclick = () => cargarMas(boton, data.siguiente_pagina);
+      boton.disabled = false;
+    } else {
+      boton.remove();
+    }
+  });
+}
+
 // 💾 Guardar una consulta en el to-do list
 function guardarConsulta(desc, sql) {
   const nueva = { desc, sql };
@@ -185,7 +304,7 @@ function renderizarConsultas() {
 // ▶️ Ejecutar una consulta guardada directamente (sin OpenAI)
 function ejecutarGuardada(i) {
   const { sql, desc } = consultasGuardadas[i];
-  fetch("http://localhost:8000/preguntar-sql", {
+  fetch("http://localhost:8000/preguntar-sql?format=columnar", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify({ sql })
@@ -1,49 +1,186 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Header
 from pydantic import BaseModel
-from app.schema import PreguntaRequest
-from app.database import intentar_sqlalchemy, lanzar_mysqlconnector
-from app.openai_client import preparar_modelo
-from app.logic import ejecutar_pregunta
+from app.schema import PreguntaRequest, PreguntasLoteRequest
+from app.database import conectar_con_reintentos, obtener_metricas_pool
+from app.openai_client import preparar_modelo_async, preparar_gateway_async, preparar_embedder_async
+from app.logic import (
+    ejecutar_pregunta_async, ejecutar_lote_async, generar_sql_async, guardar_en_cache, ejecutar_sql, es_sql_valido
+)
+from app.governor import QueryGovernor, decodificar_token
+from app.streaming import generar_ndjson, generar_sse
+from app.serialization import RespuestaJSONRapida, elegir_formato, dumps
+from app.cache import QuestionCache
+from app.result_cache import ResultCache
+from app.sql_templates import TemplateStore
+from app.singleflight import SingleFlight
+from app.limiter import Limitador
+from app.telemetry import (
+    etapa, iniciar_traza, finalizar_traza, trazar_stream, ETAPA_ESQUEMA, ETAPA_SQL, ETAPA_SERIALIZACION
+)
+from app.schema_retrieval import SchemaRetriever
+from app.shared_state import crear_estado_compartido
+from app.config import (
+    SQL_EXECUTOR_WORKERS, CACHE_SEMANTIC_ENABLED, DB_METADATA_POOL_SIZE, DB_METADATA_MAX_OVERFLOW,
+    BATCH_MAX_QUESTIONS, BATCH_MAX_CONCURRENCY, BATCH_RATE_LIMIT_RPM, RESULT_CACHE_ENABLED, TEMPLATES_ENABLED
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.encoders import jsonable_encoder
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from starlette.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
 import time
 import logging
 from sqlalchemy.sql import text
+from typing import Optional
 from app.metadata import DBMetadataManager, MetadataRefresher
-from app.middleware import log_api_request  # Importar nuestro decorador
+from app.middleware import AccessLogMiddleware, configurar_log_acceso, anotar_acceso, hash_sql
 import json
 
 # Configurar logs
 logging.basicConfig(filename="logs/app.log", level=logging.INFO)
 
-app = FastAPI()
+client = preparar_modelo_async()
+# Todas las llamadas al modelo de chat pasan por la pasarela (plazos, reintentos, límites, circuito, enrutado)
+llm = preparar_gateway_async(client)
+
+# Snapshot del esquema, lease del refrescador y caché compartidos entre workers (SQLite local o Redis)
+shared_state = crear_estado_compartido()
+
+# Se inicializan en el arranque (lifespan)
+engine = None
+metadata_engine = None
+metadata_manager = None
+metadata_refresher = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global engine, metadata_engine, metadata_manager, metadata_refresher
+    start_time = time.time()
+    access_log_listener = configurar_log_acceso()
+
+    # Pool para consultas de usuario y pool pequeño aparte para metadatos, con reintentos
+    engine = await conectar_con_reintentos("consultas")
+    metadata_engine = await conectar_con_reintentos(
+        "metadatos", pool_size=DB_METADATA_POOL_SIZE, max_overflow=DB_METADATA_MAX_OVERFLOW
+    )
+
+    # Inicializar el gestor de metadatos (desde el snapshot en disco si lo hay)
+    metadata_manager = await run_in_threadpool(DBMetadataManager, metadata_engine, snapshot_store=shared_state)
+    validacion = None
+    if metadata_manager.snapshot_loaded:
+        # Se sirve ya con el snapshot y se comprueba en segundo plano que sigue vigente
+        validacion = asyncio.create_task(run_in_threadpool(metadata_manager.validate_snapshot))
+    # Tarea adaptativa del bucle de eventos; se despierta sola con los DDL del servicio
+    metadata_refresher = MetadataRefresher(metadata_manager)
+    metadata_refresher.start()
+    origen = "snapshot en disco" if metadata_manager.snapshot_loaded else "introspección completa"
+    logging.info(f"Servicio listo en {time.time() - start_time:.2f}s ({origen})")
+
+    yield
+
+    if validacion is not None and not validacion.done():
+        validacion.cancel()
+    await metadata_refresher.stop()
+    sql_executor.shutdown(wait=False)
+    engine.dispose()
+    metadata_engine.dispose()
+    access_log_listener.stop()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(AccessLogMiddleware)
+
+# Pool acotado para ejecutar SQL sin bloquear el event loop
+sql_executor = ThreadPoolExecutor(max_workers=SQL_EXECUTOR_WORKERS, thread_name_prefix="sql")
+
+# Caché pregunta -> SQL delante de la llamada al modelo
+question_cache = QuestionCache(shared=shared_state)
+embedder = preparar_embedder_async(client) if CACHE_SEMANTIC_ENABLED else None
+
+# Caché de resultados de las lecturas, invalidada cuando cambian sus tablas
+result_cache = ResultCache() if RESULT_CACHE_ENABLED else None
+
+# Plantillas de SQL aprendidas: camino rápido sin modelo para preguntas que solo cambian un literal
+template_store = TemplateStore() if TEMPLATES_ENABLED else None
+
+# Selección de las tablas relevantes para cada pregunta
+schema_retriever = SchemaRetriever()
+
+# Límites de filas, tiempo y plan para el SQL que se ejecuta
+query_governor = QueryGovernor()
+
+# Agrupa preguntas y SQL idénticos en curso para ejecutarlos una sola vez
+question_flights = SingleFlight("preguntas")
+
+# Concurrencia y ritmo de las llamadas al modelo de los lotes (compartido entre lotes simultáneos)
+batch_limiter = Limitador(BATCH_MAX_CONCURRENCY, BATCH_RATE_LIMIT_RPM)
+
+async def esquema_cambiado():
+    """
+    has_schema_changed sin bloquear el event loop: en modo information_schema solo compara el
+    token en memoria; en modo checksum calcula la huella (SHOW CREATE por tabla) en el pool.
+    """
+    if metadata_manager.change_detection == "information_schema":
+        return metadata_manager.has_schema_changed()
+    return await run_in_threadpool(metadata_manager.has_schema_changed)
 
-client = preparar_modelo()
-engine = intentar_sqlalchemy()
-if not engine:
-    lanzar_mysqlconnector()
-    time.sleep(2)
-    engine = intentar_sqlalchemy()
+def reutilizar_resultados(cache, cache_control):
+    """
+    Si la petición puede leer y guardar en la caché de resultados (no con ?cache=false ni
+    Cache-Control: no-cache/no-store). Las escrituras la invalidan siempre.
+    """
+    return cache and not any(directiva in (cache_control or "").lower() for directiva in ("no-cache", "no-store"))
 
-# Inicializar el gestor de metadatos
-metadata_manager = DBMetadataManager(engine)
-metadata_refresher = MetadataRefresher(metadata_manager, interval=900)  # 15 minutos en segundos
-metadata_refresher.start()
+def responder(result, traza):
+    """
+    Serializa la respuesta midiendo la etapa (columnar con orjson, el resto como siempre),
+    cierra la traza de la petición y devuelve su id en X-Trace-Id
+    """
+    estado_cache = result.pop("cache_resultado", None)
+    filas = result.get("filas", result.get("resultados"))
+    anotar_acceso(
+        filas=len(filas) if isinstance(filas, list) else None,
+        sql_hash=hash_sql(result["sql"]) if result.get("sql") else None,
+        cache=result.get("cache"),
+        error="error" in result
+    )
+    with etapa(ETAPA_SERIALIZACION):
+        if "filas" in result:
+            response = RespuestaJSONRapida(result)
+        else:
+            response = JSONResponse(jsonable_encoder(result))
+    if estado_cache is not None:
+        response.headers["X-Cache"] = estado_cache
+    finalizar_traza(traza)
+    response.headers["X-Trace-Id"] = traza.id
+    return response
 
 class SQLRequest(BaseModel):
     sql: str
 
+class PaginaRequest(BaseModel):
+    token: str
+
 @app.post("/preguntar")
-async def preguntar(req: PreguntaRequest):
-    # Verificar si han cambiado las tablas o bases de datos
-    if metadata_manager.has_schema_changed():
-        metadata_manager.refresh_metadata()
-        logging.info("Esquema actualizado antes de procesar la consulta")
+async def preguntar(req: PreguntaRequest, stream: bool = False, sse: bool = False, format: Optional[str] = None,
+                    cache: bool = True, accept: Optional[str] = Header(None),
+                    cache_control: Optional[str] = Header(None)):
+    traza = iniciar_traza()
+    anotar_acceso(trace_id=traza.id)
+
+    # Verificar si han cambiado las tablas o bases de datos (sin E/S en el bucle de eventos)
+    with etapa(ETAPA_ESQUEMA):
+        if await esquema_cambiado():
+            await run_in_threadpool(metadata_manager.refresh_metadata)
+            logging.info("Esquema actualizado antes de procesar la consulta")
     
     # Para interceptar lo que se envía a la API, añade logging aquí
     logging.info(f"Pregunta recibida: {req.pregunta}")
@@ -54,34 +191,152 @@ async def preguntar(req: PreguntaRequest):
     current_db = metadata_manager.schema_info.get('current_db', 'unknown')
     contexto_pregunta = f"Base de datos actual: {current_db}. Mi pregunta es: {req.pregunta}"
     
+    # Modo SSE: los tokens del SQL según los escribe el modelo y después las filas según las lee el cursor
+    # La traza se cierra al terminar de transmitir: recoge el modelo, la validación y el SQL
+    if sse or "text/event-stream" in (accept or ""):
+        return StreamingResponse(
+            trazar_stream(traza, generar_sse(
+                llm, contexto_pregunta, metadata_manager, engine,
+                cache=question_cache, embedder=embedder, retriever=schema_retriever,
+                governor=query_governor, plantillas=template_store, cache_resultados=result_cache
+            )),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Trace-Id": traza.id}
+        )
+
+    # Modo streaming: se genera el SQL y las filas se transmiten en NDJSON según las lee el cursor
+    if stream:
+        generacion = await generar_sql_async(
+            llm, contexto_pregunta, metadata_manager,
+            cache=question_cache, embedder=embedder, retriever=schema_retriever, singleflight=question_flights,
+            plantillas=template_store
+        )
+        if "error" in generacion:
+            finalizar_traza(traza)
+            return generacion
+        anotar_acceso(sql_hash=hash_sql(generacion["sql"]), cache=generacion["origen"])
+
+        def descartar_plantilla():
+            # Una plantilla cuyo SQL falla al ejecutarse se descarta, como en el modo normal
+            if generacion["origen"] == "plantilla":
+                template_store.discard(contexto_pregunta, generacion["fingerprint"])
+
+        return StreamingResponse(
+            trazar_stream(traza, generar_ndjson(
+                engine, generacion["sql"], governor=query_governor, cache_resultados=result_cache,
+                db_metadata=metadata_manager,
+                al_terminar=lambda: guardar_en_cache(question_cache, contexto_pregunta, generacion, template_store),
+                al_fallar=descartar_plantilla
+            ), ETAPA_SQL),
+            media_type="application/x-ndjson", headers={"X-Trace-Id": traza.id}
+        )
+
     # Ejecutar la consulta
     start_time = time.time()
-    result = ejecutar_pregunta(client, engine, contexto_pregunta, metadata_manager)
+    result = await ejecutar_pregunta_async(
+        llm, engine, contexto_pregunta, metadata_manager, sql_executor,
+        cache=question_cache, embedder=embedder, retriever=schema_retriever,
+        formato=elegir_formato(format, accept), governor=query_governor, singleflight=question_flights,
+        cache_resultados=result_cache, reutilizar_resultados=reutilizar_resultados(cache, cache_control),
+        plantillas=template_store
+    )
     end_time = time.time()
     
     # Registrar el tiempo y resultado
     logging.info(f"Tiempo de procesamiento: {end_time - start_time:.2f}s")
     logging.info(f"SQL generado: {result.get('sql', 'No se generó SQL')}")
     
-    return result
+    return responder(result, traza)
+
+@app.post("/preguntar-lote")
+async def preguntar_lote(req: PreguntasLoteRequest, format: Optional[str] = None, cache: bool = True,
+                         accept: Optional[str] = Header(None), cache_control: Optional[str] = Header(None)):
+    if len(req.preguntas) > BATCH_MAX_QUESTIONS:
+        return {"error": f"El lote supera el máximo de {BATCH_MAX_QUESTIONS} preguntas."}
+    traza = iniciar_traza()
+    anotar_acceso(trace_id=traza.id)
+
+    with etapa(ETAPA_ESQUEMA):
+        if await esquema_cambiado():
+            await run_in_threadpool(metadata_manager.refresh_metadata)
+            logging.info("Esquema actualizado antes de procesar el lote")
+
+    current_db = metadata_manager.schema_info.get('current_db', 'unknown')
+    preguntas = [f"Base de datos actual: {current_db}. Mi pregunta es: {pregunta}" for pregunta in req.preguntas]
+    anotar_acceso(lote=len(preguntas))
+    logging.info(f"Lote recibido: {len(preguntas)} preguntas")
+
+    async def generar():
+        # Una línea NDJSON por pregunta en el orden en que terminan, y una final con el resumen
+        start_time = time.time()
+        errores = 0
+        async for indice, resultado in ejecutar_lote_async(
+            llm, engine, preguntas, metadata_manager, retriever=schema_retriever,
+            executor=sql_executor, cache=question_cache, embedder=embedder, formato=elegir_formato(format, accept),
+            governor=query_governor, singleflight=question_flights, limitador=batch_limiter,
+            cache_resultados=result_cache, reutilizar_resultados=reutilizar_resultados(cache, cache_control),
+            plantillas=template_store
+        ):
+            errores += "error" in resultado
+            resultado.pop("cache_resultado", None)  # En /preguntar va en la cabecera X-Cache; aquí no aplica
+            yield dumps({"indice": indice, "pregunta": req.preguntas[indice], **resultado}) + b"\n"
+        duracion = time.time() - start_time
+        logging.info(f"Lote de {len(preguntas)} preguntas procesado en {duracion:.2f}s ({errores} errores)")
+        yield dumps({"fin": True, "total": len(preguntas), "errores": errores, "segundos": duracion}) + b"\n"
+
+    # Las etapas de todas las preguntas del lote quedan en la misma traza
+    return StreamingResponse(trazar_stream(traza, generar()), media_type="application/x-ndjson",
+                             headers={"X-Trace-Id": traza.id})
 
 @app.post("/preguntar-sql")
-def preguntar_sql(data: SQLRequest):
+def preguntar_sql(data: SQLRequest, stream: bool = False, format: Optional[str] = None, cache: bool = True,
+                  accept: Optional[str] = Header(None), cache_control: Optional[str] = Header(None)):
+    traza = iniciar_traza()
+    anotar_acceso(trace_id=traza.id)
+    if stream:
+        # Sin lectura de la caché, pero una escritura transmitida invalida sus tablas y un DDL refresca los metadatos
+        return StreamingResponse(
+            trazar_stream(traza, generar_ndjson(
+                engine, data.sql, governor=query_governor, cache_resultados=result_cache, db_metadata=metadata_manager
+            ), ETAPA_SQL),
+            media_type="application/x-ndjson", headers={"X-Trace-Id": traza.id}
+        )
+    formato = elegir_formato(format, accept)
+    with etapa(ETAPA_SQL):
+        result = ejecutar_sql(
+            engine, data.sql, metadata_manager, formato, query_governor,
+            cache_resultados=result_cache, reutilizar=reutilizar_resultados(cache, cache_control)
+        )
+    return responder(result, traza)
+
+@app.post("/pagina")
+def siguiente_pagina(data: PaginaRequest, format: Optional[str] = None, cache: bool = True,
+                     accept: Optional[str] = Header(None), cache_control: Optional[str] = Header(None)):
     try:
-        with engine.connect() as conn:
-            result = conn.execute(text(data.sql))
-            columnas = result.keys()
-            filas = result.fetchall()
-            datos = [dict(zip(columnas, fila)) for fila in filas]
-            return {"resultados": datos}
-    except Exception as e:
-        return {"error": str(e)}
+        sql, offset = decodificar_token(data.token)
+    except Exception:
+        return {"error": "Token de página inválido."}
+    if not es_sql_valido(sql):
+        return {"error": "Token de página inválido."}
+
+    traza = iniciar_traza()
+    anotar_acceso(trace_id=traza.id)
+    with etapa(ETAPA_SQL):
+        result = ejecutar_sql(
+            engine, sql, metadata_manager, elegir_formato(format, accept), query_governor, offset,
+            cache_resultados=result_cache, reutilizar=reutilizar_resultados(cache, cache_control)
+        )
+    return responder(result, traza)
 
 @app.post("/refrescar-esquema")
-def refrescar_esquema():
+def refrescar_esquema(conteos_exactos: Optional[bool] = None):
     try:
-        metadata_manager.refresh_metadata()
-        return {"message": "Esquema refrescado exitosamente"}
+        # Sin el parámetro se respeta METADATA_EXACT_COUNTS
+        if conteos_exactos is None:
+            metadata_manager.refresh_metadata()
+        else:
+            metadata_manager.refresh_metadata(exact_counts=conteos_exactos)
+        return {"message": "Esquema refrescado exitosamente", "tiempos": metadata_manager.last_refresh_timings}
     except Exception as e:
         return {"error": str(e)}
 
@@ -92,10 +347,37 @@ def obtener_esquema():
     except Exception as e:
         return {"error": str(e)}
 
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/metricas-pool")
+def metricas_pool():
+    return {"pools": obtener_metricas_pool()}
+
+@app.get("/estadisticas-cache")
+def estadisticas_cache():
+    return {
+        "cache": question_cache.get_stats(),
+        "singleflight": question_flights.get_stats(),
+        "lotes": batch_limiter.get_stats(),
+        "detalle_tablas": metadata_manager.get_details_stats(),
+        "resultados": result_cache.get_stats() if result_cache is not None else None,
+        "plantillas": template_store.get_stats() if template_store is not None else None
+    }
+
+@app.get("/estadisticas-llm")
+def estadisticas_llm():
+    return {"llm": llm.get_stats()}
+
+@app.get("/estadisticas-refresco")
+def estadisticas_refresco():
+    return {"refresco": metadata_refresher.get_stats()}
+
 @app.post("/cambiar-intervalo-actualizacion")
 def cambiar_intervalo_actualizacion(intervalo: int):
     try:
-        metadata_refresher.update_interval(intervalo)
+        metadata_refresher.set_interval(intervalo * 60)
         return {"message": f"Intervalo de actualización cambiado a {intervalo} minutos"}
     except Exception as e:
         return {"error": str(e)}
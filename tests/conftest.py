@@ -0,0 +1,36 @@
+from sqlalchemy import create_engine, text
+from app.metadata import ColumnInfo, TableInfo
+
+
+def crear_engine(tmp_path, clientes=("Ana", "Luis")):
+    """SQLite de prueba con clientes (ids desde 1) y pedidos que los referencian"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'tienda.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE clientes (id INTEGER PRIMARY KEY, nombre TEXT NOT NULL)"))
+        conn.execute(text(
+            "CREATE TABLE pedidos (id INTEGER PRIMARY KEY, cliente_id INTEGER REFERENCES clientes(id), total REAL)"
+        ))
+        conn.execute(text("INSERT INTO clientes (nombre) VALUES (:nombre)"), [{"nombre": n} for n in clientes])
+    return engine
+
+
+class Metadatos:
+    """DBMetadataManager falso con un esquema fijo; cuenta las descripciones del esquema pedidas"""
+    def __init__(self, tablas=("clientes",), columnas=("id",)):
+        tabla = TableInfo(tuple(
+            ColumnInfo(c, 'int', 'NO', 'PRI', None, '', None) if c == 'id'
+            else ColumnInfo(c, 'text', 'YES', '', None, '', None)
+            for c in columnas
+        ), None)
+        self.schema_info = {'tables': {nombre: tabla for nombre in tablas}, 'relationships': []}
+        self.descripciones = 0
+
+    def get_fingerprint_token(self):
+        return "v1"
+
+    def get_system_prompt(self, prefix, tables=None):
+        self.descripciones += 1
+        return prefix + "\n".join(f"- Tabla: {nombre}" for nombre in self.schema_info['tables']), 10
+
+    def validation_verdict(self, sql, validate):
+        return validate(sql, self.schema_info)
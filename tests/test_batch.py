@@ -0,0 +1,54 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from app.limiter import Limitador
+from app.logic import ejecutar_lote_async
+from conftest import Metadatos, crear_engine
+
+
+class ClienteConcurrente:
+    """Cliente AsyncOpenAI falso que registra cuántas llamadas hay a la vez"""
+    def __init__(self):
+        self.en_curso = 0
+        self.maximo = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, **kwargs):
+        self.en_curso += 1
+        self.maximo = max(self.maximo, self.en_curso)
+        await asyncio.sleep(0.02)
+        self.en_curso -= 1
+        tabla = messages[-1]["content"].split()[-1]
+        mensaje = SimpleNamespace(content=f"SELECT COUNT(*) AS total FROM {tabla}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=mensaje)], usage=None)
+
+
+def test_lote_en_paralelo_con_concurrencia_limitada(tmp_path):
+    engine = crear_engine(tmp_path)
+    cliente = ClienteConcurrente()
+    metadatos = Metadatos(tablas=("clientes", "pedidos"))
+    preguntas = [f"pregunta {i} sobre {'clientes' if i % 2 else 'pedidos'}" for i in range(12)]
+
+    async def lanzar():
+        limitador = Limitador(max_concurrencia=3)
+        return [r async for r in ejecutar_lote_async(cliente, engine, preguntas, metadatos, limitador=limitador)]
+
+    resultados = dict(asyncio.run(lanzar()))
+
+    assert sorted(resultados) == list(range(12))
+    assert resultados[1]["resultados"] == [{"total": 2}]
+    assert resultados[0]["resultados"] == [{"total": 0}]
+    assert cliente.maximo == 3
+    assert metadatos.descripciones == 1
+
+
+def test_limitador_por_minuto():
+    async def lanzar():
+        limitador = Limitador(max_concurrencia=2, por_minuto=1200)  # 20/s con ráfaga inicial de 2
+        inicio = time.monotonic()
+        for _ in range(6):
+            async with limitador:
+                pass
+        return time.monotonic() - inicio
+
+    assert 0.18 <= asyncio.run(lanzar()) < 0.5
@@ -0,0 +1,30 @@
+from app.cache import QuestionCache, normalizar_pregunta
+
+def test_normalizacion_ignora_mayusculas_acentos_y_puntuacion():
+    assert normalizar_pregunta("¿Cuántas  ventas hubo?") == normalizar_pregunta("cuantas ventas hubo")
+
+def test_acierto_exacto_y_invalidacion_por_huella():
+    cache = QuestionCache(max_entries=10, ttl=60)
+    cache.put("¿Cuántos clientes hay?", "v1", "SELECT COUNT(*) FROM clientes")
+
+    assert cache.get("cuantos clientes hay", "v1") == "SELECT COUNT(*) FROM clientes"
+    assert cache.get("cuantos clientes hay", "v2") is None
+    assert cache.get_stats()['invalidations'] == 1
+
+def test_expulsion_lru():
+    cache = QuestionCache(max_entries=2, ttl=60)
+    cache.put("a", "v1", "SELECT 1")
+    cache.put("b", "v1", "SELECT 2")
+    cache.get("a", "v1")
+    cache.put("c", "v1", "SELECT 3")
+
+    assert cache.get("b", "v1") is None
+    assert cache.get("a", "v1") == "SELECT 1"
+    assert cache.get_stats()['evictions'] == 1
+
+def test_nivel_semantico_respeta_umbral():
+    cache = QuestionCache(max_entries=10, ttl=60, similarity_threshold=0.9)
+    cache.put("ventas por mes", "v1", "SELECT mes, SUM(total) FROM ventas GROUP BY mes", embedding=[1.0, 0.0])
+
+    assert cache.get_similar([0.99, 0.05], "v1") is not None
+    assert cache.get_similar([0.0, 1.0], "v1") is None
@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import create_engine, text
+from app.governor import QueryGovernor, ConsultaRechazada, decodificar_token
+from app.logic import ejecutar_sql
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE numeros (n INTEGER)"))
+        conn.execute(text("INSERT INTO numeros VALUES " + ",".join(f"({i})" for i in range(25))))
+    return engine
+
+def test_inyecta_limite_y_respeta_el_original():
+    governor = QueryGovernor(max_rows=100, page_size=10, timeout_ms=0)
+
+    assert governor.preparar("SELECT n FROM numeros").sql == "SELECT n FROM numeros LIMIT 11 OFFSET 0"
+    assert governor.preparar("SELECT n FROM numeros LIMIT 3").limite == 3
+
+def test_rechaza_varias_sentencias():
+    with pytest.raises(ConsultaRechazada):
+        QueryGovernor().preparar("SELECT 1; DROP TABLE numeros")
+
+def test_paginacion_con_token(engine):
+    governor = QueryGovernor(max_rows=100, page_size=10, timeout_ms=0)
+    sql = "SELECT n FROM numeros ORDER BY n"
+
+    vistos = []
+    respuesta = ejecutar_sql(engine, sql, None, governor=governor)
+    while True:
+        vistos += [fila["n"] for fila in respuesta["resultados"]]
+        if not respuesta["siguiente_pagina"]:
+            break
+        sql_token, offset = decodificar_token(respuesta["siguiente_pagina"])
+        respuesta = ejecutar_sql(engine, sql_token, None, governor=governor, offset=offset)
+
+    assert vistos == list(range(25))
+
+def test_tope_total_de_filas(engine):
+    governor = QueryGovernor(max_rows=15, page_size=10, timeout_ms=0)
+    respuesta = ejecutar_sql(engine, "SELECT n FROM numeros", None, governor=governor)
+    _, offset = decodificar_token(respuesta["siguiente_pagina"])
+    respuesta = ejecutar_sql(engine, "SELECT n FROM numeros", None, governor=governor, offset=offset)
+
+    assert len(respuesta["resultados"]) == 5
+    assert respuesta["siguiente_pagina"] is None
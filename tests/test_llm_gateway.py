@@ -0,0 +1,70 @@
+import asyncio
+import time
+from types import SimpleNamespace
+import httpx
+import openai
+import pytest
+from app.llm_gateway import CircuitBreaker, LLMGateway, LLMNoDisponible
+
+
+class ClienteFalso:
+    """Cliente AsyncOpenAI falso que responde según una lista de comportamientos por llamada"""
+    def __init__(self, comportamientos):
+        self.comportamientos = list(comportamientos)
+        self.modelos = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, **kwargs):
+        self.modelos.append(model)
+        comportamiento = self.comportamientos.pop(0) if self.comportamientos else "ok"
+        if comportamiento == "timeout":
+            raise openai.APITimeoutError(request=httpx.Request("POST", "https://api.openai.com"))
+        if comportamiento == "colgado":
+            await asyncio.sleep(10)
+        mensaje = SimpleNamespace(content="SELECT 1")
+        return SimpleNamespace(choices=[SimpleNamespace(message=mensaje)], usage=None)
+
+
+def mensajes(pregunta):
+    return [{"role": "system", "content": "esquema"}, {"role": "user", "content": pregunta}]
+
+def test_reintenta_errores_transitorios():
+    cliente = ClienteFalso(["timeout", "timeout", "ok"])
+    gateway = LLMGateway(cliente, reintentos=3, backoff=0.01)
+
+    respuesta = asyncio.run(gateway.completar(mensajes("¿Cuántos clientes hay?")))
+
+    assert respuesta.choices[0].message.content == "SELECT 1"
+    assert len(cliente.modelos) == 3
+    assert gateway.get_stats()['reintentos'] == 2
+
+def test_plazo_por_llamada_y_reintentos_acotados():
+    cliente = ClienteFalso(["colgado", "colgado", "colgado"])
+    gateway = LLMGateway(cliente, timeout=0.05, reintentos=1, backoff=0.01)
+
+    inicio = time.monotonic()
+    with pytest.raises(LLMNoDisponible):
+        asyncio.run(gateway.completar(mensajes("¿Cuántos clientes hay?")))
+    assert time.monotonic() - inicio < 1
+    assert len(cliente.modelos) == 2
+
+def test_circuito_abierto_no_llama_al_modelo():
+    cliente = ClienteFalso(["timeout"] * 10)
+    gateway = LLMGateway(cliente, reintentos=0, circuito=CircuitBreaker(umbral=2, enfriamiento=60))
+
+    for _ in range(4):
+        with pytest.raises(LLMNoDisponible):
+            asyncio.run(gateway.completar(mensajes("¿Cuántos clientes hay?")))
+
+    assert len(cliente.modelos) == 2
+    assert gateway.get_stats()['circuito'] == "abierto"
+    assert gateway.get_stats()['rechazadas'] == 2
+
+def test_enrutado_por_complejidad():
+    cliente = ClienteFalso([])
+    gateway = LLMGateway(cliente, modelo_rapido="rapido", modelo_fuerte="fuerte")
+
+    asyncio.run(gateway.completar(mensajes("¿Cuántos clientes hay?")))
+    asyncio.run(gateway.completar(mensajes("Ranking de vendedores por crecimiento mes a mes respecto al año anterior")))
+
+    assert cliente.modelos == ["rapido", "fuerte"]
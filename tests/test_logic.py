@@ -1,9 +1,185 @@
-from app.logic import ejecutar_pregunta
-from app.openai_client import preparar_modelo
-from app.database import intentar_sqlalchemy
-
-def test_consulta_simple():
-    engine = intentar_sqlalchemy()
-    client = preparar_modelo()
-    resultado = ejecutar_pregunta(client, engine, "¿Cuántas bases de datos hay?")
-    assert "sql" in resultado
+from types import SimpleNamespace
+from sqlalchemy import text
+from app.logic import ejecutar_pregunta, validar_sql
+from app.metadata import DBMetadataManager
+from app.sql_templates import TemplateStore
+from conftest import crear_engine
+
+
+class ClienteFalso:
+    """Imita OpenAI().chat.completions.create devolviendo los SQL dados en orden (el último se repite)"""
+    def __init__(self, *sqls):
+        self.prompts = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.sqls = sqls
+
+    def _create(self, model, messages, **kwargs):
+        self.prompts.append(messages)
+        sql = self.sqls[min(len(self.prompts), len(self.sqls)) - 1]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=sql))])
+
+
+def test_consulta_simple(tmp_path):
+    engine = crear_engine(tmp_path)
+    db_metadata = DBMetadataManager(engine)
+    client = ClienteFalso("```sql\nSELECT COUNT(*) AS total FROM clientes\n```")
+
+    resultado = ejecutar_pregunta(client, engine, "¿Cuántos clientes hay?", db_metadata)
+
+    assert resultado["sql"] == "SELECT COUNT(*) AS total FROM clientes"
+    assert resultado["resultados"] == [{"total": 2}]
+    # El prompt describe el esquema introspeccionado de SQLite, relaciones incluidas
+    sistema = client.prompts[0][0]["content"]
+    assert "clientes" in sistema and "pedidos.cliente_id -> clientes.id" in sistema
+
+
+def test_metadatos_sqlite(tmp_path):
+    engine = crear_engine(tmp_path)
+    db_metadata = DBMetadataManager(engine)
+    columnas = {c.name: c for c in db_metadata.schema_info['tables']['pedidos'].columns}
+
+    assert columnas['id'].key == 'PRI'
+    assert columnas['cliente_id'].references == ('clientes', 'id')
+    # Sin estimación barata fuera de MySQL: el conteo solo aparece si se pide exacto
+    assert db_metadata.schema_info['tables']['clientes'].record_count is None
+    db_metadata.refresh_tables(['clientes'], exact_counts=True)
+    assert db_metadata.schema_info['tables']['clientes'].record_count == 2
+
+    # Un cambio de estructura cambia el token y el refresco recoge la tabla nueva
+    token = db_metadata.get_change_token()
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE productos (id INTEGER PRIMARY KEY)"))
+    assert db_metadata.get_change_token() != token
+    db_metadata.refresh_metadata()
+    assert 'productos' in db_metadata.schema_info['tables']
+
+
+def test_detalle_de_tablas_bajo_demanda(tmp_path):
+    engine = crear_engine(tmp_path)
+    db_metadata = DBMetadataManager(engine)
+    db_metadata.details_max_tables = 1
+
+    # La introspección no carga muestras: se piden por tabla y se guardan en la LRU
+    detalle = db_metadata.get_table_details('clientes', exact_count=True)
+    assert detalle.sample_rows == ((1, 'Ana'), (2, 'Luis'))
+    assert detalle.value_stats == {'nombre': ('Ana', 'Luis')}
+    assert detalle.exact_count == 2
+    assert db_metadata.get_table_details('clientes') is detalle
+
+    db_metadata.get_table_details('pedidos')
+    assert db_metadata.get_details_stats() == {'hits': 1, 'loads': 2, 'evictions': 1, 'tables': 1, 'max_tables': 1}
+
+    # Si cambian las columnas de la tabla, su detalle se vuelve a cargar
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE pedidos ADD COLUMN estado TEXT"))
+    anterior = db_metadata.get_table_details('pedidos')
+    db_metadata.refresh_tables(['pedidos'])
+    assert db_metadata.get_table_details('pedidos') is not anterior
+
+    # Una descripción podada para un prompt precarga en segundo plano el detalle de sus tablas,
+    # nunca con conteo exacto, y sus valores pasan a ser conocidos para el retriever
+    db_metadata.get_schema_description(tables=['clientes'])
+    db_metadata._details_executor.shutdown(wait=True)
+    assert db_metadata._details['clientes'][1].exact_count is None
+    version, valores = db_metadata.get_known_values()
+    assert valores == {'clientes': {'nombre': ('Ana', 'Luis')}}
+    assert db_metadata.get_known_values()[0] == version
+
+
+def test_plantilla_evita_llamar_al_modelo(tmp_path):
+    engine = crear_engine(tmp_path)
+    db_metadata = DBMetadataManager(engine)
+    plantillas = TemplateStore(max_entries=10, ttl=60, min_support=2)
+
+    for id_cliente in (1, 2):
+        client = ClienteFalso(f"SELECT nombre FROM clientes WHERE id = {id_cliente}")
+        ejecutar_pregunta(client, engine, f"¿Cómo se llama el cliente {id_cliente}?", db_metadata, plantillas=plantillas)
+
+    client = ClienteFalso("SELECT 'no debería llamarse al modelo'")
+    resultado = ejecutar_pregunta(client, engine, "¿Cómo se llama el cliente 2?", db_metadata, plantillas=plantillas)
+    assert client.prompts == []
+    assert resultado["cache"] == "plantilla"
+    assert resultado["resultados"] == [{"nombre": "Luis"}]
+
+
+def test_sql_de_plantilla_se_valida_sin_reparar(tmp_path):
+    engine = crear_engine(tmp_path)
+    db_metadata = DBMetadataManager(engine)
+
+    class PlantillasFalsas:
+        def __init__(self):
+            self.descartadas = []
+
+        def get(self, pregunta, fingerprint, valores_conocidos=None):
+            return "DELETE FROM clientes"
+
+        def discard(self, pregunta, fingerprint):
+            self.descartadas.append(pregunta)
+
+    plantillas = PlantillasFalsas()
+    client = ClienteFalso("SELECT 'no debería llamarse al modelo'")
+    resultado = ejecutar_pregunta(client, engine, "borra los clientes", db_metadata, plantillas=plantillas)
+    assert client.prompts == [] and plantillas.descartadas == ["borra los clientes"]
+    assert resultado["error"].startswith("El SQL generado no es válido")
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM clientes")).scalar() == 2
+
+
+def test_veredictos_memorizados_por_version_del_esquema(tmp_path):
+    db_metadata = DBMetadataManager(crear_engine(tmp_path))
+    llamadas = []
+
+    def validar(sql, schema_info):
+        llamadas.append(sql)
+        return validar_sql(sql, schema_info)
+
+    assert db_metadata.validation_verdict("SELECT nombre FROM clientes", validar) is None
+    assert db_metadata.validation_verdict("SELECT nombre FROM clientes", validar) is None
+    assert len(llamadas) == 1
+    db_metadata.refresh_metadata()
+    db_metadata.validation_verdict("SELECT nombre FROM clientes", validar)
+    assert len(llamadas) == 2
+
+
+def test_validar_sql_contra_los_metadatos(tmp_path):
+    schema_info = DBMetadataManager(crear_engine(tmp_path)).schema_info
+
+    assert validar_sql("SELECT c.nombre, SUM(p.total) AS total FROM clientes c "
+                       "JOIN pedidos p ON p.cliente_id = c.id GROUP BY c.nombre ORDER BY total DESC", schema_info) is None
+    assert validar_sql("WITH t AS (SELECT cliente_id FROM pedidos) SELECT NOMBRE FROM clientes "
+                       "WHERE id IN (SELECT cliente_id FROM t)", schema_info) is None
+    assert validar_sql("SHOW TABLES", schema_info) is None
+
+    # Escrituras y varias sentencias se rechazan sin pedir corrección
+    assert validar_sql("DELETE FROM clientes", schema_info) == (
+        "Solo se permiten consultas de lectura (SELECT, SHOW, DESCRIBE), no DELETE.", False
+    )
+    assert validar_sql("SELECT 1; DROP TABLE clientes", schema_info).reparable is False
+
+    # Tablas y columnas inexistentes o ambiguas, con el motivo concreto
+    assert validar_sql("SELECT * FROM cliente", schema_info) == ("La tabla cliente no existe; ¿quizás clientes?", True)
+    assert validar_sql("SELECT nombres FROM clientes", schema_info).motivo == (
+        "La columna nombres no existe en clientes; ¿quizás nombre?"
+    )
+    assert validar_sql("SELECT id FROM clientes JOIN pedidos ON cliente_id = clientes.id", schema_info).motivo == (
+        "La columna id es ambigua: existe en clientes, pedidos; califícala con la tabla."
+    )
+
+
+def test_reparacion_con_el_motivo_del_rechazo(tmp_path):
+    engine = crear_engine(tmp_path)
+    db_metadata = DBMetadataManager(engine)
+    client = ClienteFalso("SELECT apellido FROM clientes", "SELECT nombre FROM clientes ORDER BY id")
+
+    resultado = ejecutar_pregunta(client, engine, "Nombres de los clientes", db_metadata)
+
+    assert resultado["resultados"] == [{"nombre": "Ana"}, {"nombre": "Luis"}]
+    # La segunda llamada lleva el SQL rechazado y el motivo exacto
+    assert client.prompts[1][-2] == {"role": "assistant", "content": "SELECT apellido FROM clientes"}
+    assert "La columna apellido no existe en clientes" in client.prompts[1][-1]["content"]
+
+    # El número de correcciones está acotado
+    client = ClienteFalso("SELECT apellido FROM clientes")
+    resultado = ejecutar_pregunta(client, engine, "Apellidos de los clientes", db_metadata)
+    assert len(client.prompts) == 3
+    assert resultado["error"].startswith("El SQL generado no es válido: La columna apellido")
@@ -0,0 +1,96 @@
+from app.logic import ejecutar_sql
+from app.metadata import DBMetadataManager
+from app.result_cache import ResultCache, analizar_sql
+from app.streaming import generar_ndjson
+from conftest import crear_engine
+
+
+def test_analizar_sql():
+    sql, tablas = analizar_sql("select c.nombre from clientes c join pedidos p on p.cliente_id = c.id")
+    assert tablas == {"clientes", "pedidos"}
+    assert analizar_sql("SELECT  c.nombre FROM clientes c JOIN pedidos p ON p.cliente_id = c.id")[0] == sql
+    assert analizar_sql("WITH t AS (SELECT id FROM clientes) SELECT * FROM t")[1] == {"clientes"}
+
+    # Escrituras, varias sentencias, bloqueos, funciones no deterministas u otra base de datos
+    assert analizar_sql("DELETE FROM clientes") is None
+    assert analizar_sql("SELECT 1 FROM clientes; SELECT 2 FROM pedidos") is None
+    assert analizar_sql("SELECT * FROM clientes FOR UPDATE") is None
+    assert analizar_sql("SELECT * FROM pedidos WHERE creado > NOW()") is None
+    assert analizar_sql("SELECT RAND() FROM clientes") is None
+    assert analizar_sql("SELECT * FROM otra.clientes") is None
+    assert analizar_sql("SELECT 1") is None
+
+
+def test_acierto_e_invalidacion_por_tabla(tmp_path):
+    engine = crear_engine(tmp_path)
+    db_metadata = DBMetadataManager(engine)
+    cache = ResultCache(validation="none")
+    sql = "SELECT nombre FROM clientes ORDER BY id"
+
+    primero = ejecutar_sql(engine, sql, db_metadata, cache_resultados=cache)
+    segundo = ejecutar_sql(engine, sql, db_metadata, cache_resultados=cache)
+    assert (primero["cache_resultado"], segundo["cache_resultado"]) == ("MISS", "HIT")
+    assert segundo["resultados"] == [{"nombre": "Ana"}, {"nombre": "Luis"}]
+    ejecutar_sql(engine, "SELECT COUNT(*) FROM pedidos", db_metadata, cache_resultados=cache)
+
+    # Una escritura que pasa por el servicio solo invalida los resultados de su tabla
+    escritura = ejecutar_sql(engine, "INSERT INTO pedidos (cliente_id, total) VALUES (1, 9.5)", db_metadata,
+                             cache_resultados=cache)
+    assert escritura["cache_resultado"] == "BYPASS"
+    assert ejecutar_sql(engine, sql, db_metadata, cache_resultados=cache)["cache_resultado"] == "HIT"
+    assert ejecutar_sql(engine, "SELECT COUNT(*) FROM pedidos", db_metadata,
+                        cache_resultados=cache)["cache_resultado"] == "MISS"
+    assert cache.get_stats()["entries"] == 2
+
+
+def test_expulsion_por_bytes_y_escritura_durante_la_ejecucion(tmp_path):
+    engine = crear_engine(tmp_path)
+    cache = ResultCache(max_bytes=100, validation="none")
+    respuesta = {"sql": "x", "resultados": [{"nombre": "Ana"}, {"nombre": "Luis"}]}
+
+    for tabla in ("clientes", "pedidos"):
+        _, consulta = cache.buscar(engine, f"SELECT * FROM {tabla}")
+        cache.guardar(consulta, respuesta)
+    assert cache.get_stats()["evictions"] == 1
+    assert cache.buscar(engine, "SELECT * FROM clientes")[0] is None
+    assert cache.buscar(engine, "SELECT * FROM pedidos")[0] == respuesta
+
+    # Si la tabla se invalida entre la búsqueda y el guardado, el resultado no se guarda
+    _, consulta = cache.buscar(engine, "SELECT * FROM clientes")
+    cache.invalidar(["clientes"])
+    cache.guardar(consulta, respuesta)
+    assert cache.buscar(engine, "SELECT * FROM clientes")[0] is None
+
+    # Un cambio de huella del esquema descarta todo
+    cache.buscar(engine, "SELECT * FROM pedidos", fingerprint="otra")
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_sin_reutilizar_las_escrituras_invalidan_igual(tmp_path):
+    engine = crear_engine(tmp_path).execution_options(isolation_level="AUTOCOMMIT")
+    db_metadata = DBMetadataManager(engine)
+    cache = ResultCache(validation="none")
+    sql = "SELECT nombre FROM clientes ORDER BY id"
+    ejecutar_sql(engine, sql, db_metadata, cache_resultados=cache)
+
+    # ?cache=false no lee ni guarda, pero su escritura sí invalida
+    assert ejecutar_sql(engine, sql, db_metadata, cache_resultados=cache, reutilizar=False)["cache_resultado"] == "BYPASS"
+    ejecutar_sql(engine, "INSERT INTO clientes (nombre) VALUES ('Eva')", db_metadata,
+                 cache_resultados=cache, reutilizar=False)
+    respuesta = ejecutar_sql(engine, sql, db_metadata, cache_resultados=cache)
+    assert respuesta["cache_resultado"] == "MISS" and len(respuesta["resultados"]) == 3
+
+    # Igual con una escritura transmitida en NDJSON
+    list(generar_ndjson(engine, "DELETE FROM clientes WHERE nombre = 'Eva'", cache_resultados=cache))
+    respuesta = ejecutar_sql(engine, sql, db_metadata, cache_resultados=cache)
+    assert respuesta["cache_resultado"] == "MISS" and len(respuesta["resultados"]) == 2
+
+
+def test_ddl_transmitido_refresca_los_metadatos(tmp_path):
+    engine = crear_engine(tmp_path).execution_options(isolation_level="AUTOCOMMIT")
+    db_metadata = DBMetadataManager(engine)
+    avisos = []
+    db_metadata.on_ddl = avisos.append
+
+    list(generar_ndjson(engine, "CREATE TABLE facturas (id INTEGER PRIMARY KEY)", db_metadata=db_metadata))
+    assert "facturas" in db_metadata.schema_info["tables"] and avisos == [["facturas"]]
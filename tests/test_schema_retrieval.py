@@ -0,0 +1,115 @@
+import asyncio
+import threading
+from app.logic import describir_esquema_async
+from app.metadata import ColumnInfo, TableInfo
+from app.schema_retrieval import SchemaRetriever, tokenizar
+
+def _tabla(*columnas):
+    return TableInfo(tuple(ColumnInfo(c, 'int', True, '', None, '', None) for c in columnas), None)
+
+SCHEMA_INFO = {
+    'current_db': 'tienda',
+    'databases': ['tienda'],
+    'tables': {
+        'clientes': _tabla('id', 'nombre', 'ciudad'),
+        'pedidos': _tabla('id', 'cliente_id', 'fecha', 'total'),
+        'productos': _tabla('id', 'nombre', 'precio'),
+        'proveedores': _tabla('id', 'razon_social'),
+        'empleados': _tabla('id', 'nombre', 'salario'),
+    },
+    'relationships': [
+        {'table': 'pedidos', 'column': 'cliente_id', 'referenced_table': 'clientes', 'referenced_column': 'id'}
+    ]
+}
+
+def test_tokenizar_identificadores_y_plurales():
+    assert tokenizar("clienteId") == tokenizar("cliente_id") == ["client", "id"]
+    assert tokenizar("Clientes") == tokenizar("cliente")
+
+def test_selecciona_top_k_y_vecinas():
+    retriever = SchemaRetriever(top_k=1)
+    tablas = retriever.select_tables("¿Cuál es el total de pedidos por fecha?", SCHEMA_INFO, "v1")
+
+    assert tablas == ["pedidos", "clientes"]
+
+def test_valores_conocidos_entran_en_el_indice():
+    retriever = SchemaRetriever(top_k=1)
+    assert retriever.select_tables("pedidos de Zaragoza", SCHEMA_INFO, "v1")[0] == "pedidos"
+
+    # Con el detalle de clientes en memoria, el valor de la pregunta apunta a su tabla
+    valores = (1, {'clientes': {'ciudad': ('Madrid', 'Zaragoza')}})
+    assert retriever.select_tables("¿Quién vive en Zaragoza?", SCHEMA_INFO, "v1", valores)[0] == "clientes"
+
+def test_sin_poda_si_el_esquema_es_pequeno():
+    retriever = SchemaRetriever(top_k=10)
+    assert retriever.select_tables("salario medio", SCHEMA_INFO, "v1") is None
+
+def test_con_embeddings_la_seleccion_no_bloquea_el_event_loop():
+    class Vector:
+        def __matmul__(self, otro):
+            return 0.0
+
+    class ModeloFalso:
+        def __init__(self):
+            self.hilos = set()
+
+        def encode(self, textos, normalize_embeddings=True):
+            self.hilos.add(threading.current_thread())
+            return [Vector() for _ in textos]
+
+    class MetadatosFalsos:
+        schema_info = SCHEMA_INFO
+
+        def get_fingerprint_token(self):
+            return "v1"
+
+        def get_system_prompt(self, prefix, tables=None):
+            return ", ".join(tables), 0
+
+        def get_known_values(self):
+            return None
+
+    retriever = SchemaRetriever(top_k=1)
+    retriever._model = ModeloFalso()
+    descripcion, tablas, _ = asyncio.run(describir_esquema_async(MetadatosFalsos(), "total de pedidos", retriever))
+    assert tablas[0] == "pedidos" and descripcion.startswith("pedidos")
+    assert threading.main_thread() not in retriever._model.hilos
+
+def test_rank_concurrente_con_reconstrucciones():
+    retriever = SchemaRetriever(top_k=1)
+    otro = {**SCHEMA_INFO, 'tables': {f"tabla_{i}": _tabla(f"columna_{i}") for i in range(50)}}
+    errores = []
+
+    def reconstruir():
+        for i in range(200):
+            retriever.build(otro if i % 2 else SCHEMA_INFO, f"v{i}")
+
+    def consultar():
+        try:
+            for _ in range(200):
+                retriever.rank("total de pedidos de la tabla 7 por columna 3")
+        except Exception as e:
+            errores.append(e)
+
+    hilos = [threading.Thread(target=reconstruir)] + [threading.Thread(target=consultar) for _ in range(3)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert errores == []
+
+def test_valores_nuevos_solo_rehacen_sus_tablas():
+    retriever = SchemaRetriever(top_k=1)
+    retriever.build(SCHEMA_INFO, "v1", (1, {'clientes': {'ciudad': ('Madrid',)}}))
+    docs_antes = retriever._index[0]
+
+    valores = (2, {'clientes': {'ciudad': ('Madrid',)}, 'productos': {'nombre': ('Tornillo', 'Madrid')}})
+    retriever.build(SCHEMA_INFO, "v1", valores)
+    docs, idf, longitud_media, _, _ = retriever._index
+    assert docs['productos'] is not docs_antes['productos']
+    assert all(docs[t] is docs_antes[t] for t in docs if t != 'productos')
+
+    # El índice actualizado es el mismo que uno construido desde cero con esos valores
+    completo = SchemaRetriever(top_k=1)
+    completo.build(SCHEMA_INFO, "v1", valores)
+    assert (docs, idf, longitud_media) == completo._index[:3]
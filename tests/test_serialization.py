@@ -0,0 +1,18 @@
+from datetime import datetime
+from decimal import Decimal
+import orjson
+from app.serialization import a_columnar, dumps, elegir_formato
+
+def test_columnar_con_decimal_y_fechas():
+    resultado = a_columnar(["id", "total", "creado"], [(1, Decimal("9.50"), datetime(2024, 3, 1)), (2, None, None)])
+
+    assert orjson.loads(dumps(resultado)) == {
+        "columnas": ["id", "total", "creado"],
+        "tipos": ["int", "number", "datetime"],
+        "filas": [[1, 9.5, "2024-03-01T00:00:00"], [2, None, None]]
+    }
+
+def test_formato_por_query_o_accept():
+    assert elegir_formato("columnar", None) == "columnar"
+    assert elegir_formato(None, "application/vnd.nl2sql.columnar+json") == "columnar"
+    assert elegir_formato(None, "application/json") is None
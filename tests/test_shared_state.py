@@ -0,0 +1,51 @@
+import asyncio
+import threading
+from app.cache import QuestionCache
+from app.shared_state import SQLiteSharedState
+
+def test_lease_exclusiva_hasta_que_caduca(tmp_path):
+    estado = SQLiteSharedState(str(tmp_path / "estado.db"))
+    assert estado.adquirir_lease("refresher", "worker-1", ttl=60)
+    assert estado.adquirir_lease("refresher", "worker-1", ttl=60)  # renovación
+    assert not estado.adquirir_lease("refresher", "worker-2", ttl=60)
+
+    estado.adquirir_lease("refresher", "worker-1", ttl=-1)  # caducada
+    assert estado.adquirir_lease("refresher", "worker-2", ttl=60)
+
+    estado.liberar_lease("refresher", "worker-2")
+    assert estado.adquirir_lease("refresher", "worker-3", ttl=60)
+
+def test_cache_compartida_entre_workers(tmp_path):
+    ruta = str(tmp_path / "estado.db")
+    worker_1 = QuestionCache(max_entries=10, ttl=60, shared=SQLiteSharedState(ruta))
+    worker_2 = QuestionCache(max_entries=10, ttl=60, shared=SQLiteSharedState(ruta))
+
+    worker_1.put("¿Cuántos clientes hay?", "v1", "SELECT COUNT(*) FROM clientes")
+    assert worker_2.get("cuantos clientes hay", "v1") == "SELECT COUNT(*) FROM clientes"
+    assert worker_2.get("cuantos clientes hay", "v2") is None
+    assert worker_2.get_stats()['hits_shared'] == 1
+
+
+def test_cache_compartida_fuera_del_event_loop(tmp_path):
+    class EstadoEnHilos(SQLiteSharedState):
+        """Registra en qué hilo se hace cada acceso al estado compartido"""
+        hilos = set()
+
+        def cache_get(self, *args):
+            self.hilos.add(threading.current_thread())
+            return super().cache_get(*args)
+
+        def cache_put(self, *args):
+            self.hilos.add(threading.current_thread())
+            return super().cache_put(*args)
+
+    ruta = str(tmp_path / "estado.db")
+    worker_1 = QuestionCache(max_entries=10, ttl=60, shared=EstadoEnHilos(ruta))
+    worker_2 = QuestionCache(max_entries=10, ttl=60, shared=EstadoEnHilos(ruta))
+
+    async def escenario():
+        await worker_1.put_async("¿Cuántos clientes hay?", "v1", "SELECT COUNT(*) FROM clientes")
+        return await worker_2.get_async("cuantos clientes hay", "v1")
+
+    assert asyncio.run(escenario()) == "SELECT COUNT(*) FROM clientes"
+    assert len(EstadoEnHilos.hilos) >= 1 and threading.main_thread() not in EstadoEnHilos.hilos
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from app.logic import ejecutar_pregunta_async
+from app.singleflight import SingleFlight, SingleFlightSync
+from conftest import Metadatos, crear_engine
+
+
+class ClienteLento:
+    """Cliente AsyncOpenAI falso que cuenta las llamadas al modelo"""
+    def __init__(self):
+        self.llamadas = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, **kwargs):
+        self.llamadas += 1
+        await asyncio.sleep(0.05)
+        mensaje = SimpleNamespace(content="SELECT COUNT(*) AS total FROM clientes")
+        return SimpleNamespace(choices=[SimpleNamespace(message=mensaje)], usage=None)
+
+
+def test_peticiones_identicas_concurrentes_hacen_una_sola_llamada_al_modelo(tmp_path):
+    engine = crear_engine(tmp_path, clientes=("Ana", "Luis", "Eva"))
+    cliente = ClienteLento()
+    flights = SingleFlight()
+
+    async def lanzar():
+        return await asyncio.gather(*(
+            ejecutar_pregunta_async(cliente, engine, pregunta, Metadatos(), singleflight=flights)
+            for pregunta in ["¿Cuántos clientes hay?", "cuantos clientes hay"] * 10
+        ))
+
+    resultados = asyncio.run(lanzar())
+
+    assert cliente.llamadas == 1
+    assert all(r["resultados"] == [{"total": 3}] for r in resultados)
+    assert flights.get_stats() == {'ejecuciones': 2, 'compartidas': 38, 'en_vuelo': 0}
+
+
+def test_refrescos_concurrentes_comparten_una_ejecucion():
+    flight = SingleFlightSync()
+    ejecuciones = []
+
+    def refrescar():
+        ejecuciones.append(1)
+        time.sleep(0.05)
+        return True
+
+    resultados = []
+    hilos = [threading.Thread(target=lambda: resultados.append(flight.do("refresh", refrescar))) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert len(ejecuciones) == 1
+    assert resultados == [True] * 8
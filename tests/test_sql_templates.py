@@ -0,0 +1,90 @@
+from app.sql_templates import TemplateStore, abstraer
+
+PREFIJO = "Base de datos actual: tienda. Mi pregunta es: "
+
+
+def test_abstraer_alinea_literales_con_la_pregunta():
+    patron, mascara, _, _, valores, _, tablas = abstraer(
+        PREFIJO + "Ventas de marzo del cliente 42 en Madrid",
+        "SELECT SUM(total) FROM ventas WHERE MONTH(fecha) = 3 AND cliente_id = 42 AND ciudad LIKE '%MADRID%'"
+    )
+    assert patron[-8:] == ("ventas", "de", "<mes:1>", "del", "cliente", "<numero:1>", "en", "<texto:1>")
+    assert [h.tipo for h in mascara] == ["mes", "numero", "texto"]
+    assert valores == ("3", "42", "Madrid")
+    assert tablas == {"ventas"}
+
+    # Sin literales que salgan de la pregunta, o con una alineación ambigua, no hay plantilla
+    assert abstraer(PREFIJO + "¿Cuántos clientes hay?", "SELECT COUNT(*) FROM clientes WHERE activo = 1") is None
+    assert abstraer(PREFIJO + "pedidos 5 del cliente 5", "SELECT * FROM pedidos WHERE cliente_id = 5") is None
+
+
+def test_plantilla_se_activa_con_valores_distintos_y_liga_parametros():
+    plantillas = TemplateStore(max_entries=10, ttl=60, min_support=2)
+    plantillas.put(PREFIJO + "pedidos del cliente 42", "v1", "SELECT * FROM pedidos WHERE cliente_id = 42")
+    # Un solo ejemplo no basta para fiarse de que el literal es un parámetro
+    assert plantillas.get(PREFIJO + "pedidos del cliente 57", "v1") is None
+
+    plantillas.put(PREFIJO + "pedidos del cliente 7", "v1", "SELECT * FROM pedidos WHERE cliente_id = 7")
+    assert plantillas.get(PREFIJO + "pedidos del cliente 57", "v1") == "SELECT * FROM pedidos WHERE cliente_id = 57"
+    assert plantillas.get(PREFIJO + "pedidos del cliente Ana", "v1") is None
+    assert plantillas.get(PREFIJO + "facturas del cliente 57", "v1") is None
+
+    # Los textos se ligan como literales escapados, con las mismas mayúsculas que el ejemplo
+    plantillas.put(PREFIJO + "clientes de Madrid", "v1", "SELECT * FROM clientes WHERE ciudad = 'MADRID'")
+    plantillas.put(PREFIJO + "clientes de Lugo", "v1", "SELECT * FROM clientes WHERE ciudad = 'LUGO'")
+    assert plantillas.get(PREFIJO + "clientes de O'Brien", "v1") is None
+    conocidos = (1, {"clientes": {"ciudad": ("Lugo", "Soria")}})
+    assert plantillas.get(PREFIJO + "clientes de Soria", "v1", conocidos) == "SELECT * FROM clientes WHERE ciudad = 'SORIA'"
+
+    stats = plantillas.get_stats()
+    assert (stats['hits'], stats['misses'], stats['active']) == (2, 4, 2)
+
+
+def test_conflicto_descarte_e_invalidacion_por_huella():
+    plantillas = TemplateStore(max_entries=10, ttl=60, min_support=2)
+    for cliente in (1, 2):
+        plantillas.put(PREFIJO + f"pedidos del cliente {cliente}", "v1",
+                       f"SELECT * FROM pedidos WHERE cliente_id = {cliente}")
+
+    # Otro SQL para el mismo patrón de pregunta: la plantilla vuelve a empezar
+    plantillas.put(PREFIJO + "pedidos del cliente 3", "v1", "SELECT id FROM pedidos WHERE cliente_id = 3")
+    assert plantillas.get(PREFIJO + "pedidos del cliente 4", "v1") is None
+    plantillas.put(PREFIJO + "pedidos del cliente 5", "v1", "SELECT id FROM pedidos WHERE cliente_id = 5")
+    assert plantillas.get(PREFIJO + "pedidos del cliente 4", "v1") == "SELECT id FROM pedidos WHERE cliente_id = 4"
+
+    plantillas.discard(PREFIJO + "pedidos del cliente 4", "v1")
+    assert plantillas.get(PREFIJO + "pedidos del cliente 4", "v1") is None
+
+    plantillas.put(PREFIJO + "pedidos del cliente 1", "v1", "SELECT id FROM pedidos WHERE cliente_id = 1")
+    plantillas.get(PREFIJO + "pedidos del cliente 1", "v2")
+    assert plantillas.get_stats()['templates'] == 0
+    assert plantillas.get_stats()['conflicts'] == 1
+
+
+def test_textos_numeros_y_limites_sin_ambiguedad():
+    plantillas = TemplateStore(max_entries=10, ttl=60, min_support=2)
+
+    # Un texto solo se liga si ya salió en un ejemplo o es un valor conocido de su columna
+    for ciudad in ("Madrid", "Sevilla"):
+        plantillas.put(PREFIJO + f"cuántos clientes hay en {ciudad}", "v1",
+                       f"SELECT COUNT(*) FROM clientes WHERE ciudad = '{ciudad}'")
+    conocidos = (1, {"clientes": {"ciudad": ("Madrid", "Sevilla", "Soria")}})
+    assert plantillas.get(PREFIJO + "cuántos clientes hay en total", "v1", conocidos) is None
+    assert plantillas.get(PREFIJO + "cuántos clientes hay en Sevilla", "v1") == \
+        "SELECT COUNT(*) FROM clientes WHERE ciudad = 'Sevilla'"
+    assert plantillas.get(PREFIJO + "cuántos clientes hay en Soria", "v1", conocidos) == \
+        "SELECT COUNT(*) FROM clientes WHERE ciudad = 'Soria'"
+
+    # "." separa miles y "," decimales; "2.5" no es un número español y no se liga
+    plantillas.put(PREFIJO + "pedidos mayores de 50 euros", "v1", "SELECT * FROM pedidos WHERE total > 50")
+    plantillas.put(PREFIJO + "pedidos mayores de 2,5 euros", "v1", "SELECT * FROM pedidos WHERE total > 2.5")
+    assert plantillas.get(PREFIJO + "pedidos mayores de 1.000 euros", "v1") == "SELECT * FROM pedidos WHERE total > 1000"
+    assert plantillas.get(PREFIJO + "pedidos mayores de 7,25 euros", "v1") == "SELECT * FROM pedidos WHERE total > 7.25"
+    assert plantillas.get(PREFIJO + "pedidos mayores de 1.5 euros", "v1") is None
+
+    # LIMIT solo admite enteros
+    for n in (3, 10):
+        plantillas.put(PREFIJO + f"las {n} mayores ventas", "v1", f"SELECT * FROM ventas ORDER BY total DESC LIMIT {n}")
+    assert plantillas.get(PREFIJO + "las 2,5 mayores ventas", "v1") is None
+    assert plantillas.get(PREFIJO + "las 1.000 mayores ventas", "v1") == \
+        "SELECT * FROM ventas ORDER BY total DESC LIMIT 1000"
@@ -0,0 +1,112 @@
+import asyncio
+from types import SimpleNamespace
+import orjson
+from sqlalchemy import text
+from app.cache import QuestionCache
+from app.governor import QueryGovernor
+from app.llm_gateway import LLMGateway
+from app.streaming import generar_ndjson, generar_sse
+from conftest import Metadatos, crear_engine
+
+CLIENTES = tuple(f"c{i}" for i in range(1, 6))
+COLUMNAS = ("id", "nombre")
+
+
+class ClienteStreaming:
+    """Cliente AsyncOpenAI falso que devuelve el SQL en varios fragmentos con stream=True"""
+    def __init__(self, fragmentos):
+        self.fragmentos = fragmentos
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, stream=False, **kwargs):
+        async def fragmentos():
+            for texto in self.fragmentos:
+                await asyncio.sleep(0)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=texto))])
+        return fragmentos()
+
+
+def leer_eventos(cuerpo):
+    eventos = []
+    for bloque in cuerpo.decode().strip().split("\n\n"):
+        nombre, datos = bloque.split("\n")
+        eventos.append((nombre.removeprefix("event: "), orjson.loads(datos.removeprefix("data: "))))
+    return eventos
+
+def test_sse_transmite_tokens_y_filas(tmp_path):
+    engine = crear_engine(tmp_path, CLIENTES)
+    cliente = ClienteStreaming(["SELECT id, nombre ", "FROM clientes ", "ORDER BY id"])
+
+    async def consumir():
+        return b"".join([e async for e in generar_sse(cliente, "lista de clientes", Metadatos(columnas=COLUMNAS), engine, chunk_size=2)])
+
+    eventos = leer_eventos(asyncio.run(consumir()))
+
+    assert [n for n, _ in eventos] == ["token"] * 3 + ["sql", "columnas", "filas", "filas", "filas", "fin"]
+    assert eventos[3][1]["sql"] == "SELECT id, nombre FROM clientes ORDER BY id"
+    assert eventos[4][1]["columnas"] == ["id", "nombre"]
+    assert eventos[5][1]["filas"] == [[1, "c1"], [2, "c2"]]
+    assert eventos[-1][1]["total_filas"] == 5
+
+def test_sse_rechaza_sql_no_valido(tmp_path):
+    engine = crear_engine(tmp_path, CLIENTES)
+    cliente = ClienteStreaming(["DROP TABLE ", "clientes"])
+
+    async def consumir():
+        return b"".join([e async for e in generar_sse(cliente, "borra todo", Metadatos(columnas=COLUMNAS), engine)])
+
+    eventos = leer_eventos(asyncio.run(consumir()))
+
+    assert [n for n, _ in eventos] == ["token", "token", "error"]
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM clientes")).scalar() == 5
+
+def test_ndjson_cabecera_con_sql(tmp_path):
+    engine = crear_engine(tmp_path, CLIENTES)
+    lineas = [orjson.loads(l) for l in generar_ndjson(engine, "SELECT id FROM clientes", chunk_size=3)]
+
+    assert lineas[0] == {"sql": "SELECT id FROM clientes", "columnas": ["id"]}
+    assert lineas[-1] == {"fin": True, "total_filas": 5}
+
+def test_sse_a_traves_de_la_pasarela(tmp_path):
+    engine = crear_engine(tmp_path, CLIENTES)
+    gateway = LLMGateway(ClienteStreaming(["SELECT COUNT(*) ", "AS total FROM clientes"]))
+
+    async def consumir():
+        return b"".join([e async for e in generar_sse(gateway, "cuantos clientes", Metadatos(columnas=COLUMNAS), engine)])
+
+    eventos = leer_eventos(asyncio.run(consumir()))
+
+    assert eventos[2] == ("sql", {"sql": "SELECT COUNT(*) AS total FROM clientes", "cache": None})
+    assert eventos[4] == ("filas", {"filas": [[5]]})
+    assert gateway.limitador.get_stats()['en_curso'] == 0
+
+def test_sse_con_gobernador_y_sql_cacheado_validado(tmp_path):
+    engine = crear_engine(tmp_path, CLIENTES)
+    cliente = ClienteStreaming(["SELECT id FROM clientes"])
+    governor = QueryGovernor(max_rows=3, timeout_ms=0)
+
+    async def consumir(pregunta, cache=None):
+        return leer_eventos(b"".join([
+            e async for e in generar_sse(cliente, pregunta, Metadatos(columnas=COLUMNAS), engine, cache=cache, governor=governor)
+        ]))
+
+    # El cursor no lee más filas que el tope del gobernador
+    eventos = asyncio.run(consumir("ids de clientes"))
+    assert eventos[-1] == ("fin", {"fin": True, "total_filas": 3, "limitado": True})
+
+    # Un SQL de la caché que ya no encaja con el esquema no se ejecuta
+    cache = QuestionCache(max_entries=10, ttl=60)
+    cache.put("apellidos", "v1", "SELECT apellido FROM clientes")
+    eventos = asyncio.run(consumir("apellidos", cache))
+    assert [n for n, _ in eventos] == ["error"] and "apellido" in eventos[0][1]["error"]
+
+def test_ndjson_avisa_si_la_consulta_falla(tmp_path):
+    engine = crear_engine(tmp_path, CLIENTES)
+    avisos = []
+    lineas = [orjson.loads(l) for l in generar_ndjson(
+        engine, "SELECT * FROM facturas", al_terminar=lambda: avisos.append("fin"),
+        al_fallar=lambda: avisos.append("fallo")
+    )]
+
+    assert "error" in lineas[-1] and avisos == ["fallo"]
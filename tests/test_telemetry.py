@@ -0,0 +1,38 @@
+import asyncio
+import logging
+from app.telemetry import ETAPA_LLM, ETAPA_SQL, etapa, iniciar_traza, trazar_stream
+
+
+def _etapas(caplog, traza):
+    lineas = [r.getMessage() for r in caplog.records if r.getMessage().startswith(f"Traza {traza.id}")]
+    assert len(lineas) == 1
+    return [parte.split("@")[0] for parte in lineas[0].split()[3:]]
+
+
+def test_la_traza_se_cierra_al_terminar_el_stream(caplog):
+    caplog.set_level(logging.INFO, logger="app.telemetry")
+
+    async def sse():
+        with etapa(ETAPA_LLM):
+            await asyncio.sleep(0)
+        yield b"token"
+        with etapa(ETAPA_SQL):
+            yield b"filas"
+
+    async def consumir(traza, cuerpo, nombre_etapa=None):
+        bloques = []
+        async for bloque in trazar_stream(traza, cuerpo, nombre_etapa):
+            # Nada se registra hasta que termina la transmisión
+            assert not any(r.getMessage().startswith(f"Traza {traza.id}") for r in caplog.records)
+            bloques.append(bloque)
+        return bloques
+
+    # Las etapas que ocurren durante un stream asíncrono quedan en la traza
+    traza = iniciar_traza()
+    assert asyncio.run(consumir(traza, sse())) == [b"token", b"filas"]
+    assert _etapas(caplog, traza) == [ETAPA_LLM, ETAPA_SQL]
+
+    # Un iterador síncrono se lee en el pool y toda su lectura cuenta como la etapa indicada
+    traza = iniciar_traza()
+    assert asyncio.run(consumir(traza, iter([b"a", b"b"]), ETAPA_SQL)) == [b"a", b"b"]
+    assert _etapas(caplog, traza) == [ETAPA_SQL]